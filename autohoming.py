@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 from os import POSIX_FADV_SEQUENTIAL
 import time
-import threading
+import asyncio
 import socket
-import json
+import argparse
+from collections import OrderedDict
+import codec
+import metrics
 from gpiozero import PWMLED
 from simple_pid import PID
-from pixhawk import Pixhawk     # pixhawk or nucleo
+from pixhawk import Pixhawk, ManualControlStreamer, COMMAND_TIMEOUT     # pixhawk or nucleo
+from scheduler import ControlScheduler
+from flightrec import FlightRecorder
+from bearing_filter import BearingFilter, wrap180
+from fusion import HeadingFusion
+from localize import BeaconLocalizer
+from profiler import Profiler, PROFILE_DIR
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
 
@@ -30,185 +39,378 @@ SETPOINT_REACHED_WAIT_PERIOD = 3    # time in seconds before yaw angle is consid
 FORWARD_SPEED = 200                 # speed (max 1000) the ship move forward
 YAW_SPEED = 100                     # speed the ship yaw to turn toward the goal
 
+""" Control loop settings """
+CONTROL_MIN_PERIOD = 0.02           # seconds, new samples arriving faster than this are coalesced into one step
+CONTROL_MAX_PERIOD = 0.1            # seconds, a step runs at least this often even without new samples
+STATUS_PERIOD = 1                   # seconds between effort and input lines in the log, steps run up to 1/CONTROL_MIN_PERIOD times a second
+STATS_PERIOD = 10                   # seconds between control loop statistics reports
+TELEM_PERIOD = 0.2                  # seconds between telemetry snapshots to the relay, which decides what the LORA link gets
+APPLIED_CACHE = 256                 # command ids remembered, a retransmission of one of them is acked without applying it again
+MAX_PACKET = 1024                   # bytes read per UDP packet, every input packet is far smaller
+SEQ_MODULO = 65536                  # command ids are 16 bit and wrap around
+REORDER_WINDOW = 30                 # seconds a command can be older than the latest of its name, longer than any GUI retry, e.g. after a GUI restart
+FLIGHT_RECORD = "/home/pi/flight.rec"   # ring file kept across runs, replay with flightrec.py
+
 """ Helper classes """
 class Timer:
     """ Convenient class for executing non timing-critical action periodically """
-    def __init__(self, duration):
+    def __init__(self, duration, clock=time.time):
         self.duration = duration
-        self.start_time = time.time()
+        self.clock = clock
+        self.start_time = clock()
 
     def __call__(self):
-        if time.time() - self.start_time > self.duration:
+        if self.clock() - self.start_time > self.duration:
             self.reset()
             return True
         else:
             return False
 
     def reset(self):
-        self.start_time = time.time()
+        self.start_time = self.clock()
+
+class UDPReceiver(asyncio.DatagramProtocol):
+    """
+    Base class for a UDP input: bound socket, packet handling, and a timeout after which the state is reset
+    On the event loop the receiver is the datagram protocol of its own socket
+    """
+    name = "UDP"
+    on_packet = None        # called after each batch of packets, e.g. to trigger a control step
+    recorder = None         # flight recorder getting every packet received
+
+    def __init__(self, UDP_IP, UDP_PORT, timeout=None):
+        self.port = UDP_PORT
+        self.timeout = timeout
+        self.received = metrics.counter("autohoming_packets_total", "UDP packets received per input", input=self.name)
+        self.decode_errors = metrics.counter("autohoming_decode_errors_total", "Packets that failed to decode per input", input=self.name)
+        self.timeouts = metrics.counter("autohoming_input_timeouts_total", "Inputs reset after their timeout without a packet", input=self.name)
+        self.last_packet = time.monotonic()
+        self.sock = socket.socket(socket.AF_INET, # Internet
+                                    socket.SOCK_DGRAM) # UDP
+        self.sock.bind((UDP_IP, UDP_PORT))
+        self.sock.settimeout(timeout)
+
+    def reset(self):
+        pass
 
-class Joystick:
+    def handle(self, message):
+        raise NotImplementedError
+
+    def timed_out(self):
+        self.reset()
+        log.debug("Socket timed out waiting for %s msg", self.name)
+
+    def update(self):
+        """ Blocking receive of one packet, for running the receiver on its own thread """
+        try:
+            message, addr = self.sock.recvfrom(MAX_PACKET)
+            self.received.inc()
+            if self.recorder:
+                self.recorder.packet(self.port, message)
+            self.handle(message)
+        except socket.timeout:
+            self.timeouts.inc()
+            self.timed_out()
+
+    def datagram_received(self, message, addr):
+        """ Protocol callback for each packet, the transport only reads when the socket is ready so no read ever fails """
+        self.last_packet = time.monotonic()
+        self.received.inc()
+        if self.recorder:
+            self.recorder.packet(self.port, message)
+        self.handle(message)
+        if self.on_packet:
+            self.on_packet()
+
+    async def attach(self, loop):
+        """ Serve the socket from the loop as a datagram endpoint, with this receiver as its protocol """
+        transport, protocol = await loop.create_datagram_endpoint(lambda: self, sock=self.sock)
+        transport.max_size = MAX_PACKET         # the selector transport reads each packet into a fresh 256 KiB buffer otherwise
+
+    def error_received(self, exc):
+        log.warning("%s socket error: %s", self.name, exc)
+
+    async def watchdog(self):
+        """ Event loop equivalent of the socket timeout """
+        if self.timeout is None:
+            return
+        while True:
+            remaining = self.last_packet + self.timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            else:
+                self.timeouts.inc()
+                self.timed_out()
+                self.last_packet = time.monotonic()
+
+class Joystick(UDPReceiver):
     """ Convenient class for getting joystick data from UDP packet """
+    name = "Joystick"
+
     def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_JS):
         self.axes = [0]*6
         self.btns = [0]*6
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                                    socket.SOCK_DGRAM) # UDP
-        self.sock.bind((UDP_IP, UDP_PORT))
-        self.sock.settimeout(1)
+        super().__init__(UDP_IP, UDP_PORT, timeout=1)
 
     def reset(self):
         self.axes = [0]*6
         self.btns = [0]*6
     
-    def update(self):
+    def handle(self, message):
         try:
-            message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
             #log.debug(message)
-            packet = json.loads(message.decode())
+            packet = codec.decode(message)
             if packet.get("type") == "js":
                 self.axes = packet.get("ax",[0]*6)
                 self.btns = packet.get("bt",[0]*6)
             else:
                 self.reset()
             
-        except socket.timeout:
-            self.reset()
-            log.debug("Socket timed out waiting for Joystick msg")
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\nReceived msg: %s", message.decode())
+        except codec.DecodeError:
+            self.decode_errors.inc()
+            log.error("Corrupt or incorrect format\nReceived msg: %s", message)
         except KeyError as msg:
             log.error("Packet received has no [%s] key", msg)
 
-class Vision:
+class Vision(UDPReceiver):
+    name = "Vision"
+
     def __init__(self, UDP_IP = VISION_IP, UDP_PORT = PORT_VISION):
         self.bearing = None
         self.distance = None
-
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                                    socket.SOCK_DGRAM) # UDP
-        self.sock.bind((UDP_IP, UDP_PORT))
-        self.sock.settimeout(10)
+        self.heading = None             # latest autopilot heading, set by HeadingFusion
+        self.world_bearing = None       # vision bearing turned into the world frame when it arrived
+        super().__init__(UDP_IP, UDP_PORT, timeout=10)
 
         self.reset()
 
     def reset(self):
         self.bearing = None
         self.distance = None
+        self.world_bearing = None
 
-    def update(self):
+    def predict(self, heading):
+        """ New autopilot heading, refresh the relative bearing from the world frame one """
+        self.heading = heading
+        if self.world_bearing is not None:
+            self.bearing = wrap180(self.world_bearing - heading)
+
+    def timed_out(self):
+        log.debug("Socket timed out waiting for Vision msg")    # last vision fix is kept
+
+    def handle(self, message):
         try:
-            message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
             # log.debug(message)
-            packet = json.loads(message.decode())
+            packet = codec.decode(message)
 
             if packet.get("type") == "vision":
                 self.bearing = packet.get("bearing") or None
                 self.distance = packet.get("distance") or None
+                if self.bearing is not None and self.heading is not None:
+                    self.world_bearing = wrap180(self.bearing + self.heading)
+                else:
+                    self.world_bearing = None
 
-        except socket.timeout:
-            self.reset
-            log.debug("Socket timed out waiting for Vision msg")
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\nReceived msg: %s", message.decode())
+        except codec.DecodeError:
+            self.decode_errors.inc()
+            log.error("Corrupt or incorrect format\nReceived msg: %s", message)
 
-class RadioCompass:
+class RadioCompass(UDPReceiver):
     """ Convenient class for getting radio compass data from UDP packet """
-    def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_KERB):
-        self.bearing = None
+    name = "Radio Compass"
+    on_fix = None           # called with (bearing relative to the bow, weight) for every confident sample the filter accepted
+
+    def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_KERB, bearing_filter=None):
+        self.bearing = None          # filtered bearing
+        self.bearing_std = None      # its circular standard deviation in degrees
         self.raw_bearing = None
         self.power = 0
         self.confidence = 0
-        self.confident = False
-        self.min_power = 5           # minimum strength to be considered valid
-        self.min_confidence = 5      # minimum confidence to be considered valid
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                                    socket.SOCK_DGRAM) # UDP
-        self.sock.bind((UDP_IP, UDP_PORT))
-        self.sock.settimeout(10)
+        self.min_power = 5           # minimum strength for a sample to count
+        self.min_confidence = 5      # minimum confidence for a sample to count
+        self.filter = bearing_filter or BearingFilter()
+        self.heading = None          # latest autopilot heading, set by HeadingFusion. When known the filter works in the world frame
+        super().__init__(UDP_IP, UDP_PORT, timeout=10)
     
     def reset(self):
         self.bearing = None
+        self.bearing_std = None
         self.power = 0
         self.confidence = 0
-        self.confident = False
-
-    def update(self):
+        self.filter.reset()
+
+    @property
+    def confident(self):
+        """ Filtered bearing trusted now, its weight decays between packets so every read evaluates it again """
+        return self.filter.confident()
+
+    def predict(self, heading):
+        """ New autopilot heading, refresh the relative bearing from the filtered world frame bearing """
+        if self.heading is None:
+            self.filter.reset()      # the filter held relative bearings until now
+        self.heading = heading
+        if self.filter.bearing is not None:
+            self.bearing = wrap180(self.filter.bearing - heading)
+
+    def handle(self, message):
         try:
-            message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
             log.info(message)
-            packet = json.loads(message.decode())
+            packet = codec.decode(message)
             self.power = packet.get("power") or 0
             self.confidence = packet.get("confidence") or 0
             log.debug("Min Power {}, Min Confidence {}".format(self.min_power, self.min_confidence))
-            self.confident = self.power >= self.min_power and self.confidence >= self.min_confidence
-            self.bearing = packet.get("bearing") - 45 or None
-            if self.bearing and self.bearing > 180:
-                self.bearing = -(360 - self.bearing)
+            if packet.get("bearing") is None:
+                return
+            self.raw_bearing = wrap180(packet.get("bearing") - 45)
+
+            # weighted circular average with multipath gating, trusted on its spread rather than on single sample thresholds
+            self.filter.min_power = self.min_power
+            self.filter.min_confidence = self.min_confidence
+            if self.heading is None:
+                accepted = self.filter.update(self.raw_bearing, self.power, self.confidence)
+                self.bearing = self.filter.bearing
+            else:
+                accepted = self.filter.update(wrap180(self.raw_bearing + self.heading), self.power, self.confidence)
+                self.bearing = None if self.filter.bearing is None else wrap180(self.filter.bearing - self.heading)
+            self.bearing_std = self.filter.std
+            if accepted and self.confident and self.on_fix:
+                self.on_fix(self.raw_bearing, self.filter.weight(self.power, self.confidence))
 
-            
-        except socket.timeout:
-            self.reset()
-            log.debug("Socket timed out waiting for Radio Compass msg")
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\nReceived msg: %s", message.decode())
+        except codec.DecodeError:
+            self.decode_errors.inc()
+            log.error("Corrupt or incorrect format\nReceived msg: %s", message)
 
 
 class Telemetry:
     """ Convenient class for sending telemetry data to ground station through UDP"""
-    def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_RELAY):
+    def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_RELAY, vid=None):
         self.sock = socket.socket(socket.AF_INET,   # Internet
                                 socket.SOCK_DGRAM)  # UDP
+        self.vid = vid      # None when the relay serves this vehicle only and stamps it
     
-    def update(self, pixhawk, compass, pid, effort):
+    def update(self, pixhawk, compass, pid, effort, localizer=None):
+        message = codec.encode(self.packet(pixhawk, compass, pid, effort, localizer))
+        # log.debug(message)            
+        self.sock.sendto(message, (LOCALHOST, PORT_RELAY))
+
+    def packet(self, pixhawk, compass, pid, effort, localizer=None):
         packet = {}
         packet["type"] = "telem"
         packet["heartbeat"] = pixhawk.heartbeat
         packet["bearing"] = compass.bearing
         packet["confident"] = compass.confident
+        packet["power"] = compass.power
+        packet["confidence"] = compass.confidence
+        if localizer:
+            packet["beacon"] = localizer.telemetry()       # [lat, lon, std m] of the estimated beacon position
         packet["arm"] = pixhawk.armed
         packet["pidparams"] = [pid.Kp, pid.Ki, pid.Kd]
         packet["effort(p,y)"] = [effort.pitch, effort.yaw]
-        message = json.dumps(packet)
-        # log.debug(message)            
-        self.sock.sendto(message.encode(), (LOCALHOST, PORT_RELAY))
-
-
-class CMDProcessor:
-    """ Convenient class for tuning PID through UDP """
-    def __init__(self, UDP_IP = LOCALHOST, UDP_PORT = PORT_CMD):
-        self.sock = socket.socket(socket.AF_INET, # Internet
-                                    socket.SOCK_DGRAM) # UDP
-        self.sock.bind((UDP_IP, UDP_PORT))
-        self.sock.settimeout(None)
+        if self.vid is not None:
+            packet["vid"] = self.vid
+        return packet
+
+    def send_stats(self, stats):
+        packet = {"type": "stats"}
+        packet.update(stats)
+        if self.vid is not None:
+            packet["vid"] = self.vid
+        self.sock.sendto(codec.encode(packet), (LOCALHOST, PORT_RELAY))
+
+
+class CMDProcessor(UDPReceiver):
+    """
+    Convenient class for tuning PID through UDP
+    Commands carrying an id (the GUI's "seq") are applied once and acked to the relay once applied, the relay no longer
+    acks them on forwarding. A retransmission of an applied command is acked again without applying it. A command older
+    than the latest one of the same name applied within REORDER_WINDOW, in the same GUI session ("sid"), is dropped
+    without an ack, so a late "arm" cannot re-arm after a "disarm". A disarm is never dropped.
+    """
+    name = "Command"
+    profiler = None         # started by the profile command
+
+    def __init__(self, pid, compass, UDP_IP = LOCALHOST, UDP_PORT = PORT_CMD, vid=None):
+        super().__init__(UDP_IP, UDP_PORT, timeout=None)
+        self.pid = pid
+        self.compass = compass
+        self.vid = vid
+        self.applied = OrderedDict()        # (cmd, sid, seq) of the latest commands applied
+        self.latest = {}                    # (cmd, sid) -> (seq, time) of the newest one applied
+        self.duplicates = 0
+        self.superseded = 0
 
         self.arming = False
         self.disarming = False
         
-    def update(self, pid):
+    def handle(self, message):
         try:
-            message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
             log.info(message)
-            packet = json.loads(message.decode())
+            packet = codec.decode(message)
 
             if packet.get("type") == "cmd":
-                if packet.get("cmd") == "tune":
-                    pid.Kp = packet.get('Kp')
-                    pid.Ki = packet.get('Ki')
-                    pid.Kd = packet.get('Kd')
-
-                elif packet.get("cmd") == "arm":
-                    if packet.get("arm"):
-                        self.arming = True
-                    else:
-                        self.disarming = True
+                cmd, seq, sid = packet.get("cmd"), packet.get("seq"), packet.get("sid")
+                if seq is not None and (cmd, sid, seq) in self.applied:
+                    self.duplicates += 1
+                    log.debug("Duplicate %s #%d acked again", cmd, seq)
+                elif seq is not None and self.is_superseded(packet):
+                    self.superseded += 1
+                    log.info("%s #%d is older than #%d, dropped without an ack", cmd, seq, self.latest[(cmd, sid)][0])
+                    return
+                else:
+                    self.apply(packet)
+                    if seq is not None:
+                        self.latest[(cmd, sid)] = (seq, time.monotonic())
+                        self.applied[(cmd, sid, seq)] = True
+                        if len(self.applied) > APPLIED_CACHE:
+                            self.applied.popitem(last=False)
+                self.send_ack(cmd, seq, sid)
+
+        except codec.DecodeError:
+            self.decode_errors.inc()
+            log.error("Corrupt or incorrect format\nReceived msg: %s", message)
+
+    def is_superseded(self, packet):
+        """ True for a command sent before the latest one of its name applied from the same session, never a disarm """
+        if packet.get("sid") is None or (packet.get("cmd") == "arm" and not packet.get("arm")):
+            return False        # ids of GUIs without sessions are random at each start and cannot be ordered
+        latest = self.latest.get((packet.get("cmd"), packet.get("sid")))
+        if latest is None or time.monotonic() - latest[1] > REORDER_WINDOW:
+            return False
+        return (packet["seq"] - latest[0]) % SEQ_MODULO >= SEQ_MODULO//2
+
+    def send_ack(self, cmd, seq, sid=None):
+        packet = {"type": "ack", "cmd": cmd}
+        if seq is not None:
+            packet["seq"] = seq
+            if sid is not None:
+                packet["sid"] = sid
+        if self.vid is not None:
+            packet["vid"] = self.vid
+        try:
+            self.sock.sendto(codec.encode(packet), (LOCALHOST, PORT_RELAY))
+        except OSError as msg:
+            log.error("Ack of %s: %s", cmd, msg)
+
+    def apply(self, packet):
+        if packet.get("cmd") == "tune":
+            self.pid.Kp = packet.get('Kp')
+            self.pid.Ki = packet.get('Ki')
+            self.pid.Kd = packet.get('Kd')
+
+        elif packet.get("cmd") == "arm":
+            if packet.get("arm"):
+                self.arming = True
+                self.disarming = False
+            else:
+                self.disarming = True
+                self.arming = False
 
-                elif packet.get("cmd") == "threshold":
-                    compass.min_confidence = packet.get('conf')
-                    compass.min_power = packet.get('power')
+        elif packet.get("cmd") == "threshold":
+            self.compass.min_confidence = packet.get('conf')
+            self.compass.min_power = packet.get('power')
 
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\nReceived msg: %s", message.decode())
+        elif packet.get("cmd") == "profile" and self.profiler:
+            self.profiler.start(packet.get("seconds"), packet.get("rate"))
 
 class Effort:
     """ Struct for storing current pitch and yaw effort """
@@ -218,46 +420,21 @@ class Effort:
         self.deadzone_low = -100
         self.deadzone_high = 100
 
-"""" Initialize helper objects """
-pixhawk = Pixhawk(DEVICE, BAUD)
-joy = Joystick()
-compass = RadioCompass()
-vision = Vision()
-telem = Telemetry()
-cmdproc = CMDProcessor()
-effort = Effort()
-yaw_pid = PID(Kp=0.5, Ki=0.05, Kd=0.5, setpoint=0, sample_time=0.5, output_limits=(-0.2,0.2))
-
-""" Worker tasks """
-def joystick_thread():
-    while True:
-        joy.update()
-
-def compass_thread():
-    while True:
-        compass.update()
-
-def vision_thread():
-    while True:
-        vision.update()
+class NoLED:
+    """ Stands in for the status LED when there is no GPIO, e.g. running against sim.py on a PC """
+    def pulse(self, **kwargs):
+        pass
 
-def relay_thread():
-    while True:
-        telem.update(pixhawk, compass, yaw_pid, effort)
-        time.sleep(1)
-
-def get_feedback_thread():
-    while True:
-        pixhawk.get_feedback()
-        time.sleep(1)
-
-def cmdproc_thread():
-    while True:
-        cmdproc.update(yaw_pid)
+    def blink(self, **kwargs):
+        pass
 
 class StatusLED():
     def __init__(self):
-        self.led = PWMLED(18)
+        try:
+            self.led = PWMLED(18)
+        except Exception as msg:
+            log.warning("Status LED unavailable: %s", msg)
+            self.led = NoLED()
         self._mode = -1
 
     def pulse_slow(self):
@@ -285,106 +462,219 @@ class StatusLED():
             self._mode = 4
             self.led.blink(on_time=1, off_time=0.01)
 
+""" Worker tasks """
+async def telemetry_loop(telem, controller, scheduler, period=TELEM_PERIOD):
+    """ Snapshot of the controller's state to the relay every period, control loop statistics every STATS_PERIOD """
+    stats_timer = Timer(STATS_PERIOD)
+    c = controller
+    while True:
+        telem.update(c.pixhawk, c.compass, c.yaw_pid, c.effort, c.localizer)
+        if stats_timer():
+            scheduler.log_stats()
+            log.info("MANUAL_CONTROL stream: %s", c.streamer.stats())
+            stats = scheduler.stats()
+            stats["manual_control"] = c.streamer.stats()
+            telem.send_stats(stats)
+        await asyncio.sleep(period)
+
 """ Main loop """
-def main():
-    led = StatusLED()
-    setpoint_timer = Timer(SETPOINT_REACHED_WAIT_PERIOD)
-
-    while(1):
-        time.sleep(0.1)
-
-        if not pixhawk.armed and cmdproc.arming:
-            pixhawk.arm()
-            cmdproc.arming = False
-
-        elif pixhawk.armed and cmdproc.disarming:
-            effort.yaw = 0
-            effort.pitch = 0
-            yaw_pid.reset()
-            pixhawk.send_cmd(effort.pitch, effort.yaw)
-            pixhawk.disarm()
-            cmdproc.disarming = False
-
-        if pixhawk.armed:
-            js_active = joy.axes[2] > 0         # hold down LT button to use joystick
+class Controller:
+    """ Convenient class holding the homing control step and the state it keeps between steps """
+    def __init__(self, pixhawk, streamer, joy, compass, vision, cmdproc, effort, yaw_pid, led, clock=time.time, localizer=None):
+        self.pixhawk = pixhawk
+        self.streamer = streamer
+        self.joy = joy
+        self.compass = compass
+        self.vision = vision
+        self.cmdproc = cmdproc
+        self.effort = effort
+        self.yaw_pid = yaw_pid
+        self.led = led
+        self.localizer = localizer
+        self.setpoint_timer = Timer(SETPOINT_REACHED_WAIT_PERIOD, clock)
+        self.status_timer = Timer(STATUS_PERIOD, clock)
+        self.mode = None            # last control mode logged, as (message, args)
+
+    def homing_bearing(self):
+        """ Radio compass bearing when it is trusted, else the bearing to the localized beacon if that is trusted """
+        if self.compass.bearing and self.compass.confident:
+            return self.compass.bearing, "radio"
+        if self.localizer and self.localizer.confident:
+            bearing = self.localizer.bearing(self.compass.heading)
+            if bearing is not None:
+                return bearing, "beacon estimate"
+        return None, None
+
+    async def pixhawk_command(self, request):
+        """ Wait for the COMMAND_ACK of an arm/disarm request without blocking the loop """
+        future = request()
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.pixhawk.forget(future)
+            log.warning("No COMMAND_ACK from the Pixhawk after %s s", COMMAND_TIMEOUT)
+        log.info("Pixhawk armed: %s", self.pixhawk.armed)
+
+    async def step(self):
+        if not self.pixhawk.armed and self.cmdproc.arming:
+            await self.pixhawk_command(self.pixhawk.request_arm)
+            self.cmdproc.arming = False
+
+        elif self.pixhawk.armed and self.cmdproc.disarming:
+            self.effort.yaw = 0
+            self.effort.pitch = 0
+            self.yaw_pid.reset()
+            self.streamer.set(self.effort.pitch, self.effort.yaw)
+            await self.pixhawk_command(self.pixhawk.request_disarm)
+            self.cmdproc.disarming = False
+
+        if self.pixhawk.armed:
+            js_active = self.joy.axes[2] > 0         # hold down LT button to use joystick
+            bearing, source = self.homing_bearing()
             if js_active:
-                effort.yaw = int(joy.axes[0]*1000)    # left stick left-right for turn left-right
-                effort.pitch = int(joy.axes[1]*1000)  # left stick up-down for forward-backward
+                self.effort.yaw = int(self.joy.axes[0]*1000)    # left stick left-right for turn left-right
+                self.effort.pitch = int(self.joy.axes[1]*1000)  # left stick up-down for forward-backward
 
-                led.blink_fast()
-                log.info("Using joystick control")
-            
-            elif compass.bearing and compass.confident:
-                effort.yaw = int(yaw_pid(compass.bearing/180) * 1000)      # Calculate PID based on scaled feedback
-                # if effort.yaw < -50 and effort.yaw > effort.deadzone_low:
-                #     effort.yaw = effort.deadzone_low
-                # elif effort.yaw > 50 and effort.yaw < effort.deadzone_high:
-                #     effort.yaw = effort.deadzone_high
+                self.led.blink_fast()
+                self.log_mode("Using joystick control")
+        
+            elif bearing:
+                self.effort.yaw = int(self.yaw_pid(bearing/180) * 1000)      # Calculate PID based on scaled feedback
+                # if self.effort.yaw < -50 and self.effort.yaw > self.effort.deadzone_low:
+                #     self.effort.yaw = self.effort.deadzone_low
+                # elif self.effort.yaw > 50 and self.effort.yaw < self.effort.deadzone_high:
+                #     self.effort.yaw = self.effort.deadzone_high
 
-                if compass.bearing > -SETPOINT_TOLERANCE and compass.bearing < SETPOINT_TOLERANCE:
-                    # effort.yaw = int(yaw_pid(compass.bearing/180) * 1000)      # Calculate PID based on scaled feedback
+                if bearing > -SETPOINT_TOLERANCE and bearing < SETPOINT_TOLERANCE:
+                    # self.effort.yaw = int(self.yaw_pid(self.compass.bearing/180) * 1000)      # Calculate PID based on scaled feedback
 
-                    if setpoint_timer():              
-                        effort.pitch = -FORWARD_SPEED
-                        led.blink_fast()
+                    if self.setpoint_timer():              
+                        self.effort.pitch = -FORWARD_SPEED
+                        self.led.blink_fast()
 
-                    if vision.distance and vision.distance < 100:
+                    if self.vision.distance and self.vision.distance < 100:
                         Kp_pitch = 2
-                        effort.pitch = -vision.distance*Kp_pitch
-                    
-                else:
-                    if compass.bearing < 0:
-                        effort.yaw = -YAW_SPEED
-                    elif compass.bearing > 0:
-                        effort.yaw = YAW_SPEED
-
-                    led.flash()
-                    setpoint_timer.reset()
-                    yaw_pid.reset()
-                    effort.pitch = 0
+                        self.effort.pitch = -self.vision.distance*Kp_pitch
                 
-                log.info("Using radio homing control")
-                log.info("PID params: {} {} {}".format(yaw_pid.Kp, yaw_pid.Ki, yaw_pid.Kd))
+                else:
+                    if bearing < 0:
+                        self.effort.yaw = -YAW_SPEED
+                    elif bearing > 0:
+                        self.effort.yaw = YAW_SPEED
+
+                    self.led.flash()
+                    self.setpoint_timer.reset()
+                    self.yaw_pid.reset()
+                    self.effort.pitch = 0
+            
+                if self.log_mode("Using %s homing control", source):
+                    log.info("PID params: %s %s %s", self.yaw_pid.Kp, self.yaw_pid.Ki, self.yaw_pid.Kd)
 
             else:
-                effort.yaw = 0
-                effort.pitch = 0
-                yaw_pid.reset()
+                self.effort.yaw = 0
+                self.effort.pitch = 0
+                self.yaw_pid.reset()
 
-                led.blink_slow()
-                log.info("Waiting for compass bearing")
+                self.led.blink_slow()
+                self.log_mode("Waiting for compass bearing")
 
-            pixhawk.send_cmd(effort.pitch, effort.yaw)      # negative pitch is going forward, negative yaw is left turn    
-            log.info("Effort pitch: {}, Effort yaw: {}".format(effort.pitch, effort.yaw))
-        
+            self.streamer.set(self.effort.pitch, self.effort.yaw)      # negative pitch is going forward, negative yaw is left turn    
+    
         else:
-            led.pulse_slow()
-            log.info("Idling")
-        
-        log.info("Pitch effort:{}\tYaw effort: {}\tArmed: {}\tLink Hearbeat: {}".format(effort.pitch, effort.yaw, pixhawk.armed, pixhawk.heartbeat))
-        log.info("Current radio bearing: {}\tPower: {}\tConfidence: {}\tCurrent vision bearing: {}\tCurrent vision distance: {}".format(compass.bearing, compass.power, compass.confidence, vision.bearing, vision.distance))
-
-
-
-
-
-
+            self.led.pulse_slow()
+            self.log_mode("Idling")
+    
+        if self.status_timer():
+            log.info("Pitch effort:%s\tYaw effort: %s\tArmed: %s\tLink Hearbeat: %s", self.effort.pitch, self.effort.yaw, self.pixhawk.armed, self.pixhawk.heartbeat)
+            log.info("Current radio bearing: %s\tPower: %s\tConfidence: %s\tCurrent vision bearing: %s\tCurrent vision distance: %s", self.compass.bearing, self.compass.power, self.compass.confidence, self.vision.bearing, self.vision.distance)
 
+    def log_mode(self, message, *args):
+        """ Log the control mode when it changes rather than on every step. Returns True if it was logged """
+        if (message, args) == self.mode:
+            return False
+        self.mode = (message, args)
+        log.info(message, *args)
+        return True
+
+
+def export_metrics(scheduler, controller):
+    """ Histograms and counters the control loop already keeps, read at scrape time """
+    streamer, pixhawk, compass = controller.streamer, controller.pixhawk, controller.compass
+    metrics.adopt(scheduler.latency, "autohoming_step_latency_seconds", "New sample (or deadline) to the end of its control step")
+    metrics.adopt(scheduler.jitter, "autohoming_step_jitter_seconds", "Control step start after its planned start")
+    metrics.adopt(scheduler.duration, "autohoming_step_seconds", "Time spent in the control step")
+    metrics.counter("autohoming_step_overruns_total", "Control steps ending more than the max period after their planned start",
+                    function=lambda: scheduler.overruns)
+    metrics.counter("autohoming_steps_total", "Control steps run", function=lambda: scheduler.event_steps + scheduler.deadline_steps)
+    metrics.adopt(streamer.timing_error, "manual_control_timing_error_seconds", "MANUAL_CONTROL send time after its tick")
+    metrics.counter("manual_control_coalesced_total", "Setpoints replaced before they were sent", function=lambda: streamer.coalesced)
+    metrics.gauge("autohoming_armed", "Pixhawk armed", function=lambda: pixhawk.armed)
+    metrics.gauge("autohoming_compass_power", "Latest radio compass power", function=lambda: compass.power)
+    metrics.gauge("autohoming_compass_confidence", "Latest radio compass confidence", function=lambda: compass.confidence)
+    metrics.gauge("autohoming_compass_confident", "Filtered radio bearing trusted", function=lambda: compass.confident)
+
+async def main(pixhawk, joy, compass, vision, cmdproc, telem, effort, yaw_pid, localizer):
+    """ Every socket is served by one event loop, each UDP receiver and the Pixhawk link as a reader """
+    loop = asyncio.get_running_loop()
+    receivers = [joy, compass, vision, cmdproc]
+    for receiver in receivers:
+        await receiver.attach(loop)
+    loop.add_reader(pixhawk.master.fd, pixhawk.poll)
+
+    streamer = ManualControlStreamer(pixhawk)             # sole sender of MANUAL_CONTROL, at a fixed rate, on this loop
+    controller = Controller(pixhawk, streamer, joy, compass, vision, cmdproc, effort, yaw_pid, StatusLED(), localizer=localizer)
+    scheduler = ControlScheduler(controller.step, CONTROL_MIN_PERIOD, CONTROL_MAX_PERIOD)
+    export_metrics(scheduler, controller)
+    for receiver in receivers:
+        receiver.on_packet = scheduler.notify     # run a step as soon as a new sample arrives
+
+    fusion = HeadingFusion([compass, vision])     # fresh relative bearings at the attitude rate between DOA fixes
+    fusion.on_update = scheduler.notify
+    fusion.attach(pixhawk)
+
+    localizer.attach(pixhawk)                     # every confident bearing becomes a line through the GPS position
+    compass.on_fix = lambda bearing, weight: localizer.add(bearing, weight, fusion.heading)
+
+    tasks = [asyncio.create_task(receiver.watchdog()) for receiver in receivers]
+    tasks.append(asyncio.create_task(streamer.stream()))
+    tasks.append(asyncio.create_task(telemetry_loop(telem, controller, scheduler)))
+    await scheduler.run()
 
 
 if __name__ == "__main__":
-    joystick_task = threading.Thread(target=joystick_thread)
-    compass_task = threading.Thread(target=compass_thread)
-    vision_task = threading.Thread(target=vision_thread)
-    relay_task = threading.Thread(target=relay_thread)
-    get_feedback_task = threading.Thread(target=get_feedback_thread)
-    cmdproc_task = threading.Thread(target=cmdproc_thread)
-    joystick_task.start()
-    compass_task.start()
-    vision_task.start()
-    relay_task.start()
-    get_feedback_task.start()
-    cmdproc_task.start()
-
-    main()
-
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=DEVICE, help="Pixhawk link, e.g. udpin:127.0.0.1:14551 for sim.py")
+    parser.add_argument("--record", default=FLIGHT_RECORD, help="flight record file, empty to disable")
+    parser.add_argument("--vid", type=int, help="vehicle id, when the relay serves more than one vehicle (relayserver.py --vehicle)")
+    parser.add_argument("--port-cmd", type=int, default=PORT_CMD, help="command port given to the relay for this vehicle")
+    parser.add_argument("--port-js", type=int, default=PORT_JS, help="joystick port given to the relay for this vehicle")
+    parser.add_argument("--metrics-port", type=int, default=metrics.PORT_AUTOHOMING, help="local HTTP metrics endpoint, 0 to disable")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="where profiles started by SIGUSR1 or the profile command go")
+    args = parser.parse_args()
+    metrics.serve(args.metrics_port)
+    CMDProcessor.profiler = Profiler("autohoming", args.profile_dir).install_signal()
+
+    """ Initialize helper objects """
+    pixhawk = Pixhawk(args.device, BAUD)
+    joy = Joystick(UDP_PORT=args.port_js)
+    compass = RadioCompass()
+    vision = Vision()
+    telem = Telemetry(vid=args.vid)
+    effort = Effort()
+    yaw_pid = PID(Kp=0.5, Ki=0.05, Kd=0.5, setpoint=0, sample_time=0.5, output_limits=(-0.2,0.2))
+    cmdproc = CMDProcessor(yaw_pid, compass, UDP_PORT=args.port_cmd, vid=args.vid)
+    localizer = BeaconLocalizer()
+
+    """ Record every input, MANUAL_CONTROL effort and heartbeat for offline replay """
+    recorder = None
+    if args.record:
+        recorder = FlightRecorder(args.record)
+        UDPReceiver.recorder = recorder
+        pixhawk.recorder = recorder
+        pixhawk.subscribe('HEARTBEAT', recorder.heartbeat)
+
+    try:
+        asyncio.run(main(pixhawk, joy, compass, vision, cmdproc, telem, effort, yaw_pid, localizer))
+    finally:
+        if recorder:
+            recorder.close()
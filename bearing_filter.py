@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Streaming bearing estimator on the unit circle
+Each bearing is a unit vector weighted by its power and confidence. The vectors are averaged with an exponential
+time decay, so the mean direction never suffers from the +-180 wrap. A sample weighs in proportion to the time since
+the previous one, up to SAMPLE_PERIOD, so a reading polled several times before Hydra replaces it counts once in all
+and the weight reached does not depend on the poll rate. The length of the mean vector gives
+a circular standard deviation. Samples too far from the current mean are gated out as multipath. After a run of
+rejections that agree with each other the filter restarts from their direction, because the beacon or the boat really moved.
+"""
+import math
+import time
+
+TAU = 3.0               # s, time constant of the exponential average, a few DOA estimates
+SAMPLE_PERIOD = 1.0     # s, how often Hydra produces a new DOA estimate, a sample sooner than this weighs less
+GATE_SIGMA = 3          # reject samples further than this many standard deviations from the mean
+GATE_MIN = 25           # deg, never gate tighter than this
+MAX_REJECTS = 3         # consecutive rejections agreeing with each other before restarting on their direction
+POWER_REF = 20          # dB, power giving full weight
+CONFIDENCE_REF = 10     # dB, confidence giving full weight
+MAX_STD = 15            # deg, standard deviation up to which the bearing is trusted
+STALE_TIME = 3          # s without an accepted sample before the bearing is no longer trusted
+MIN_WEIGHT = 0.6        # decayed weight needed to trust the bearing, held by quarter weight estimates once a second
+MIN_ESTIMATES = 2       # sample periods' worth of accepted samples since the last restart before the bearing is trusted
+
+def wrap180(angle):
+    return (angle + 180) % 360 - 180
+
+class BearingFilter:
+    """ Convenient class for an exponentially weighted circular mean with outlier gating """
+    def __init__(self, tau=TAU, gate_sigma=GATE_SIGMA, gate_min=GATE_MIN, max_rejects=MAX_REJECTS, sample_period=SAMPLE_PERIOD,
+                 clock=time.monotonic):
+        self.tau = tau
+        self.sample_period = sample_period
+        self.gate_sigma = gate_sigma
+        self.gate_min = gate_min
+        self.max_rejects = max_rejects
+        self.clock = clock
+        self.min_power = 0
+        self.min_confidence = 0
+        self.reset()
+
+    def reset(self):
+        self.c = 0              # weighted sum of cosines
+        self.s = 0              # weighted sum of sines
+        self.w = 0              # sum of weights
+        self.decayed = None     # time the sums were last decayed to
+        self.last = None        # time of the last accepted sample
+        self.previous = None    # time of the last weighted sample, accepted or not
+        self.last_weight = 0    # weight the last accepted sample was added with
+        self.estimates = 0      # sample periods' worth of accepted samples since the last restart
+        self.rejects = []       # consecutive rejected (bearing, share of a sample period)
+        self.accepted = 0
+        self.rejected = 0
+        self.bearing = None
+        self.std = None
+
+    def weight(self, power, confidence):
+        """ 0 below the thresholds, rising to 1 at POWER_REF and CONFIDENCE_REF """
+        if power < self.min_power or confidence < self.min_confidence:
+            return 0
+        return min(1, max(0, power/POWER_REF))*min(1, max(0, confidence/CONFIDENCE_REF))
+
+    def update(self, bearing, power, confidence, t=None):
+        """ Add one sample in degrees. Returns True if it was used, False if it was weightless or gated out """
+        t = self.clock() if t is None else t
+        w = self.weight(power, confidence)
+        if w <= 0:
+            return False
+        share = 1 if self.previous is None else min(1, max(0, t - self.previous)/self.sample_period)
+        self.previous = t
+        if share <= 0:
+            return False        # the same estimate again at the same instant
+        w *= share              # repeats of one estimate share its weight
+
+        if self.decayed is not None:
+            decay = math.exp(-(t - self.decayed)/self.tau)
+            self.c *= decay
+            self.s *= decay
+            self.w *= decay
+        self.decayed = t
+
+        if self.bearing is not None and self.w > 0:
+            gate = max(self.gate_min, self.gate_sigma*self.std)
+            if abs(wrap180(bearing - self.bearing)) > gate:
+                self.rejected += 1
+                self.rejects.append((bearing, share))     # one repeated estimate counts as one rejection in all
+                agree = all(abs(wrap180(b - bearing)) <= self.gate_min for b, _ in self.rejects)
+                if not agree or sum(s for _, s in self.rejects) < self.max_rejects - 1e-6:
+                    while sum(s for _, s in self.rejects) > self.max_rejects - 1 + 1e-6:
+                        del self.rejects[0]
+                    return False
+                self.c = self.s = self.w = self.estimates = 0     # rejected samples agree with each other, start again from them
+
+        self.rejects = []
+        self.accepted += 1
+        radians = math.radians(bearing)
+        self.c += w*math.cos(radians)
+        self.s += w*math.sin(radians)
+        self.w += w
+        self.estimates += share
+        self.last = t
+        self.last_weight = w
+
+        length = min(1, math.hypot(self.c, self.s)/self.w)
+        self.bearing = wrap180(math.degrees(math.atan2(self.s, self.c)))
+        self.std = math.degrees(math.sqrt(-2*math.log(length))) if length > 0 else 180
+        return True
+
+    @property
+    def variance(self):
+        """ Circular variance in degrees squared, None before the first sample """
+        return None if self.std is None else self.std**2
+
+    def confident(self, t=None):
+        t = self.clock() if t is None else t
+        if self.bearing is None or t - self.last > STALE_TIME or self.estimates < MIN_ESTIMATES - 1e-6:
+            return False
+        return self.std <= MAX_STD and self.w*math.exp(-(t - self.decayed)/self.tau) >= MIN_WEIGHT
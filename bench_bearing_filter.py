@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Per-sample cost of the circular bearing filter, and its error against the true bearing on synthetic streams
+Streams come from the sim.py beacon model (noise, multipath outliers, optionally a boat turning at a constant rate),
+with a new estimate at the DOA rate read again by every poll in between, like radio_compass.py polling Hydra
+The share of control steps with a trusted bearing is compared between that stream and independent estimates at the poll
+rate, for full and weak readings, since trust must not depend on how often the same estimate is read
+A flight record can be given to run the filter over recorded radio compass packets instead
+"""
+import time
+import math
+import random
+import argparse
+import codec
+import sim
+import flightrec
+from bearing_filter import BearingFilter, wrap180
+
+def synthetic(samples, turn_rate=0, outliers=sim.OUTLIER_RATE, confident_outliers=0, noise=sim.BEARING_NOISE, seed=0,
+              doa_rate=sim.DOA_RATE, power=None):
+    """
+    (t, true bearing, bearing, power, confidence) at the compass rate, vessel 100 m from the beacon turning at turn_rate deg/s
+    A new estimate comes at doa_rate, polls in between repeat it. power scales the reading to that dB, confidence with it
+    confident_outliers is the fraction of multipath bearings that come with a normal confidence, so only gating can catch them
+    """
+    rng = random.Random(seed)
+    vessel = sim.Vessel(heading=rng.uniform(-180, 180))
+    beacon = sim.Beacon(0, 100, noise=noise, outliers=outliers, rng=rng)
+    stream = []
+    reading, next_estimate = None, 0
+    for i in range(samples):
+        t = i/sim.COMPASS_RATE
+        vessel.heading = (vessel.heading + turn_rate/sim.COMPASS_RATE) % 360
+        if t >= next_estimate - 1e-9:
+            bearing, p, confidence = beacon.reading(vessel)
+            if rng.random() < confident_outliers:
+                bearing = rng.uniform(-180, 180)
+            if power is not None:
+                p, confidence = power, confidence*power/p
+            reading, next_estimate = (int(round(bearing)), p, confidence), t + 1/doa_rate
+        stream.append((t, beacon.relative_bearing(vessel)) + reading)
+    return stream
+
+def trusted(stream, control_rate=10):
+    """ Share of control steps at which the filter fed with stream is confident, after the first 10 s """
+    bearing_filter = BearingFilter()
+    samples = iter(stream)
+    sample = next(samples, None)
+    steps = trusted_steps = 0
+    t = 0
+    while sample is not None:
+        while sample is not None and sample[0] <= t:
+            bearing_filter.update(sample[2], sample[3], sample[4], sample[0])
+            sample = next(samples, None)
+        if t >= 10:
+            steps += 1
+            trusted_steps += bearing_filter.confident(t)
+        t += 1/control_rate
+    return trusted_steps/steps
+
+def errors(stream):
+    """ RMS and max absolute error of the raw bearings and of the filter output, and the filter's mean reported std """
+    bearing_filter = BearingFilter()
+    bearing_filter.min_power = bearing_filter.min_confidence = 5
+    raw, filtered, stds = [], [], []
+    for t, true, bearing, power, confidence in stream:
+        bearing_filter.update(bearing, power, confidence, t)
+        raw.append(abs(wrap180(bearing - true)))
+        if bearing_filter.bearing is not None:
+            filtered.append(abs(wrap180(bearing_filter.bearing - true)))
+            stds.append(bearing_filter.std)
+    rms = lambda values: math.sqrt(sum(v*v for v in values)/len(values))
+    return rms(raw), max(raw), rms(filtered), max(filtered), sum(stds)/len(stds), bearing_filter.rejected
+
+def recorded(path):
+    """ Filter output over the radio compass packets of a flight record, there is no truth so only the spread is reported """
+    bearing_filter = BearingFilter()
+    jumps_raw, jumps_filtered = [], []
+    last_raw = last_filtered = None
+    for t, kind, port, payload in flightrec.read_records(path):
+        if kind != flightrec.PACKET or port != sim.PORT_KERB:
+            continue
+        packet = codec.decode(payload)
+        bearing = wrap180(packet["bearing"] - sim.BEARING_OFFSET)
+        bearing_filter.update(bearing, packet.get("power") or 0, packet.get("confidence") or 0, t)
+        if last_raw is not None:
+            jumps_raw.append(abs(wrap180(bearing - last_raw)))
+        if last_filtered is not None and bearing_filter.bearing is not None:
+            jumps_filtered.append(abs(wrap180(bearing_filter.bearing - last_filtered)))
+        last_raw, last_filtered = bearing, bearing_filter.bearing
+    return jumps_raw, jumps_filtered, bearing_filter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=200000, help="samples timed")
+    parser.add_argument("--samples", type=int, default=3000, help="samples per synthetic stream (10 min at 5 Hz polls)")
+    parser.add_argument("--record", default=None, help="flight record to run the filter over")
+    args = parser.parse_args()
+
+    stream = synthetic(args.number)
+    bearing_filter = BearingFilter()
+    started = time.perf_counter()
+    for t, true, bearing, power, confidence in stream:
+        bearing_filter.update(bearing, power, confidence, t)
+    print("update: {:.2f} us per sample".format((time.perf_counter() - started)/args.number*1e6))
+
+    print("{:<28}{:>10}{:>10}{:>10}{:>10}{:>10}{:>9}".format("stream", "raw rms", "raw max", "filt rms", "filt max", "mean std", "gated"))
+    for name, turn_rate, outliers, confident_outliers in (("steady", 0, sim.OUTLIER_RATE, 0),
+                                                          ("steady, 20% multipath", 0, 0.2, 0),
+                                                          ("steady, 10% confident mp", 0, 0, 0.1),
+                                                          ("turning 10 deg/s", 10, sim.OUTLIER_RATE, 0),
+                                                          ("turning 60 deg/s", 60, sim.OUTLIER_RATE, 0)):
+        print("{:<28}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>9}".format(
+              name, *errors(synthetic(args.samples, turn_rate, outliers, confident_outliers))))
+
+    if args.record:
+        jumps_raw, jumps_filtered, bearing_filter = recorded(args.record)
+        print("record: {} samples, mean step raw {:.1f} deg, filtered {:.1f} deg, {} gated".format(
+              len(jumps_raw) + 1, sum(jumps_raw)/max(1, len(jumps_raw)), sum(jumps_filtered)/max(1, len(jumps_filtered)), bearing_filter.rejected))
+
+    print()
+    print("{:<28}{:>16}{:>16}".format("trusted control steps", "{} Hz DOA".format(sim.DOA_RATE), "{} Hz DOA".format(sim.COMPASS_RATE)))
+    for power in (30, 15, 10, 8, 6):
+        repeated = trusted(synthetic(args.samples, outliers=0, power=power))
+        independent = trusted(synthetic(args.samples, outliers=0, power=power, doa_rate=sim.COMPASS_RATE))
+        print("{:<28}{:>15.0f}%{:>15.0f}%".format("power {} dB".format(power), repeated*100, independent*100))
+        assert abs(repeated - independent) < 0.1, "trust depends on how often the same estimate is read"
+    assert trusted(synthetic(args.samples, outliers=0, power=30)) > 0.99, "full readings at the DOA rate not trusted"
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compare size and encode/decode throughput of the binary codec frames with the current json.dumps payloads
+Also reports how many frames per second fit through a link of a given byte rate
+The "autohoming" rows are what Telemetry.update sends, built by the real code from stand-ins of its inputs
+"""
+import json
+import timeit
+import argparse
+from types import SimpleNamespace
+import codec
+from autohoming import Telemetry
+
+PACKETS = {
+    "telem": {"type": "telem", "heartbeat": 1234, "bearing": -37, "confident": True, "arm": True,
+              "pidparams": [0.5, 0.05, 0.5], "effort(p,y)": [-200, 137]},
+    "js": {"type": "js", "ax": [0.123, -0.456, 1.0], "bt": [1, 0]},
+    "cmd tune": {"type": "cmd", "cmd": "tune", "Kp": 0.5, "Ki": 0.05, "Kd": 0.5},
+    "cmd arm": {"type": "cmd", "cmd": "arm", "arm": True},
+    "ack": {"type": "ack", "cmd": "arm"},
+}
+
+def autohoming_telem(beacon):
+    pixhawk = SimpleNamespace(heartbeat=1234, armed=True)
+    compass = SimpleNamespace(bearing=-37, confident=True, power=41, confidence=12.5)
+    pid = SimpleNamespace(Kp=0.5, Ki=0.05, Kd=0.5)
+    effort = SimpleNamespace(pitch=-200, yaw=137)
+    localizer = SimpleNamespace(telemetry=lambda: beacon)
+    telem = Telemetry()
+    packet = telem.packet(pixhawk, compass, pid, effort, localizer)
+    telem.sock.close()
+    return packet
+
+PACKETS["autohoming"] = autohoming_telem(None)
+PACKETS["autohoming+fix"] = autohoming_telem([43.6532261, -79.3831843, 12.3])
+
+def json_encode(packet):
+    return (json.dumps(packet, separators=(',', ':')) + '\n').encode()
+
+def json_decode(message):
+    return json.loads(message.decode())
+
+def rate(fn, arg, number):
+    return number / timeit.timeit(lambda: fn(arg), number=number)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000, help="iterations per measurement")
+    parser.add_argument("--link", type=float, default=11520, help="link capacity in bytes per second (115200 baud UART by default)")
+    args = parser.parse_args()
+
+    print("{:<16}{:>7}{:>7}{:>12}{:>12}{:>12}{:>12}{:>10}{:>10}".format(
+        "packet", "json B", "bin B", "json enc/s", "bin enc/s", "json dec/s", "bin dec/s", "json f/s", "bin f/s"))
+    for name, packet in PACKETS.items():
+        text = json_encode(packet)
+        frame = codec.encode(packet)
+        assert codec.decode(frame) == codec.decode(text), name
+        assert codec.is_binary(frame), name
+        print("{:<16}{:>7}{:>7}{:>12.0f}{:>12.0f}{:>12.0f}{:>12.0f}{:>10.0f}{:>10.0f}".format(
+            name, len(text), len(frame),
+            rate(json_encode, packet, args.number), rate(codec.encode, packet, args.number),
+            rate(json_decode, text, args.number), rate(codec.decode, frame, args.number),
+            args.link/len(text), args.link/len(frame)))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Blocking send-and-wait commands against the asynchronous pipeline in commands.py, over a lossy UDP echo on localhost
+The echo plays the relay: it acks every command it receives after a delay, and both directions lose packets.
+Blocking: the old GUI, one command at a time, one send, the caller waits up to 1 s for an ack naming the same cmd.
+Pipeline: a burst of commands submitted at once, acks matched by sequence number, retransmission with backoff.
+Reported: time the caller (the GUI event loop) was blocked, commands acked, and time until the last one finished
+Then who acks, in simulated time over a slow lossy radio and a lossy localhost hop from the relay to autohoming:
+    hop ack       the relay acks on forwarding, what the local hop loses is acked but never applied
+    end to end    autohoming acks once applied, only the ground station retries, over the radio
+    + relay retry autohoming acks once applied and the relay retries the local hop itself, as relayserver.py does
+Last, autohoming's CMDProcessor fed arm/disarm sequences with random ids: an arm then a disarm from a restarted GUI, and
+an arm whose first copy was lost, retried after the disarm that followed it from the same GUI. Every disarm must apply,
+the late arm must not, and nothing may be acked without being applied.
+"""
+import heapq
+import time
+import socket
+import random
+import argparse
+import threading
+import codec
+import relayserver
+import autohoming
+from commands import CommandPipeline, SEQ_MODULO
+
+ACK_WAIT = 1        # s, the old GUI's read timeout
+
+class LossyEcho:
+    """ Acks commands sent to its port after delay, losing loss of the packets each way """
+    def __init__(self, delay, loss, seed=0):
+        self.delay = delay
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.addr = self.sock.getsockname()
+        self.sock.settimeout(0.1)
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                message, addr = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            if self.rng.random() < self.loss:
+                continue
+            packet = codec.decode(message)
+            ack = {"type": "ack", "cmd": packet["cmd"]}
+            if "seq" in packet:
+                ack["seq"] = packet["seq"]
+            if self.rng.random() >= self.loss:
+                threading.Timer(self.delay, self.sock.sendto, (codec.encode(ack), addr)).start()
+
+def blocking(echo, count):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(ACK_WAIT)
+    acked, blocked = 0, 0
+    started = time.monotonic()
+    for i in range(count):
+        t = time.monotonic()
+        sock.sendto(codec.encode({"type": "cmd", "cmd": "arm", "arm": bool(i % 2)}), echo.addr)
+        try:
+            reply = codec.decode(sock.recvfrom(1024)[0])
+            acked += reply.get("cmd") == "arm"
+        except socket.timeout:
+            pass
+        blocked += time.monotonic() - t
+    return blocked, acked, time.monotonic() - started
+
+def pipelined(echo, count):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.1)
+    pipeline = CommandPipeline(lambda packet: sock.sendto(codec.encode(packet), echo.addr)).start()
+    done = threading.Semaphore(0)
+    results = []
+    def callback(ok, pending, round_trip):
+        results.append(ok)
+        done.release()
+    stop = threading.Event()
+    def receive():
+        while not stop.is_set():
+            try:
+                pipeline.on_ack(codec.decode(sock.recvfrom(1024)[0]))
+            except socket.timeout:
+                pass
+    threading.Thread(target=receive, daemon=True).start()
+
+    started = time.monotonic()
+    for i in range(count):
+        pipeline.submit("arm", {"arm": bool(i % 2)}, callback)
+    blocked = time.monotonic() - started
+    for i in range(count):
+        done.acquire()
+    elapsed = time.monotonic() - started
+    stop.set()
+    pipeline.stop()
+    return blocked, sum(results), elapsed, pipeline.stats()["retransmissions"]
+
+def two_hops(policy, count=500, radio_delay=0.5, radio_loss=0.1, local_loss=0.1, seed=0):
+    """ Commands one every 2 s through GCS -> radio -> relay -> localhost -> autohoming and the acks back """
+    rng = random.Random(seed)
+    events = []
+    clock = [0]
+    def at(delay, action, *args):
+        heapq.heappush(events, (clock[0] + delay, id(args), action, args))
+
+    applied, acked = set(), set()
+    radio_sends = [0]
+    def radio(action, *args):
+        radio_sends[0] += 1
+        if rng.random() >= radio_loss:
+            at(radio_delay, action, *args)
+    def local(action, *args):
+        if rng.random() >= local_loss:
+            at(0.001, action, *args)
+
+    pipeline = CommandPipeline(lambda packet: radio(relay_receive, dict(packet)), retry_timeout=2.5, max_tries=3,
+                               clock=lambda: clock[0])
+    forwarded = {}          # seq -> tries, relay retry state
+    def relay_receive(packet):
+        seq = packet["seq"]
+        if policy == "hop ack":
+            radio(gcs_receive, seq)
+        if policy == "+ relay retry" and seq in forwarded:
+            return
+        forwarded[seq] = 1
+        local(vehicle_receive, seq)
+        if policy == "+ relay retry":
+            at(relayserver.COMMAND_RETRY, relay_retry, seq)
+    def relay_retry(seq):
+        if seq in forwarded and forwarded[seq] < relayserver.COMMAND_TRIES:
+            forwarded[seq] += 1
+            local(vehicle_receive, seq)
+            at(relayserver.COMMAND_RETRY, relay_retry, seq)
+    def vehicle_receive(seq):
+        applied.add(seq)
+        if policy != "hop ack":
+            local(relay_ack, seq)
+    def relay_ack(seq):
+        forwarded.pop(seq, None)
+        radio(gcs_receive, seq)
+    def gcs_receive(seq):
+        pipeline.on_ack({"type": "ack", "cmd": "arm", "seq": seq})
+
+    def callback(ok, pending, round_trip):
+        if ok:
+            acked.add(pending.seq)
+    for i in range(count):
+        at(2*i, lambda: pipeline.submit("arm", {"arm": True}, callback))
+    while events:
+        clock[0], _, action, args = heapq.heappop(events)
+        action(*args)
+        deadline = pipeline.poll(clock[0])
+        if deadline is not None and not any(t <= deadline for t, *rest in events):
+            at(deadline - clock[0], lambda: None)
+    return {"acked": len(acked), "acked, not applied": len(acked - applied), "applied": len(applied),
+            "radio packets/cmd": radio_sends[0]/count, "gcs retries": pipeline.retransmissions}
+
+class AckedProcessor(autohoming.CMDProcessor):
+    """ CMDProcessor keeping the acks it would send """
+    def __init__(self):
+        super().__init__(None, None, UDP_PORT=0)
+        self.acks = []
+
+    def send_ack(self, cmd, seq, sid=None):
+        self.acks.append((cmd, seq, sid))
+
+def reordering(trials=1000, seed=0):
+    rng = random.Random(seed)
+    result = {"disarmed": 0, "late arm applied": 0, "acked, not applied": 0}
+    for i in range(trials):
+        cmd = AckedProcessor()
+        packet = lambda arm, seq, sid: codec.encode({"type": "cmd", "cmd": "arm", "arm": arm, "seq": seq, "sid": sid})
+        old, new = rng.randrange(SEQ_MODULO), rng.randrange(SEQ_MODULO)
+        cmd.handle(packet(True, old, 1))                        # GUI run 1 arms
+        cmd.handle(packet(False, new, 2))                       # GUI run 2 disarms
+        result["disarmed"] += cmd.disarming and not cmd.arming
+        cmd.arming = cmd.disarming = False
+        cmd.handle(packet(False, (old + 1) % SEQ_MODULO, 1))    # run 1 disarms, then the retry of its lost arm arrives
+        late = packet(True, old - 1 if old else SEQ_MODULO - 1, 1)
+        cmd.handle(late)
+        result["late arm applied"] += cmd.arming
+        result["acked, not applied"] += ("arm", old - 1 if old else SEQ_MODULO - 1, 1) in cmd.acks
+        cmd.sock.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commands", type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:<26}{:>12}{:>10}{:>12}{:>10}".format("link", "blocked s", "acked", "elapsed s", "resent"))
+    for delay, loss in ((0.02, 0), (0.02, 0.1), (0.2, 0.2)):
+        echo = LossyEcho(delay, loss)
+        blocked, acked, elapsed = blocking(echo, args.commands)
+        print("{:<26}{:>12.3f}{:>10}{:>12.2f}{:>10}".format("{:.0f} ms {:.0%} blocking".format(delay*1e3, loss),
+                                                           blocked, acked, elapsed, "-"))
+        blocked, acked, elapsed, resent = pipelined(echo, args.commands)
+        print("{:<26}{:>12.3f}{:>10}{:>12.2f}{:>10}".format("{:.0f} ms {:.0%} pipeline".format(delay*1e3, loss),
+                                                           blocked, acked, elapsed, resent))
+        echo.stop_event.set()
+
+    print()
+    columns = ["acked", "acked, not applied", "applied", "radio packets/cmd", "gcs retries"]
+    print("{:<16}".format("500 commands") + "".join("{:>20}".format(c) for c in columns))
+    for policy in ("hop ack", "end to end", "+ relay retry"):
+        result = two_hops(policy)
+        print("{:<16}".format(policy) + "".join("{:>20.2f}".format(result[c]) if isinstance(result[c], float) else "{:>20}".format(result[c]) for c in columns))
+
+    print()
+    result = reordering()
+    print("arm/disarm reordering, 1000 runs: " + ", ".join("{} {}".format(k, v) for k, v in result.items()))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Compare CPU, RSS and bearing update rate of the HTTP and Selenium radio compass feeds against kerberos_mock.py
+Each feed runs in its own process; CPU and RSS are summed over that process and everything it spawned (chromedriver, chrome)
+"""
+import os
+import time
+import socket
+import argparse
+import multiprocessing as mp
+import radio_compass
+from kerberos_mock import MockCompassServer
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.INFO)
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def process_tree(pid):
+    """ pid and all its descendants, read from /proc """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+def tree_usage(pid):
+    """ (cpu seconds, rss bytes) summed over the process tree """
+    cpu = rss = 0
+    for p in process_tree(pid):
+        try:
+            with open("/proc/{}/stat".format(p)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK    # utime + stime
+            rss += int(fields[21]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+def feed_worker(mode, http_port, udp_port, rate, duration, ready, done):
+    log.getLogger().setLevel(log.WARNING)
+    if mode == "selenium":
+        feed = radio_compass.SeleniumFeed(port=http_port)
+    else:
+        feed = radio_compass.HTTPFeed(port=http_port)
+    sender = radio_compass.CompassSender(UDP_PORT=udp_port)
+    ready.set()
+    radio_compass.run(feed, sender, rate, duration)
+    done.wait()     # stay alive so the parent can take the final usage snapshot
+    feed.close()
+
+def bench(mode, http_port, rate, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+
+    ready, done = mp.Event(), mp.Event()
+    worker = mp.Process(target=feed_worker, args=(mode, http_port, sock.getsockname()[1], rate, duration, ready, done))
+    worker.start()
+    ready.wait()
+    cpu_start, _ = tree_usage(worker.pid)
+
+    received = 0
+    peak_rss = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration + 0.5:
+        try:
+            sock.recvfrom(1024)
+            received += 1
+        except socket.timeout:
+            pass
+        peak_rss = max(peak_rss, tree_usage(worker.pid)[1])
+
+    cpu_end, _ = tree_usage(worker.pid)
+    done.set()
+    worker.join()
+    sock.close()
+    return {"cpu_percent": 100*(cpu_end - cpu_start)/duration, "rss_mb": peak_rss/2**20, "updates_per_s": received/duration}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per feed")
+    parser.add_argument("--rate", type=float, default=20, help="poll rate in Hz for the HTTP feed")
+    parser.add_argument("--selenium", action="store_true", help="also run the Selenium feed (needs chrome and chromedriver)")
+    args = parser.parse_args()
+
+    server = MockCompassServer(PORT=0).start()
+    runs = [("http", args.rate)]
+    if args.selenium:
+        runs.append(("selenium", 1))   # the scraper cannot poll faster than the page refresh anyway
+
+    print("{:<10}{:>8}{:>10}{:>10}{:>12}".format("feed", "rate", "cpu %", "rss MB", "updates/s"))
+    for mode, rate in runs:
+        result = bench(mode, server.port, rate, args.duration)
+        print("{:<10}{:>8.1f}{:>10.1f}{:>10.1f}{:>12.1f}".format(mode, rate, result["cpu_percent"], result["rss_mb"], result["updates_per_s"]))
+
+    server.stop()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Measure DOA estimates per second on synthetic IQ for every method and batch size, and check the bearings are right
+Hydra updates the compass roughly once per second on the Pi, which is the rate to beat
+"""
+import time
+import argparse
+import numpy as np
+import doa
+
+def bench(engine, frames, samples, repeats):
+    rng = np.random.default_rng(0)
+    truth = rng.uniform(0, 360, frames)
+    iq = np.concatenate([doa.synthetic_iq(engine, b, 1, samples, rng=rng) for b in truth])
+
+    engine.estimate(iq)     # warm up
+    start = time.perf_counter()
+    for i in range(repeats):
+        bearing, power, confidence = engine.estimate(iq)
+    elapsed = time.perf_counter() - start
+
+    error = np.abs((bearing - truth + 180) % 360 - 180)
+    return frames*repeats/elapsed, np.max(error)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=2**14, help="samples per channel per frame")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    settings = doa.load_settings()
+    print("{:<10}{:>8}{:>14}{:>16}".format("method", "batch", "estimates/s", "max error deg"))
+    for method in ("Bartlett", "Capon", "MUSIC"):
+        engine = doa.DOAEngine(settings["center_freq"], settings["ant_spacing"], doa.ARRANGEMENTS[int(settings["ant_arrangement_index"])], [method])
+        for frames in (1, 8, 32):
+            rate, error = bench(engine, frames, args.samples, args.repeats)
+            print("{:<10}{:>8}{:>14.1f}{:>16.1f}".format(method, frames, rate, error))
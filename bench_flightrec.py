@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Hot path cost of the flight recorder against the INFO log line autohoming.py writes today
+Then replays the recording at 1x and Nx speed into local sockets and checks every packet arrives in order
+"""
+import os
+import time
+import socket
+import argparse
+import tempfile
+import logging
+import flightrec
+
+COMPASS = b'{"bearing":123.0,"power":12.5,"confidence":8.1}'
+
+def per_call(fn, number):
+    start = time.perf_counter()
+    for i in range(number):
+        fn()
+    return (time.perf_counter() - start)/number*1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000, help="appends per measurement")
+    parser.add_argument("--speed", type=float, default=10, help="fast replay multiplier")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "bench.rec")
+    recorder = flightrec.FlightRecorder(path, size=8*1024*1024)
+
+    logger = logging.getLogger("bench")
+    logger.propagate = False
+    handler = logging.FileHandler(os.path.join(folder, "bench.log"))
+    handler.setFormatter(logging.Formatter('[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    print("{:<32}{:>10}".format("per call", "us"))
+    print("{:<32}{:>10.2f}".format("log.info(message)", per_call(lambda: logger.info(COMPASS), args.number)))
+    print("{:<32}{:>10.2f}".format("recorder.packet(port, message)", per_call(lambda: recorder.packet(5001, COMPASS), args.number)))
+    print("{:<32}{:>10.2f}".format("recorder.effort(pitch, yaw)", per_call(lambda: recorder.effort(-200, 137), args.number)))
+    recorder.close()
+
+    """ Replay a 2 s recording of 50 Hz packets on the four ports """
+    recorder = flightrec.FlightRecorder(path, size=8*1024*1024)
+    sinks = {}
+    for port in flightrec.REPLAY_PORTS:
+        sinks[port] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sinks[port].bind((flightrec.LOCALHOST, port))
+        sinks[port].setblocking(False)
+    for i in range(100):
+        recorder.packet(5001 + i % 4, str(i).encode())
+        time.sleep(0.02)
+    recorder.close()
+    recording = list(flightrec.runs(path))[-1]
+    duration = recording[-1][0] - recording[1][0]
+
+    for speed in (1, args.speed):
+        start = time.monotonic()
+        sent = flightrec.replay(recording, speed)
+        elapsed = time.monotonic() - start
+        received = []
+        for port, sink in sinks.items():
+            try:
+                while True:
+                    received.append(int(sink.recv(64)))
+            except BlockingIOError:
+                pass
+        print("replay {:>4}x: {} packets, {:.2f} s for {:.2f} s recorded, all received: {}".format(
+              speed, sent, elapsed, duration, sorted(received) == list(range(100))))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Heading-aided bearings against relative-only bearings
+Open loop: the boat turns at a constant rate, the radio compass reports at its own rate and the autopilot heading at
+ATTITUDE_RATE. The error is that of the bearing the controller would read at every attitude update.
+Closed loop: sim.py homing runs with and without HeadingFusion.
+"""
+import time
+import math
+import random
+import argparse
+import autohoming
+import sim
+from fusion import HeadingFusion, ATTITUDE_RATE
+from bearing_filter import wrap180
+
+def open_loop(turn_rate, seconds=60, aided=True, seed=0):
+    """ RMS and max error of compass.bearing at every attitude update, and how many distinct bearings the controller saw """
+    clock = sim.VirtualClock()
+    rng = random.Random(seed)
+    vessel = sim.Vessel(heading=rng.uniform(-180, 180))
+    beacon = sim.Beacon(0, 100, rng=rng)
+    compass = autohoming.RadioCompass("127.0.0.1", 0)
+    compass.filter.clock = clock
+    fusion = HeadingFusion([compass], clock)
+    errors, bearings = [], set()
+    next_compass = clock()
+    try:
+        for i in range(int(seconds*ATTITUDE_RATE)):
+            vessel.heading = (vessel.heading + turn_rate/ATTITUDE_RATE) % 360
+            if aided:
+                fusion.update(vessel.heading)
+            if clock() >= next_compass:
+                compass.handle(beacon.packet(vessel))
+                next_compass += 1/sim.COMPASS_RATE
+            if compass.bearing is not None:
+                errors.append(abs(wrap180(compass.bearing - beacon.relative_bearing(vessel))))
+                bearings.add(round(compass.bearing, 3))
+            clock.advance(1/ATTITUDE_RATE)
+    finally:
+        compass.sock.close()
+    return math.sqrt(sum(e*e for e in errors)/len(errors)), max(errors), len(bearings)/seconds
+
+def closed_loop(headings, aided, gains=None):
+    results = [sim.simulate(sim.Scenario((0, 100), heading=heading), sim.pid_settings(gains), heading_aided=aided) for heading in headings]
+    mean = lambda key: sum(r[key] for r in results)/len(results)
+    return (sum(r["arrived"] for r in results), mean("time"), mean("bearing_error"), max(r["overshoot"] for r in results),
+            mean("heading_error"), mean("steps")/mean("time"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000, help="heading updates timed")
+    parser.add_argument("--headings", type=float, nargs="+", default=[90, -60, 150, -135], help="start headings of the closed loop runs")
+    parser.add_argument("--gains", type=float, nargs=3, default=None, metavar=("KP", "KI", "KD"))
+    args = parser.parse_args()
+
+    compass = autohoming.RadioCompass("127.0.0.1", 0)
+    vision = autohoming.Vision("127.0.0.1", 0)
+    compass.handle(b'{"bearing": 60, "power": 30, "confidence": 20}')
+    fusion = HeadingFusion([compass, vision])
+    started = time.perf_counter()
+    for i in range(args.number):
+        fusion.update(i % 360)
+    print("update: {:.2f} us per heading".format((time.perf_counter() - started)/args.number*1e6))
+
+    print("{:<22}{:>10}{:>10}{:>12}".format("open loop", "rms", "max", "bearings/s"))
+    for turn_rate in (0, 10, 30, 60):
+        for aided in (False, True):
+            print("{:<22}{:>10.1f}{:>10.1f}{:>12.1f}".format(
+                  "{} deg/s{}".format(turn_rate, ", aided" if aided else ""), *open_loop(turn_rate, aided=aided)))
+
+    print("{:<22}{:>9}{:>9}{:>13}{:>10}{:>10}{:>9}".format("closed loop", "arrived", "time s", "bearing err", "overshoot", "head err", "steps/s"))
+    for aided in (False, True):
+        print("{:<22}{:>9}{:>9.1f}{:>13.2f}{:>10.1f}{:>10.1f}{:>9.1f}".format(
+              "aided" if aided else "relative only", *closed_loop(args.headings, aided, args.gains)))
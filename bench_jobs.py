@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Sync, restart and cancel commands against the relay's job manager, with dummy scripts in place of the real ones
+The sync script prints the done marker then stays in the foreground like radio_compass.py does after a sync, the
+restart script runs for a few seconds. Each step sends one command the way the GUI does and runs the relay loop until
+the expected job state is reached, reporting whether the command was acked, what the relay told the ground stations,
+and how long it took. A second sync must replace the first one, a cancel naming no job must stop a sync past its done
+marker, and a restart while one is running must be refused without an ack.
+"""
+import os
+import time
+import argparse
+import tempfile
+import codec
+import relayserver
+from jobs import RUNNING, DONE, CANCELLED
+
+SYNC = """#!/bin/sh
+echo "Wait 10 secs for Hydra to start..."
+echo "Sync process done in 0.1 s"
+exec sleep 1000
+"""
+RESTART = """#!/bin/sh
+echo "restarting"
+sleep {}
+"""
+
+class Relay(relayserver.RelayServer):
+    """ Relay keeping the acks and job reports it would broadcast """
+    def __init__(self, **kwargs):
+        super().__init__(port=0, **kwargs)
+        self.acks = []
+        self.reports = []
+
+    def send_ack(self, cmd, seq=None, origin=None, sid=None):
+        self.acks.append((cmd, seq))
+
+    def send_job(self, packet):
+        self.reports.append(packet)
+
+def script(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(text)
+    os.chmod(path, 0o755)
+    return path
+
+def step(relay, seq, cmd, until, timeout=10, **params):
+    """ Send a command, run the loop until until(relay) holds. Returns (acked, reports, seconds) """
+    acks, reports = len(relay.acks), len(relay.reports)
+    start = time.monotonic()
+    relay.process(codec.encode(dict({"type": "cmd", "cmd": cmd, "seq": seq, "sid": 1}, **params)))
+    while not until(relay):
+        if time.monotonic() - start > timeout:
+            raise RuntimeError("{} #{}: timed out, jobs {}".format(cmd, seq, relay.jobs.stats()))
+        relay.run_once(relayserver.TICK)
+    seconds = time.monotonic() - start
+    reported = ["{} {}{}".format(p["job"], p["state"], ": " + p["line"] if "line" in p else "") for p in relay.reports[reports:]]
+    return (cmd, seq) in relay.acks[acks:], reported, seconds
+
+def state(name, *states):
+    return lambda relay: name in relay.jobs.jobs and relay.jobs.jobs[name].state in states
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--restart-seconds", type=float, default=2)
+    args = parser.parse_args()
+    relayserver.log.getLogger().setLevel(relayserver.log.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chmod(directory, 0o755)          # the sync job drops root privileges like the relay's does
+        relay = Relay(sync_command=script(directory, "sync.sh", SYNC),
+                      restart_command=script(directory, "restart.sh", RESTART.format(args.restart_seconds)))
+        jobs = relay.jobs.jobs
+        first = []                          # the sync jobs started, in order
+        steps = [
+            ("sync", "sync", state("sync", DONE), True),
+            ("sync again", "sync", lambda r: state("sync", DONE)(r) and jobs["sync"] is not first[0], True),
+            ("cancel, no job named", "cancel", state("sync", CANCELLED), True),
+            ("restart", "restart", state("restart", RUNNING), True),
+            ("restart while running", "restart", lambda r: True, False),
+        ]
+        print("{:<24}{:>8}{:>10}  {}".format("step", "acked", "s", "reported"))
+        for seq, (name, cmd, until, expect_ack) in enumerate(steps):
+            acked, reported, seconds = step(relay, seq, cmd, until)
+            if cmd == "sync":
+                first.append(jobs["sync"])
+            print("{:<24}{:>8}{:>10.2f}  {}".format(name, str(acked), seconds, "; ".join(reported)))
+            assert acked == expect_ack, name
+        assert first[0].state == CANCELLED and first[1].state == CANCELLED, "a sync past its done marker is still running"
+        assert any(p["state"] == "refused" for p in relay.reports), "refusal not reported"
+
+        relay.jobs.cancel()
+        deadline = time.monotonic() + 10
+        while relay.jobs.active() and time.monotonic() < deadline:
+            relay.run_once(relayserver.TICK)
+        print("jobs at the end: " + ", ".join("{} {}".format(name, s["state"]) for name, s in relay.jobs.stats().items()))
+        relay.sock.close()
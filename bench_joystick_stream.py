@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Change driven joystick packets against the old fixed rate polling, on a synthetic stick trace
+The operator holds LT with the sticks idle most of the time and now and then steers, a smooth sweep of the left stick.
+The stick reports events at EVENT_RATE while it moves and jitters by a few thousandths.
+Polling: the old joystick_thread, a full js packet every 0.1 s whatever the sticks do.
+Change driven: joystick_stream.JoystickStream fed with every event, at most 20 Hz while moving, keepalives while idle.
+Reported: packets and bytes per second, delay from a stick movement to the packet carrying it, and the largest error
+of the stick position the vehicle holds
+"""
+import math
+import random
+import argparse
+import codec
+from joystick_stream import JoystickStream
+
+EVENT_RATE = 100        # Hz, input events while a stick moves
+POLL_PERIOD = 0.1       # s, the old UDP joystick thread
+DEADBAND = 0.05
+
+def trace(seconds, seed=0):
+    """ (t, axes, btns) input events: idle with LT held, a steering sweep of 2-6 s every 10-30 s """
+    rng = random.Random(seed)
+    events = []
+    t = 0
+    while t < seconds:
+        idle = rng.uniform(10, 30)
+        for i in range(int(idle)):      # jitter on the held trigger, about once a second
+            events.append((t + i + rng.random(), [0, 0, round(1 - rng.uniform(0, 0.004), 3)], [0, 0]))
+        t += idle
+        sweep = rng.uniform(2, 6)
+        amplitude = rng.uniform(0.3, 1)
+        for i in range(int(sweep*EVENT_RATE)):
+            x = amplitude*math.sin(math.pi*i/(sweep*EVENT_RATE))
+            x += rng.uniform(-0.003, 0.003)
+            events.append((t + i/EVENT_RATE, [0 if abs(x) < DEADBAND else x, 0, 1], [0, 0]))
+        t += sweep
+    return sorted(e for e in events if e[0] < seconds)
+
+def run(events, seconds, change_driven):
+    sent = []                   # (t, axes, bytes)
+    def send(axes, btns):
+        sent.append((clock[0], axes, len(codec.encode({"type": "js", "ax": axes, "bt": btns}))))
+    clock = [0]
+    stream = JoystickStream(send, clock=lambda: clock[0])
+    delays, errors = [], []
+    next_poll = 0
+    state = (events[0][1], events[0][2])
+    if change_driven:
+        stream.update(*state)
+    pending = None              # time of the first movement not sent yet
+    for t, axes, btns in events + [(seconds, None, None)]:
+        while True:             # time based sends up to this event
+            due = next_poll if not change_driven else stream.deadline()
+            if due is None or due > t:
+                break
+            clock[0] = due
+            count = len(sent)
+            if change_driven:
+                stream.poll(due)
+            else:
+                send([round(a, 3) for a in state[0]], state[1])
+                next_poll += POLL_PERIOD
+            if pending is not None and len(sent) > count:
+                delays.append(due - pending)
+                pending = None
+        if axes is None:
+            break
+        clock[0] = t
+        errors.append(max(abs(a - b) for a, b in zip(axes, sent[-1][1])) if sent else 0)
+        if abs(axes[0] - state[0][0]) >= 0.01 and pending is None:
+            pending = t
+        state = (axes, btns)
+        if change_driven:
+            if stream.update(axes, btns, t) and pending is not None:
+                delays.append(0)
+                pending = None
+    delays.sort()
+    return {"packets/s": len(sent)/seconds, "B/s": sum(size for t, axes, size in sent)/seconds,
+            "delay p50 ms": delays[len(delays)//2]*1e3 if delays else 0, "delay max ms": delays[-1]*1e3 if delays else 0,
+            "max error": max(errors)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=600)
+    args = parser.parse_args()
+
+    events = trace(args.seconds)
+    columns = ["packets/s", "B/s", "delay p50 ms", "delay max ms", "max error"]
+    print("{:<16}".format("joystick") + "".join("{:>14}".format(c) for c in columns))
+    for name, change_driven in (("poll 10 Hz", False), ("change driven", True)):
+        result = run(events, args.seconds, change_driven)
+        print("{:<16}".format(name) + "".join("{:>14.3f}".format(result[c]) for c in columns))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Run the kerberos_sync.py sequence against the control pages of kerberos_mock.py and time each step
+The mock answers every form after a configurable handler delay, like the receiver reconfiguring, and serves one
+button without a name (Calibrate IQ), which must be found by its label and left out of the POST body
+Checks that every button was pressed once, in order, and that the pages end in the state the sequence asks for
+"""
+import time
+import argparse
+import kerberos_sync
+from kerberos_mock import MockControlServer
+import logging as log
+
+def bench(delay, settle):
+    server = MockControlServer(PORT=0, delay=delay).start()
+    web = kerberos_sync.KerberosWeb(port=server.port)
+    steps = kerberos_sync.sync_sequence(settle)
+    start = time.monotonic()
+    try:
+        timings = kerberos_sync.run(web, steps)
+    finally:
+        web.close()
+        server.stop()
+    total = time.monotonic() - start
+
+    pressed = [step.button for step in steps]
+    assert server.presses == pressed, "pressed {}, expected {}".format(server.presses, pressed)
+    expected = {"dc_comp": True, "fir_size": "100", "en_sync": False, "en_noise": False, "en_doa": True}
+    state = {k: server.state[k] for k in expected}
+    assert state == expected, "ended in {}".format(state)
+    return total, timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--delay", type=float, nargs="+", default=[0, 0.2], help="seconds the mock takes to answer a form")
+    parser.add_argument("--settle", type=float, default=kerberos_sync.SETTLE_TIME, help="seconds given to sample sync and IQ calibration")
+    args = parser.parse_args()
+
+    log.getLogger().setLevel(log.WARNING)
+    for delay in args.delay:
+        print("handler delay {} s, settle {} s".format(delay, args.settle))
+        total, timings = bench(delay, args.settle)
+        print("{:<28}{:6.2f} s, all {} buttons pressed in order".format("total", total, len(timings)))
+        print()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Cost per bearing of the recursive least squares beacon fix, and its error against the true beacon position
+Survey: the boat drives a straight line past the beacon, the classic triangulation geometry. New estimates come at the
+DOA rate and every poll in between repeats the last one, like radio_compass.py reading Hydra, and the reported std must
+match the one from the estimates alone, a line each
+Homing: sim.py runs, where the boat mostly drives at the beacon and only drift or turns give the lines a crossing angle
+"""
+import time
+import math
+import random
+import argparse
+import sim
+from localize import BeaconLocalizer
+from bearing_filter import BearingFilter
+
+def survey(offset=30, speed=1.5, seconds=120, seed=0, poll_rate=sim.COMPASS_RATE):
+    """
+    Error of the fix and its reported std every 20 s while passing the beacon at offset metres
+    A new estimate every 1/DOA_RATE s, added again at every poll in between
+    """
+    rng = random.Random(seed)
+    beacon = sim.Beacon(offset, speed*seconds/2, rng=rng)
+    vessel = sim.Vessel(heading=0)
+    bearing_filter = BearingFilter()        # only used for its sample weight
+    bearing_filter.min_power = bearing_filter.min_confidence = 5
+    localizer = BeaconLocalizer(clock=lambda: 0)
+    rows = []
+    next_estimate = 0
+    for i in range(int(seconds*poll_rate)):
+        t = i/poll_rate
+        vessel.y = speed*t
+        localizer.set_position(vessel.x, vessel.y, vessel.heading, t)
+        if t >= next_estimate - 1e-9:
+            bearing, power, confidence = beacon.reading(vessel)
+            next_estimate = t + 1/sim.DOA_RATE
+        localizer.add(round(bearing), bearing_filter.weight(power, confidence), t=t)
+        if (i + 1) % (20*poll_rate) == 0:
+            error = None if localizer.estimate is None else math.hypot(localizer.estimate[0] - beacon.x, localizer.estimate[1] - beacon.y)
+            rows.append((t + 1/poll_rate, localizer.lines, error, localizer.std))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=200000, help="bearings timed")
+    parser.add_argument("--seeds", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    localizer = BeaconLocalizer(clock=lambda: 0)
+    samples = [(rng.uniform(-200, 200), rng.uniform(-200, 200), rng.uniform(-180, 180)) for i in range(1000)]
+    started = time.perf_counter()
+    for i in range(args.number):
+        east, north, bearing = samples[i % 1000]
+        localizer.set_position(east, north, 0, i)
+        localizer.add(bearing, 1, t=i)
+    print("add: {:.2f} us per bearing".format((time.perf_counter() - started)/args.number*1e6))
+
+    print("{:<10}{:>8}{:>8}{:>10}{:>10}{:>16}".format("survey s", "seed", "lines", "error m", "std m", "std, no repeats"))
+    for seed in range(args.seeds):
+        for (t, lines, error, std), (_, _, _, alone) in zip(survey(seed=seed), survey(seed=seed, poll_rate=sim.DOA_RATE)):
+            print("{:<10.0f}{:>8}{:>8}{:>10}{:>10}{:>16}".format(t, seed, lines, "-" if error is None else "{:.1f}".format(error),
+                                                                 "-" if std is None else "{:.1f}".format(std),
+                                                                 "-" if alone is None else "{:.1f}".format(alone)))
+            if std is not None and alone is not None:
+                assert std > 0.7*alone, "repeated polls of one estimate shrink the std"
+
+    print("{:<50}{:>9}{:>10}{:>10}".format("homing", "arrived", "error m", "std m"))
+    for beacon, heading, current in (((0, 100), 90, (0, 0)), ((0, 200), 150, (0.3, 0)), ((40, 150), -60, (-0.2, 0.1))):
+        result = sim.simulate(sim.Scenario(beacon, heading=heading, current=current))
+        print("{:<50}{:>9}{:>10}{:>10}".format("beacon {} heading {} current {}".format(beacon, heading, current), str(result["arrived"]),
+                                               "-" if result["beacon_error"] is None else result["beacon_error"],
+                                               "-" if result["beacon_std"] is None else result["beacon_std"]))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Token based LoRa link against uncoordinated newline writes, over lora_link.HalfDuplexChannel between two pseudo terminals
+Both runs carry the same traffic in real time: vehicle telemetry at TELEM_RATE and a command every COMMAND_PERIOD that
+the vehicle acks, then the same with the joystick streaming at JOYSTICK_RATE, more than a 2.4 kbps air rate can carry.
+Reported: bursts lost to collisions, commands acked and their round trip, telemetry and joystick packets delivered per second, and payload goodput against airtime
+"""
+import time
+import queue
+import random
+import argparse
+import threading
+import serial
+import codec
+import lora_link
+
+TELEM_RATE = 1          # Hz, the old full snapshot rate
+JOYSTICK_RATE = 5       # Hz
+COMMAND_PERIOD = 2      # s on average, the clicks are not in step with the telemetry
+ACK_TIMEOUT = 3         # s
+
+TELEM = codec.encode_json({"type": "telem", "heartbeat": 120, "bearing": -12.5, "confident": True, "arm": True,
+                           "pidparams": [0.5, 0.05, 0.5], "effort(p,y)": [-300, 120]})
+JOYSTICK = codec.encode_json({"type": "js", "ax": [0.125, -0.5, 0.0], "bt": [1, 0]})
+
+class Counters:
+    def __init__(self):
+        self.telem = 0
+        self.joystick = 0
+        self.commands = 0
+        self.acked = 0
+        self.round_trips = []
+        self.payload = 0
+        self.acks = queue.Queue()
+
+    def vehicle_receive(self, message, reply):
+        packet = codec.decode(message)
+        self.payload += len(message)
+        if packet["type"] == "js":
+            self.joystick += 1
+        elif packet["type"] == "cmd":
+            reply(codec.encode_json({"type": "ack", "cmd": packet["cmd"], "id": packet["id"]}))
+
+    def gcs_receive(self, message):
+        packet = codec.decode(message)
+        self.payload += len(message)
+        if packet["type"] == "telem":
+            self.telem += 1
+        elif packet["type"] == "ack":
+            self.acks.put(packet["id"])
+
+def every(period, action, stop):
+    next_time = time.monotonic()
+    while not stop.is_set():
+        action()
+        next_time += period
+        stop.wait(max(0, next_time - time.monotonic()))
+
+def command_loop(counters, send, stop):
+    """ One command at a time, waiting for its ack like gui.py does """
+    rng = random.Random(0)
+    stop.wait(rng.uniform(0, COMMAND_PERIOD))
+    while not stop.is_set():
+        counters.commands += 1
+        started = time.monotonic()
+        send(codec.encode_json({"type": "cmd", "cmd": "pid", "id": counters.commands}))
+        deadline = started + ACK_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                if counters.acks.get(timeout=max(0, deadline - time.monotonic())) == counters.commands:
+                    counters.acked += 1
+                    counters.round_trips.append(time.monotonic() - started)
+                    break
+            except queue.Empty:
+                break
+        stop.wait(max(0, started + rng.uniform(0.5, 1.5)*COMMAND_PERIOD - time.monotonic()))
+
+def reader(ser, handle, stop):
+    buffer = b''
+    while not stop.is_set():
+        buffer += ser.read(ser.in_waiting or 1)
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            try:
+                handle(line)
+            except (codec.DecodeError, KeyError, TypeError):
+                pass
+
+def run(mode, seconds, rate, loss, joystick):
+    channel = lora_link.HalfDuplexChannel(rate, loss, seed=0).start()
+    vehicle = serial.Serial(channel.names[0], timeout=lora_link.TICK)
+    gcs = serial.Serial(channel.names[1], timeout=lora_link.TICK)
+    counters = Counters()
+    stop = threading.Event()
+    threads = []
+
+    if mode == "token":
+        vehicle_link = lora_link.LoraLink(vehicle, master=False, on_receive=lambda m: counters.vehicle_receive(m, reply))
+        gcs_link = lora_link.LoraLink(gcs, master=True, on_receive=counters.gcs_receive)
+        reply = lambda m: vehicle_link.send(m, lora_link.COMMAND)
+        next_telem = [0]
+        def fill(room):
+            now = time.monotonic()
+            if now < next_telem[0]:
+                return None
+            next_telem[0] = now + 1/TELEM_RATE
+            return TELEM
+        vehicle_link.fill = fill
+        threads += [threading.Thread(target=vehicle_link.run), threading.Thread(target=gcs_link.run)]
+        send_joystick = lambda: gcs_link.send(JOYSTICK, lora_link.JOYSTICK, replace=True)
+        send_command = lambda m: gcs_link.send(m, lora_link.COMMAND)
+        send_telem = None
+    else:
+        reply = lambda m: vehicle.write(m + b'\n')
+        threads += [threading.Thread(target=reader, args=(vehicle, lambda m: counters.vehicle_receive(m, reply), stop)),
+                    threading.Thread(target=reader, args=(gcs, counters.gcs_receive, stop))]
+        send_joystick = lambda: gcs.write(JOYSTICK + b'\n')
+        send_command = lambda m: gcs.write(m + b'\n')
+        send_telem = lambda: vehicle.write(TELEM + b'\n')
+
+    threads.append(threading.Thread(target=command_loop, args=(counters, send_command, stop)))
+    if joystick:
+        threads.append(threading.Thread(target=every, args=(1/JOYSTICK_RATE, send_joystick, stop)))
+    if send_telem:
+        threads.append(threading.Thread(target=every, args=(1/TELEM_RATE, send_telem, stop)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    if mode == "token":
+        vehicle_link.stop()
+        gcs_link.stop()
+    time.sleep(0.2)
+    stats = channel.stats()
+    channel.stop()
+
+    trips = sorted(counters.round_trips)
+    return {"collisions": stats["collisions"], "acked %": 100*counters.acked/max(1, counters.commands),
+            "ack p50 s": trips[len(trips)//2] if trips else float("nan"), "ack max s": trips[-1] if trips else float("nan"),
+            "telem/s": counters.telem/seconds, "js/s": counters.joystick/seconds,
+            "goodput %": 100*counters.payload/max(1, sum(stats["air_bytes"]))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args()
+
+    columns = ["collisions", "acked %", "ack p50 s", "ack max s", "telem/s", "js/s", "goodput %"]
+    print("{:<42}".format("link") + "".join("{:>12}".format(c) for c in columns))
+    for joystick in (False, True):
+        for loss in (0, 0.1):
+            for mode in ("uncoordinated", "token"):
+                result = run(mode, args.seconds, lora_link.AIR_RATE, loss, joystick)
+                name = "{:.0%} loss, {}{}".format(loss, "joystick, " if joystick else "", mode)
+                print("{:<42}".format(name) + "".join("{:>12.2f}".format(result[c]) for c in columns), flush=True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Hot path cost of metrics.py: a counter increment, a gauge set and a histogram observation, against an empty method
+call and an attribute add for reference. Then the cost of a scrape of a registry the size of the relay's, rendered and
+fetched over HTTP while another thread keeps observing.
+"""
+import time
+import timeit
+import argparse
+import threading
+import urllib.request
+import metrics
+from relayserver import LOOP_BOUNDS
+
+class Plain:
+    def __init__(self):
+        self.value = 0
+
+    def nothing(self):
+        pass
+
+def per_call(statement, namespace, number):
+    return min(timeit.repeat(statement, globals=namespace, number=number, repeat=5))/number*1e9
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=1000000)
+    args = parser.parse_args()
+
+    registry = metrics.Registry()
+    namespace = {"plain": Plain(), "counter": registry.counter("c_total"), "gauge": registry.gauge("g"),
+                 "histogram": registry.histogram("h_seconds", bounds=LOOP_BOUNDS), "value": 0.0003}
+    print("{:<28}{:>10}".format("hot path", "ns/call"))
+    for name, statement in (("empty method call", "plain.nothing()"), ("attribute add", "plain.value += 1"),
+                            ("counter.inc()", "counter.inc()"), ("gauge.set(v)", "gauge.set(value)"),
+                            ("histogram.observe(v)", "histogram.observe(value)")):
+        print("{:<28}{:>10.0f}".format(name, per_call(statement, namespace, args.number)))
+
+    for i in range(60):         # about what relayserver.py registers, two names registered in turn
+        registry.counter("route_packets_total", function=lambda: i, route=str(i))
+        registry.gauge("route_age_seconds", function=lambda: i, route=str(i))
+    for i in range(4):
+        registry.histogram("loop_seconds", bounds=LOOP_BOUNDS, part=str(i)).observe(0.0001)
+    started = time.perf_counter()
+    for i in range(100):
+        text = registry.render()
+    render = (time.perf_counter() - started)/100
+    print()
+    print("render: {} series, {} bytes, {:.3f} ms".format(text.count("\n") - 2*text.count("# TYPE"), len(text), render*1e3))
+    families = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE"):
+            families.append(line.split()[2])
+        elif not line.startswith("#"):
+            assert line.startswith(families[-1]), "{} is not in the block of its name".format(line)
+    assert len(families) == len(set(families)), "a metric name has more than one header"
+
+    server = metrics.serve(19100, registry=registry)
+    stop = threading.Event()
+    hot = registry.histogram("h_seconds", bounds=LOOP_BOUNDS)
+    def observe():
+        while not stop.is_set():
+            for i in range(1000):
+                hot.observe(0.0003)
+    threading.Thread(target=observe, daemon=True).start()
+    started = time.perf_counter()
+    for i in range(100):
+        urllib.request.urlopen("http://127.0.0.1:19100/metrics").read()
+    print("scrape over HTTP under load: {:.2f} ms".format((time.perf_counter() - started)/100*1e3))
+    stop.set()
+    server.shutdown()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Arm, disarm and COMMAND_ACK handling of pixhawk.py against the stand-in autopilot of mav_standin.py
+Each case sends a command the way the vehicle does and times it until its future resolves: with the reader thread,
+with wait() reading the link itself, from an event loop reader as in autohoming.py, with a late ack, and with no ack at
+all, which must time out, cancel the future and leave no pending command behind. A second request for the same command
+must cancel the first one. Dispatch is checked on the heartbeats: queue, callbacks, and a failing callback that must not
+stop the others.
+"""
+import time
+import asyncio
+import argparse
+from concurrent.futures import CancelledError
+from pymavlink import mavutil
+import mav_standin
+import pixhawk
+from pixhawk import Pixhawk, BAUD
+import logging as log
+
+ACCEPTED = mavutil.mavlink.MAV_RESULT_ACCEPTED
+
+def timed(function):
+    start = time.monotonic()
+    result = function()
+    return result, time.monotonic() - start
+
+def report(name, result, seconds, armed, expected):
+    ok = result == expected[0] and armed == expected[1]
+    print("{:<32}{:>10}{:>8}{:>10.3f}  {}".format(name, str(result), str(armed), seconds, "ok" if ok else "FAILED"))
+    assert ok, "{}: result {}, armed {}, expected {}".format(name, result, armed, expected)
+
+async def on_loop(link, request, timeout):
+    """ A command from an event loop, the link served by a reader callback as in autohoming.main """
+    loop = asyncio.get_running_loop()
+    loop.add_reader(link.master.fd, link.poll)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(request()), timeout)
+    finally:
+        loop.remove_reader(link.master.fd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ack-delay", type=float, default=0.5, help="seconds the stand-in holds its acks in the late ack case")
+    parser.add_argument("--timeout", type=float, default=1, help="seconds given to a command the stand-in never acks")
+    args = parser.parse_args()
+    log.getLogger().setLevel(log.WARNING)
+
+    autopilot = mav_standin.StandinAutopilot(heartbeat_period=0.1).start()
+    link = Pixhawk("udpin:127.0.0.1:14551", BAUD)
+    print("{:<32}{:>10}{:>8}{:>10}".format("case", "result", "armed", "s"))
+
+    link.start()
+    report("arm, reader thread", *timed(lambda: link.wait(link.request_arm())), link.armed, (ACCEPTED, True))
+    report("disarm, reader thread", *timed(lambda: link.wait(link.request_disarm())), link.armed, (ACCEPTED, False))
+
+    autopilot.ack_delay = args.ack_delay
+    result, seconds = timed(lambda: link.wait(link.request_arm()))
+    report("arm, ack after {} s".format(args.ack_delay), result, seconds, link.armed, (ACCEPTED, True))
+    assert seconds >= args.ack_delay, "resolved before the ack was sent"
+    autopilot.ack_delay = 0
+
+    first = link.request_disarm()
+    second = link.request_disarm()
+    result, seconds = timed(lambda: link.wait(second))
+    report("disarm, asked twice", result, seconds, link.armed, (ACCEPTED, False))
+    assert first.cancelled(), "the superseded request is still waiting"
+    try:
+        first.result(0)
+        raise AssertionError("the superseded request resolved")
+    except CancelledError:
+        pass
+
+    autopilot.drop_acks = True
+    timeouts = pixhawk.COMMAND_TIMEOUTS.value
+    future = link.request_arm()
+    result, seconds = timed(lambda: link.wait(future, args.timeout))
+    report("arm, no ack", result, seconds, link.armed, (None, True))     # armed all the same, the heartbeats say so
+    assert args.timeout <= seconds < args.timeout + 0.5, "gave up after {:.3f} s".format(seconds)
+    assert future.cancelled() and not link.pending, "a timed out command is still pending"
+    assert pixhawk.COMMAND_TIMEOUTS.value == timeouts + 1, "timeout not counted"
+    autopilot.drop_acks = False
+    link.wait(link.request_disarm())        # the stand-in armed without acking, start the next cases disarmed
+
+    link.stop()
+    report("arm, wait reads the link", *timed(lambda: link.wait(link.request_arm())), link.armed, (ACCEPTED, True))
+    report("disarm, event loop reader", *timed(lambda: asyncio.run(on_loop(link, link.request_disarm, args.timeout))),
+           link.armed, (ACCEPTED, False))
+
+    heartbeats = link.subscribe('HEARTBEAT')
+    seen = []
+    def failing(message):
+        raise ValueError("callback failure")
+    link.subscribe('HEARTBEAT', failing)
+    link.subscribe('HEARTBEAT', seen.append)
+    errors, count = pixhawk.CALLBACK_ERRORS.value, link.heartbeat
+    log.getLogger().setLevel(log.CRITICAL)     # the failing callback logs an error per heartbeat
+    link.start()
+    time.sleep(1)
+    link.stop()
+    log.getLogger().setLevel(log.WARNING)
+    print("dispatch: {} heartbeats, {} seen after a failing callback, {} callback errors, {} queued".format(
+          link.heartbeat - count, len(seen), pixhawk.CALLBACK_ERRORS.value - errors, len(heartbeats)))
+    assert seen and link.heartbeat - count == len(seen) == pixhawk.CALLBACK_ERRORS.value - errors, "a callback was skipped"
+    assert heartbeats[-1] is seen[-1], "queue missed heartbeats"
+
+    autopilot.stop()
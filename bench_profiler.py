@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Cost of the sampling profiler on a process shaped like the vehicle side: a few threads decoding packets flat out,
+a few more waking on timers like the telemetry and streaming threads. Work done per second is compared with the
+profiler idle (nothing runs, the baseline) and sampling at several rates, along with the CPU the sampler itself used
+per sample and the share of the samples that landed in the busy threads.
+"""
+import time
+import argparse
+import threading
+import codec
+import profiler
+
+MESSAGE = codec.encode({"type": "telem", "heartbeat": 1, "bearing": 12.5, "confident": True, "power": 30, "confidence": 12})
+
+class TimedProfiler(profiler.Profiler):
+    """ Profiler counting the CPU time of its sampler thread """
+    def run(self, seconds, rate):
+        started = time.thread_time()
+        super().run(seconds, rate)
+        self.cpu = time.thread_time() - started
+
+def busy(stop, counts, i):
+    while not stop.is_set():
+        for j in range(100):
+            codec.decode(MESSAGE)
+        counts[i] += 100
+
+def timer(stop, period):
+    while not stop.is_set():
+        stop.wait(period)
+
+def run(seconds, rate, busy_threads=2, timer_threads=4):
+    stop = threading.Event()
+    counts = [0]*busy_threads
+    threads = [threading.Thread(target=busy, args=(stop, counts, i), name="busy-{}".format(i)) for i in range(busy_threads)]
+    threads += [threading.Thread(target=timer, args=(stop, 0.05), name="timer-{}".format(i)) for i in range(timer_threads)]
+    for thread in threads:
+        thread.start()
+    sampler = None
+    if rate:
+        sampler = TimedProfiler("bench", directory="/tmp")
+        sampler.start(seconds, rate)
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    result = {"decodes/s": sum(counts)/seconds}
+    if sampler:
+        sampler.thread.join()
+        with open(sampler.last_path) as f:
+            total, by_thread, functions = profiler.summary(f, 100)
+        result["busy %"] = 100*sum(n for name, n in by_thread if name.startswith("busy"))/max(1, total)
+        result["sampler cpu %"] = 100*sampler.cpu/seconds
+        result["us/sample"] = 1e6*sampler.cpu/max(1, seconds*rate)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per rate, the best one is shown, the GIL makes single runs noisy")
+    args = parser.parse_args()
+
+    profiler.log.getLogger().setLevel(profiler.log.WARNING)
+    columns = ["decodes/s", "busy %", "sampler cpu %", "us/sample"]
+    print("{:<14}".format("profiler") + "".join("{:>16}".format(c) for c in columns))
+    baseline = None
+    for rate in (0, 50, 100, 500):
+        result = max((run(args.seconds, rate) for i in range(args.repeat)), key=lambda r: r["decodes/s"])
+        baseline = baseline or result["decodes/s"]
+        name = "idle" if not rate else "{} Hz".format(rate)
+        print("{:<14}".format(name) + "".join("{:>16.1f}".format(result[c]) if c in result else "{:>16}".format("-") for c in columns)
+              + "   {:+.1f}% work".format(100*(result["decodes/s"]/baseline - 1)))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Compare the table driven selector relay with the previous threaded relay, which fully decodes every packet
+and routes through an if/elif chain. Joystick packets are pushed into the relay over UDP and over a pty
+standing in for the LORA UART, and timestamped again when they come out on the joystick port.
+Reports packets per second and forwarding latency for both implementations.
+"""
+import os
+import time
+import socket
+import argparse
+import threading
+import serial
+import codec
+import lora_link
+import relayserver
+from relayserver import RelayServer, LOCALHOST, PORT_RELAY, PORT_JS, PORT_GUI
+
+class LegacyRelay:
+    """ The relay before the routing table: blocking reader threads, full decode, if/elif on type and cmd """
+    def __init__(self, port=PORT_RELAY, ser=None):
+        self.ser = ser
+        self.port = port
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((relayserver.IP_ANY, port))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def process(self, message):
+        try:
+            packet = codec.decode(message)
+            if packet.get("type") == "telem":
+                self.sock.sendto(message, (LOCALHOST, PORT_GUI))
+                self.to_be_written_to_serial = codec.encode_json(packet)
+            elif packet.get("type") == "js":
+                self.sock.sendto(message, (LOCALHOST, PORT_JS))
+            elif packet.get("type") == "stats":
+                self.sock.sendto(message, (LOCALHOST, PORT_GUI))
+        except codec.DecodeError:
+            pass
+
+    def udp_processing_thread(self):
+        while self.running:
+            message, addr = self.sock.recvfrom(1024)
+            if message:
+                self.process(message)
+
+    def serial_processing_thread(self):
+        while self.running:
+            message = self.ser.readline()
+            if message:
+                self.process(message)
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.udp_processing_thread, daemon=True)]
+        if self.ser:
+            self.threads.append(threading.Thread(target=self.serial_processing_thread, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.sock.sendto(b'', (LOCALHOST, self.port))     # wake the blocking recvfrom
+        for thread in self.threads:
+            thread.join()
+        self.sock.close()
+
+class SelectorRelay(RelayServer):
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while self.running:
+            self.run_once(timeout=0.1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+def open_pty():
+    """ Master fd for the bench to write to, and a pyserial port on the slave end for the relay """
+    master, slave = os.openpty()
+    return master, serial.Serial(os.ttyname(slave), timeout=1)
+
+def measure(send, count, window):
+    """ Send count js packets, at most window in flight, and time each one out of the joystick port """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind((LOCALHOST, PORT_JS))
+    sink.settimeout(1)
+    sent = {}
+    latencies = []
+    start = time.perf_counter()
+    i = 0
+    lost = 0
+    while i < count or len(sent) > 0:
+        while i < count and len(sent) < window:
+            sent[i] = time.perf_counter()
+            send(codec.encode({"type": "js", "ax": [(i % 1000)/1000, (i//1000 % 1000)/1000, 0], "bt": []}), i)
+            i += 1
+        try:
+            message = sink.recv(1024)
+        except socket.timeout:
+            lost += len(sent)
+            break
+        packet = codec.decode(message)
+        key = round(packet["ax"][0]*1000) + 1000*round(packet["ax"][1]*1000)    # packet number carried in the first two axes
+        if key in sent:
+            latencies.append(time.perf_counter() - sent.pop(key))
+    elapsed = time.perf_counter() - start
+    sink.close()
+    latencies.sort()
+    ms = lambda q: 1000*latencies[min(len(latencies) - 1, int(q*len(latencies)))] if latencies else float("nan")
+    return len(latencies)/elapsed, ms(0.5), ms(0.99), lost
+
+def bench(relay_class, link, count, window):
+    master = ser = None
+    if link == "pty":
+        master, ser = open_pty()
+    relay = relay_class(ser=ser)
+    relay.start()
+    time.sleep(0.2)
+
+    if link == "udp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send = lambda message, i: sock.sendto(message, (LOCALHOST, PORT_RELAY))
+    elif relay_class is LegacyRelay:
+        # the UART was newline framed JSON
+        send = lambda message, i: os.write(master, codec.encode_json(codec.decode(message)) + b'\n')
+    else:
+        # JSON in lora_link data frames, which leave the token where it is
+        send = lambda message, i: os.write(master, lora_link.frame(lora_link.DATA, codec.encode_json(codec.decode(message))))
+    result = measure(send, count, window)
+    relay.stop()
+    if master is not None:
+        os.close(master)
+        ser.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=20000, help="packets per run")
+    parser.add_argument("--window", type=int, default=16, help="packets in flight")
+    parser.add_argument("--link", choices=["udp", "pty", "both"], default="both")
+    args = parser.parse_args()
+
+    relayserver.log.getLogger().setLevel(relayserver.log.WARNING)
+    links = ["udp", "pty"] if args.link == "both" else [args.link]
+    print("{:<10}{:<6}{:>12}{:>10}{:>10}{:>7}".format("relay", "link", "packets/s", "p50 ms", "p99 ms", "lost"))
+    for link in links:
+        for name, relay_class in (("legacy", LegacyRelay), ("selector", SelectorRelay)):
+            rate, p50, p99, lost = bench(relay_class, link, args.count, args.window)
+            print("{:<10}{:<6}{:>12.0f}{:>10.3f}{:>10.3f}{:>7}".format(name, link, rate, p50, p99, lost))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Load test of one relay serving many simulated vehicles, the relay routing by vehicle id
+Each vehicle stands in for an autohoming: it sends telemetry at TELEM_RATE and acks the commands it receives. The
+ground station side sends joystick packets at JS_RATE and a command every second to every vehicle, plus as many
+joystick packets addressed to vehicles of another relay, which this one must drop. Sends are spread evenly over time.
+Reported per fleet size: packets/s through the relay, latency of joystick (GCS -> vehicle), telemetry (vehicle -> GCS)
+and commands (GCS -> vehicle -> ack at the GCS), packets delivered to the wrong vehicle, packets lost, foreign packets
+dropped, malformed packets sent (a broken JSON telemetry and stats packet per vehicle every second, which must not
+take the relay down) and the decode errors the relay counted for them, and the relay's CPU time. The relay runs in a process of its own, so that it does not share the
+interpreter lock with the simulated vehicles and ground station.
+"""
+import time
+import socket
+import argparse
+import selectors
+import threading
+import multiprocessing
+import codec
+import relayserver
+from relayserver import Vehicle, LOCALHOST, IP_ANY, PORT_RELAY, PORT_GUI
+from bench_relay import SelectorRelay
+
+TELEM_RATE = 5          # Hz per vehicle
+JS_RATE = 20            # Hz per vehicle, the joystick stream's rate while the sticks move
+CMD_RATE = 1            # Hz per vehicle
+FOREIGN_VID = 200       # vids from here on belong to another relay
+MALFORMED = (b'{"type":"telem","bearing":1', b'{"type":"stats","cpu":')     # truncated upstream packets
+BASE_PORT = 6000        # vehicle i gets the command port BASE_PORT + 2i and the joystick port next to it
+
+def relay_process(count, ready, stop, results):
+    """ Relay serving count vehicles until stop is set, then its stats and CPU time go in results """
+    relayserver.log.getLogger().setLevel(relayserver.log.WARNING)
+    relay = SelectorRelay(vehicles=[Vehicle(vid, BASE_PORT + 2*vid, BASE_PORT + 2*vid + 1) for vid in range(count)])
+    started = time.process_time()
+    relay.start()
+    ready.set()
+    stop.wait()
+    relay.stop()
+    results.put((relay.stats(), time.process_time() - started))
+
+class Vehicles:
+    """ The autohoming end of n vehicles: one command and one joystick socket each, served by one selector thread """
+    def __init__(self, count, sent, latencies):
+        self.sent = sent
+        self.latencies = latencies
+        self.misrouted = 0
+        self.selector = selectors.DefaultSelector()
+        self.cmd_socks = []
+        for vid in range(count):
+            for port, handle in ((BASE_PORT + 2*vid, self.command), (BASE_PORT + 2*vid + 1, self.joystick)):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((LOCALHOST, port))
+                sock.setblocking(False)
+                self.selector.register(sock, selectors.EVENT_READ, (vid, handle))
+                if handle == self.command:
+                    self.cmd_socks.append(sock)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select(0.1):
+                vid, handle = key.data
+                while True:
+                    try:
+                        message = key.fileobj.recv(1024)
+                    except BlockingIOError:
+                        break
+                    if codec.peek_vid(message) != vid:
+                        self.misrouted += 1
+                        continue
+                    handle(vid, codec.decode(message))
+
+    def joystick(self, vid, packet):
+        seq = round(packet["ax"][0]*1000) + 1000*round(packet["ax"][1]*1000)     # packet number carried in two axes
+        sent = self.sent.pop(("js", vid, seq), None)
+        if sent is not None:
+            self.latencies["js"].append(time.perf_counter() - sent)
+
+    def command(self, vid, packet):
+        ack = {"type": "ack", "cmd": packet["cmd"], "seq": packet["seq"], "vid": vid}
+        self.cmd_socks[vid].sendto(codec.encode(ack), (LOCALHOST, PORT_RELAY))
+
+    def telem(self, vid, seq):
+        packet = {"type": "telem", "heartbeat": seq, "bearing": 12.5, "confident": True, "arm": True,
+                  "pidparams": [0.5, 0.05, 0.5], "effort(p,y)": [-200, 30], "vid": vid}
+        self.cmd_socks[vid].sendto(codec.encode(packet), (LOCALHOST, PORT_RELAY))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+class GroundStation:
+    """ Receives what the relay broadcasts to the ground stations and times telemetry and acks """
+    def __init__(self, sent, latencies):
+        self.sent = sent
+        self.latencies = latencies
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((IP_ANY, PORT_GUI))
+        self.sock.settimeout(0.1)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                packet = codec.decode(self.sock.recv(1024))
+            except socket.timeout:
+                continue
+            key = {"telem": lambda: ("telem", packet.get("vid"), packet.get("heartbeat")),
+                   "ack": lambda: ("cmd", packet.get("vid"), packet.get("seq"))}.get(packet.get("type"))
+            sent = self.sent.pop(key(), None) if key else None
+            if sent is not None:
+                self.latencies[key()[0]].append(time.perf_counter() - sent)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+def js_packet(vid, seq):
+    return codec.encode({"type": "js", "ax": [(seq % 1000)/1000, (seq//1000 % 1000)/1000, 1], "bt": [0, 0], "vid": vid})
+
+def run(count, seconds):
+    sent, latencies = {}, {"js": [], "telem": [], "cmd": []}
+    ready, stop, results = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+    relay = multiprocessing.Process(target=relay_process, args=(count, ready, stop, results))
+    relay.start()
+    ready.wait()
+    vehicles = Vehicles(count, sent, latencies)
+    gcs = GroundStation(sent, latencies)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    time.sleep(0.2)
+
+    offered = malformed = 0
+    start = time.perf_counter()
+    ticks = int(seconds*JS_RATE)
+    for tick in range(ticks):
+        for vid in range(count):
+            due = start + (tick + vid/count)/JS_RATE
+            delay = due - time.perf_counter()
+            if delay > 0.0005:
+                time.sleep(delay)
+            sent[("js", vid, tick)] = time.perf_counter()
+            sock.sendto(js_packet(vid, tick), (LOCALHOST, PORT_RELAY))
+            sock.sendto(js_packet(FOREIGN_VID + vid % 50, tick), (LOCALHOST, PORT_RELAY))
+            offered += 2
+            if tick % (JS_RATE//TELEM_RATE) == 0:
+                sent[("telem", vid, tick)] = time.perf_counter()
+                vehicles.telem(vid, tick)
+                offered += 1
+            if tick % (JS_RATE//CMD_RATE) == 0:
+                sent[("cmd", vid, tick)] = time.perf_counter()
+                sock.sendto(codec.encode({"type": "cmd", "cmd": "arm", "arm": True, "seq": tick, "vid": vid}), (LOCALHOST, PORT_RELAY))
+                offered += 2        # the command and its ack
+                for message in MALFORMED:
+                    vehicles.cmd_socks[vid].sendto(message, (LOCALHOST, PORT_RELAY))
+                    malformed += 1
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)                 # stragglers
+
+    vehicles.stop()
+    gcs.stop()
+    alive = relay.is_alive()
+    stop.set()
+    if not alive:
+        raise RuntimeError("the relay died during the run")
+    stats, cpu = results.get()
+    relay.join()
+    sock.close()
+    routed = sum(s["packets"] for name, s in stats.items() if isinstance(s, dict) and "packets" in s)
+    result = {"packets/s": offered/elapsed, "misrouted": vehicles.misrouted, "lost": len(sent),
+              "foreign dropped": stats["other_vehicles"], "malformed": malformed,
+              "decode errors": stats["decode_errors"],
+              "cpu %": 100*cpu/elapsed,
+              "us/packet": 1e6*cpu/max(1, routed + stats["other_vehicles"])}
+    for name, values in latencies.items():
+        values.sort()
+        result[name + " p50 ms"] = 1e3*values[len(values)//2] if values else float("nan")
+        result[name + " p99 ms"] = 1e3*values[min(len(values) - 1, int(0.99*len(values)))] if values else float("nan")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1, 4, 16, 64, 128])
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+    if max(args.vehicles) > FOREIGN_VID:
+        parser.error("at most {} vehicles, the vids above belong to the other relay".format(FOREIGN_VID))
+
+    relayserver.log.getLogger().setLevel(relayserver.log.WARNING)
+    columns = ["packets/s", "js p50 ms", "js p99 ms", "telem p99 ms", "cmd p99 ms", "misrouted", "lost",
+               "foreign dropped", "malformed", "decode errors", "cpu %", "us/packet"]
+    print("{:<10}".format("vehicles") + "".join("{:>16}".format(c) for c in columns))
+    for count in args.vehicles:
+        result = run(count, args.seconds)
+        print("{:<10}".format(count) + "".join("{:>16.2f}".format(result[c]) if isinstance(result[c], float)
+                                               else "{:>16}".format(result[c]) for c in columns))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Load test of the autohoming UDP inputs: one event loop (current design) against one blocking thread per socket (previous design)
+A sender process streams joystick, compass, vision and command packets stamped with their send time;
+the receiver process reports its CPU use and the send-to-handled latency of every packet
+On the loop each receiver is the datagram protocol of its socket. The last line says whether the loop is ahead of the
+threads on both CPU and p99 latency, which is the acceptance test of the event loop design
+"""
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import statistics
+import multiprocessing as mp
+from simple_pid import PID
+import autohoming
+import logging as log
+
+BASE_PORT = 15000
+
+def packets():
+    t = time.monotonic
+    yield autohoming.PORT_JS, lambda: {"type": "js", "ax": [0.1, -0.2, 0.0], "bt": [0, 0], "t": t()}
+    yield autohoming.PORT_KERB, lambda: {"bearing": 90, "power": 20, "confidence": 30, "t": t()}
+    yield autohoming.PORT_VISION, lambda: {"type": "vision", "bearing": 3, "distance": 150, "t": t()}
+    yield autohoming.PORT_CMD, lambda: {"type": "cmd", "cmd": "threshold", "power": 5, "conf": 5, "t": t()}
+
+def sender(rate, duration, offset):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sources = [(port + offset, make) for port, make in packets()]
+    period = len(sources)/rate
+    next_time = time.monotonic()
+    end = next_time + duration
+    while next_time < end:
+        for port, make in sources:
+            sock.sendto(json.dumps(make()).encode(), (autohoming.LOCALHOST, port))
+        next_time += period
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def instrument(receiver, latencies):
+    handle = receiver.handle
+    def timed(message):
+        handle(message)
+        latencies.append(time.monotonic() - json.loads(message)["t"])
+    receiver.handle = timed
+
+def make_receivers(offset, latencies):
+    compass = autohoming.RadioCompass(UDP_PORT=autohoming.PORT_KERB + offset)
+    receivers = [autohoming.Joystick(UDP_PORT=autohoming.PORT_JS + offset),
+                 compass,
+                 autohoming.Vision(UDP_IP=autohoming.LOCALHOST, UDP_PORT=autohoming.PORT_VISION + offset),
+                 autohoming.CMDProcessor(PID(), compass, UDP_PORT=autohoming.PORT_CMD + offset)]
+    for receiver in receivers:
+        instrument(receiver, latencies)
+    return receivers
+
+def run_threads(receivers, duration):
+    for receiver in receivers:
+        receiver.sock.settimeout(0.5)       # so the threads notice the end of the run
+    stop = threading.Event()
+    def worker(receiver):
+        while not stop.is_set():
+            receiver.update()
+    threads = [threading.Thread(target=worker, args=(r,), daemon=True) for r in receivers]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+
+async def run_loop(receivers, duration):
+    loop = asyncio.get_running_loop()
+    for receiver in receivers:
+        await receiver.attach(loop)
+    tasks = [asyncio.create_task(r.watchdog()) for r in receivers]
+    await asyncio.sleep(duration)
+    for task in tasks:
+        task.cancel()
+
+def receiver_process(mode, offset, duration, ready, results):
+    log.getLogger().setLevel(log.WARNING)
+    latencies = []
+    receivers = make_receivers(offset, latencies)
+    ready.set()
+    cpu = time.process_time()
+    if mode == "threads":
+        run_threads(receivers, duration)
+    else:
+        asyncio.run(run_loop(receivers, duration))
+    results.put((time.process_time() - cpu, latencies))
+
+def bench(mode, rate, duration, offset):
+    ready, results = mp.Event(), mp.Queue()
+    receiver = mp.Process(target=receiver_process, args=(mode, offset, duration + 1, ready, results))
+    receiver.start()
+    ready.wait()
+    time.sleep(0.2)
+    sender(rate, duration, offset)
+    cpu, latencies = results.get()
+    receiver.join()
+    latencies.sort()
+    return {"packets": len(latencies),
+            "cpu_percent": 100*cpu/(duration + 1),
+            "mean_us": 1e6*statistics.mean(latencies),
+            "p99_us": 1e6*latencies[int(0.99*(len(latencies) - 1))]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=float, default=2000, help="total packets per second over the four sockets")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--offset", type=int, default=BASE_PORT - autohoming.PORT_RELAY, help="added to every port so a running autohoming is not disturbed")
+    args = parser.parse_args()
+
+    print("{:<10}{:>10}{:>10}{:>12}{:>12}{:>12}".format("runtime", "packets", "cpu %", "cpu us/pkt", "mean us", "p99 us"))
+    results = {}
+    for mode in ("threads", "asyncio"):
+        result = results[mode] = bench(mode, args.rate, args.duration, args.offset)
+        print("{:<10}{:>10}{:>10.1f}{:>12.1f}{:>12.0f}{:>12.0f}".format(mode, result["packets"], result["cpu_percent"],
+              result["cpu_percent"]/100*(args.duration + 1)/max(1, result["packets"])*1e6, result["mean_us"], result["p99_us"]))
+    ahead = all(results["asyncio"][key] < results["threads"][key] for key in ("cpu_percent", "p99_us"))
+    print("asyncio ahead on cpu and p99: {}".format("yes" if ahead else "no"))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+MANUAL_CONTROL timing seen by the stand-in autopilot: ad hoc send_cmd from an irregular control loop vs ManualControlStreamer
+on a thread of its own vs the streamer as a task of the event loop that also runs the control steps, as in autohoming.py
+Setpoints come from the same irregular loop in every case; the stand-in records when each MANUAL_CONTROL arrives
+"""
+import time
+import asyncio
+import random
+import argparse
+import statistics
+import logging as log
+import mav_standin
+from pixhawk import Pixhawk, ManualControlStreamer, BAUD
+
+def irregular_loop(duration, send, period=0.1, jitter=0.08):
+    """ Mimics the control loop: nominal period plus whatever the step and the scheduler add """
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        send(random.randint(-1000, 1000), random.randint(-1000, 1000))
+        time.sleep(period + random.uniform(0, jitter))
+
+async def irregular_steps(duration, send, period=0.1, jitter=0.08, busy=0.005):
+    """ irregular_loop as event loop steps, each holding the loop for up to busy seconds like a control step """
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        send(random.randint(-1000, 1000), random.randint(-1000, 1000))
+        until = time.monotonic() + random.uniform(0, busy)
+        while time.monotonic() < until:
+            pass
+        await asyncio.sleep(period + random.uniform(0, jitter))
+
+async def on_loop(streamer, duration):
+    task = asyncio.create_task(streamer.stream())
+    await irregular_steps(duration, streamer.set)
+    task.cancel()
+
+def intervals(autopilot, start):
+    times = [t for t, x, r in autopilot.manual_control if t >= start]
+    return [b - a for a, b in zip(times, times[1:])]
+
+def report(name, gaps, duration, extra=""):
+    print("{:<10}{:>10.1f}{:>12.1f}{:>12.1f}{:>12.1f}  {}".format(
+        name, len(gaps)/duration, 1000*statistics.mean(gaps), 1000*statistics.pstdev(gaps), 1000*max(gaps), extra))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=20, help="streamer rate in Hz")
+    args = parser.parse_args()
+    log.getLogger().setLevel(log.WARNING)
+
+    autopilot = mav_standin.StandinAutopilot().start()
+    pixhawk = Pixhawk("udpin:127.0.0.1:14551", BAUD).start()
+    print("{:<10}{:>10}{:>12}{:>12}{:>12}".format("sender", "msgs/s", "mean ms", "stdev ms", "max gap ms"))
+
+    start = time.monotonic()
+    irregular_loop(args.duration, pixhawk.send_cmd)
+    time.sleep(0.2)
+    report("ad hoc", intervals(autopilot, start), args.duration)
+
+    streamer = ManualControlStreamer(pixhawk, rate=args.rate).start()
+    start = time.monotonic()
+    irregular_loop(args.duration, streamer.set)
+    streamer.stop()
+    time.sleep(0.2)
+    report("thread", intervals(autopilot, start), args.duration, streamer.stats())
+
+    streamer = ManualControlStreamer(pixhawk, rate=args.rate)
+    start = time.monotonic()
+    asyncio.run(on_loop(streamer, args.duration))
+    time.sleep(0.2)
+    report("on loop", intervals(autopilot, start), args.duration, streamer.stats())
+
+    pixhawk.stop()
+    autopilot.stop()
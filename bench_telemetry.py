@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Delta adaptive-rate telemetry against the old full JSON snapshot every second, over a modelled LoRa link
+The link is half duplex with a fixed byte rate, shared by telemetry and the ground station reports, drops whatever
+would overflow the module buffer, and loses a fraction of the rest. The telemetry is a sim.py homing run at 5 Hz.
+Reported: airtime used, packets the module dropped, how often the ground station saw the bearing change, and the error
+of the bearing it showed against the truth
+"""
+import math
+import random
+import argparse
+import codec
+import sim
+import telemetry
+
+DT = 0.01                   # s, simulation step
+MODULE_BUFFER = 256         # bytes the LoRa module queues before dropping
+
+class Link:
+    """ Half duplex link: one transmission at a time at rate bytes/s, delivered in order unless lost """
+    def __init__(self, rate, loss, rng):
+        self.rate = rate
+        self.loss = loss
+        self.rng = rng
+        self.busy_until = 0
+        self.in_flight = []         # (arrival time, direction, message)
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, message, direction, now):
+        if (self.busy_until - now)*self.rate + len(message) > MODULE_BUFFER:
+            self.dropped += 1
+            return
+        self.busy_until = max(now, self.busy_until) + len(message)/self.rate
+        self.sent += len(message)
+        if self.rng.random() >= self.loss:
+            self.in_flight.append((self.busy_until, direction, message))
+
+    def receive(self, now):
+        arrived = [entry for entry in self.in_flight if entry[0] <= now]
+        self.in_flight = [entry for entry in self.in_flight if entry[0] > now]
+        return arrived
+
+def snapshots(seconds, seed=0):
+    """ (t, telem packet) at 5 Hz from a homing run, with the true bearing """
+    trace = []
+    scenario = sim.Scenario((60, 250), heading=120, current=(0.2, 0), seed=seed)
+    sim.simulate(scenario, duration=seconds, trace=trace)
+    beacon = sim.Beacon(*scenario.beacon)
+    packets = []
+    for t, x, y, heading, pitch, yaw in trace[::int(round(0.2/sim.DT))]:
+        bearing = beacon.relative_bearing(sim.Vessel(x, y, heading=heading))
+        packets.append((t, {"type": "telem", "heartbeat": int(t), "bearing": round(bearing, 1), "confident": True, "arm": True,
+                            "pidparams": [0.5, 0.05, 0.5], "effort(p,y)": [int(pitch), int(yaw)], "beacon": None}))
+    return packets
+
+def run(packets, rate, loss, adaptive, seed=0):
+    rng = random.Random(seed)
+    link = Link(rate, loss, rng)
+    encoder = telemetry.TelemetryEncoder()
+    decoder = telemetry.TelemetryDecoder()
+    shown = None                    # (time the packet was built, bearing) on the ground station
+    truth = None
+    errors, updates = [], 0
+    next_write = 0
+    index = 0
+    steps = int(packets[-1][0]/DT)
+    for step in range(steps):
+        now = step*DT
+        while index < len(packets) and packets[index][0] <= now:
+            truth = packets[index]
+            encoder.update(truth[1])
+            index += 1
+
+        if truth and now >= next_write:
+            if adaptive:
+                message = encoder.next_packet(now)
+                message = message and message + b'\n'
+                next_write = now + encoder.period()
+            else:
+                message = codec.encode_json(truth[1]) + b'\n'
+                next_write = now + 1
+            if message:
+                link.send(message, "down", now)
+
+        for arrival, direction, message in link.receive(now):
+            packet = codec.decode(message)
+            if direction == "up":
+                encoder.report(packet, now)
+                continue
+            state = decoder.apply(packet) if adaptive else packet
+            if state and (shown is None or state["bearing"] != shown[1]):
+                updates += 1
+            if state:
+                shown = (now, state["bearing"])
+            report = decoder.report(now) if adaptive else None
+            if report:
+                link.send(report + b'\n', "up", now)
+
+        if shown:
+            errors.append(abs(sim.wrap180(shown[1] - truth[1]["bearing"])))
+    seconds = steps*DT
+    return {"air B/s": link.sent/seconds, "dropped": link.dropped, "bearing updates/s": updates/seconds,
+            "bearing err rms": math.sqrt(sum(e*e for e in errors)/len(errors)),
+            "rate Hz": 1/encoder.period() if adaptive else 1}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--seconds", type=float, default=300)
+    args = parser.parse_args()
+
+    packets = snapshots(args.seconds)
+    columns = ["air B/s", "dropped", "bearing updates/s", "bearing err rms", "rate Hz"]
+    print("{:<30}".format("link") + "".join("{:>19}".format(c) for c in columns))
+    for rate, loss in ((300, 0), (300, 0.1), (300, 0.3), (120, 0), (60, 0.1)):
+        for adaptive in (False, True):
+            result = run(packets, rate, loss, adaptive)
+            name = "{} B/s, {:.0%} loss, {}".format(rate, loss, "delta" if adaptive else "full 1 Hz")
+            print("{:<30}".format(name) + "".join("{:>19.2f}".format(result[c]) for c in columns))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Cost of the ground station telemetry history: an append per received packet, and the data prepared for one frame of
+the plots (window, decimation, NaN breaks), over a session of several hours at the 5 Hz telemetry rate.
+Memory is compared with keeping every packet in a list, which grows for as long as the GUI runs.
+"""
+import sys
+import time
+import random
+import argparse
+import timeseries
+
+TELEM_RATE = 5          # Hz
+PLOT_SECONDS = 60
+PLOT_POINTS = 300
+
+def packets(count, seed=0):
+    rng = random.Random(seed)
+    for i in range(count):
+        yield {"type": "telem", "heartbeat": i//TELEM_RATE, "bearing": rng.choice([None, round(rng.uniform(-180, 180), 1)]),
+               "confident": True, "arm": True, "effort(p,y)": [rng.randint(-300, 0), rng.randint(-100, 100)],
+               "power": rng.randint(0, 60), "confidence": rng.randint(0, 30)}
+
+def list_size(history):
+    return sys.getsizeof(history) + sum(sys.getsizeof(p) + sum(sys.getsizeof(v) for v in p.values()) for p in history)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hours", type=float, default=4)
+    args = parser.parse_args()
+
+    count = int(args.hours*3600*TELEM_RATE)
+    stream = list(packets(count))
+    history = timeseries.TelemetryHistory()
+    kept = []
+    print("{:<8}{:>14}{:>14}{:>16}{:>16}".format("hours", "append us", "frame ms", "ring MB", "list MB"))
+    step = int(3600*TELEM_RATE)
+    for start in range(0, count, step):
+        chunk = stream[start:start + step]
+        started = time.perf_counter()
+        for i, packet in enumerate(chunk, start):
+            history.add(i/TELEM_RATE, packet)
+        append = (time.perf_counter() - started)/len(chunk)*1e6
+        kept.extend(chunk)
+
+        now = (start + len(chunk))/TELEM_RATE
+        frames = 50
+        started = time.perf_counter()
+        for frame in range(frames):
+            times, values = history.window(PLOT_SECONDS, now, PLOT_POINTS)
+            for name in timeseries.CHANNELS:
+                timeseries.segments(times - now, values[:, history.channel(name)])
+            timeseries.span(values[:, history.channel("power")], values[:, history.channel("confidence")])
+        frame_ms = (time.perf_counter() - started)/frames*1e3
+        ring = (history.times.nbytes + history.values.nbytes)/1e6
+        print("{:<8.0f}{:>14.2f}{:>14.3f}{:>16.2f}{:>16.2f}".format(now/3600, append, frame_ms, ring, list_size(kept)/1e6))
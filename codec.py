@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Wire format shared by gui.py, relayserver.py and autohoming.py
+telem, js, cmd and ack packets are packed into fixed struct frames: version byte, type byte, then the payload
+cmd and ack frames may end with a sequence number and the sender's session, decoders that predate them read the frame
+without them
+telem frames may end with the compass signal and the beacon estimate, flagged in the frame, the same way
+Packets of a given vehicle carry its id ("vid"): version 2 frames have it as a third header byte, JSON as a key
+Anything without a binary layout is sent as compact JSON, and JSON is always accepted on decode for older peers
+"""
+import re
+import json
+import struct
+
+VERSION = 1
+VERSION_VID = 2                         # same frames with the vehicle id in the header
+
+class DecodeError(ValueError):
+    pass
+
+HEADER = struct.Struct("<BB")          # version, type
+HEADER_VID = struct.Struct("<BBB")     # version, type, vehicle id
+
+TYPE_TELEM = 1
+TYPE_JS = 2
+TYPE_CMD = 3
+TYPE_ACK = 4
+TYPE_IDS = {"telem": TYPE_TELEM, "js": TYPE_JS, "cmd": TYPE_CMD, "ack": TYPE_ACK}
+TYPE_NAMES = {v: k for k, v in TYPE_IDS.items()}
+
+CMD_NAMES = ["arm", "tune", "threshold", "sync", "exit", "restart", "reboot", "cancel", "profile"]     # append only, the index is the wire id
+CMD_IDS = {name: i for i, name in enumerate(CMD_NAMES)}
+
+NO_BEARING = -32768                     # int16 sentinel for bearing = None
+TELEM = struct.Struct("<IhBfffhh")      # heartbeat, bearing*10, flags, Kp, Ki, Kd, effort pitch, effort yaw
+TELEM_CONFIDENT = 0x01
+TELEM_ARM = 0x02
+TELEM_SIGNAL = 0x04                     # SIGNAL follows
+TELEM_BEACON = 0x08                     # the packet has a beacon key, BEACON follows unless it is None
+SIGNAL = struct.Struct("<hh")           # power*10, confidence*10
+BEACON = struct.Struct("<iiH")          # lat*1e7, lon*1e7, std m*10
+TELEM_KEYS = {"type", "heartbeat", "bearing", "confident", "arm", "pidparams", "effort(p,y)", "power", "confidence", "beacon"}
+JS = struct.Struct("<hhhBB")            # 3 axes*1000, button count, button bitmask
+JS_AXES = 3
+CMD = struct.Struct("<B")               # command id, followed by the command parameters below
+ACK = struct.Struct("<B")               # command id
+SEQ = struct.Struct("<H")               # optional sequence number after a cmd frame's parameters or an ack's command id
+SESSION = struct.Struct("<H")           # optional session ("sid") after the sequence number, picked at each GUI start
+CMD_PARAMS = {
+    "tune": (struct.Struct("<fff"), ("Kp", "Ki", "Kd")),
+    "arm": (struct.Struct("<?"), ("arm",)),
+    "threshold": (struct.Struct("<hh"), ("power", "conf")),
+    "profile": (struct.Struct("<HH"), ("seconds", "rate")),     # 0 for the profiler's default
+}
+
+def _clamp16(value):
+    return max(-32767, min(32767, int(round(value))))
+
+def encode_json(packet):
+    return json.dumps(packet, separators=(',', ':')).encode()
+
+def _header(kind, vid):
+    if vid is None:
+        return HEADER.pack(VERSION, kind)
+    return HEADER_VID.pack(VERSION_VID, kind, vid)
+
+def _command_id(packet):
+    frame = b''
+    if packet.get("seq") is not None:
+        frame += SEQ.pack(packet["seq"])
+        if packet.get("sid") is not None:
+            frame += SESSION.pack(packet["sid"])
+    return frame
+
+def _read_command_id(packet, payload, offset):
+    if len(payload) >= offset + SEQ.size:
+        packet["seq"] = SEQ.unpack_from(payload, offset)[0]
+        offset += SEQ.size
+        if len(payload) >= offset + SESSION.size:
+            packet["sid"] = SESSION.unpack_from(payload, offset)[0]
+    return packet
+
+def encode(packet):
+    """ Pack a packet dict into bytes, binary when the type and keys are known, JSON otherwise """
+    try:
+        kind = packet.get("type")
+        vid = packet.get("vid")
+        keys = set(packet) - {"vid"}
+        if kind == "telem":
+            bearing = packet.get("bearing")
+            flags = (TELEM_CONFIDENT if packet.get("confident") else 0) | (TELEM_ARM if packet.get("arm") else 0)
+            Kp, Ki, Kd = packet.get("pidparams") or (0, 0, 0)
+            pitch, yaw = packet.get("effort(p,y)") or (0, 0)
+            beacon = packet.get("beacon")
+            tail = b''
+            if "power" in keys or "confidence" in keys:
+                flags |= TELEM_SIGNAL
+                tail += SIGNAL.pack(_clamp16((packet.get("power") or 0)*10), _clamp16((packet.get("confidence") or 0)*10))
+            if "beacon" in keys:
+                flags |= TELEM_BEACON
+                if beacon is not None:
+                    lat, lon, std = beacon
+                    tail += BEACON.pack(int(round(lat*1e7)), int(round(lon*1e7)), max(0, min(65535, int(round(std*10)))))
+            if keys <= TELEM_KEYS:
+                return _header(TYPE_TELEM, vid) + TELEM.pack(packet.get("heartbeat") or 0,
+                                                                     NO_BEARING if bearing is None else _clamp16(bearing*10),
+                                                                     flags, Kp or 0, Ki or 0, Kd or 0, _clamp16(pitch), _clamp16(yaw)) + tail
+
+        elif kind == "js":
+            axes = (list(packet.get("ax") or []) + [0]*JS_AXES)[:JS_AXES]
+            btns = list(packet.get("bt") or [])[:8]
+            mask = sum(1 << i for i, b in enumerate(btns) if b)
+            return _header(TYPE_JS, vid) + JS.pack(*[_clamp16(a*1000) for a in axes], len(btns), mask)
+
+        elif kind == "cmd" and packet.get("cmd") in CMD_IDS:
+            cmd = packet["cmd"]
+            layout, params = CMD_PARAMS.get(cmd, (None, ()))
+            if keys <= {"type", "cmd", "seq", "sid"} | set(params) and (packet.get("sid") is None or packet.get("seq") is not None):
+                frame = _header(TYPE_CMD, vid) + CMD.pack(CMD_IDS[cmd])
+                if layout:
+                    frame += layout.pack(*[packet.get(k) or 0 for k in params])
+                return frame + _command_id(packet)
+
+        elif kind == "ack" and packet.get("cmd") in CMD_IDS and keys <= {"type", "cmd", "seq", "sid"} \
+                and (packet.get("sid") is None or packet.get("seq") is not None):
+            return _header(TYPE_ACK, vid) + ACK.pack(CMD_IDS[packet["cmd"]]) + _command_id(packet)
+
+    except (TypeError, ValueError, struct.error):
+        pass
+
+    return encode_json(packet)
+
+def is_binary(message):
+    return len(message) >= HEADER.size and message[0] in (VERSION, VERSION_VID)
+
+def header_size(message):
+    return HEADER_VID.size if message[0] == VERSION_VID else HEADER.size
+
+def peek_type(message):
+    """ Packet type of a binary frame without decoding the payload, None for JSON """
+    if is_binary(message):
+        return TYPE_NAMES.get(message[1])
+    return None
+
+JSON_TYPE = re.compile(rb'"type"\s*:\s*"(\w+)"')
+JSON_CMD = re.compile(rb'"cmd"\s*:\s*"(\w+)"')
+
+def peek(message):
+    """ (type, cmd) routing key read from the frame header or the JSON text, without decoding the packet """
+    if is_binary(message):
+        kind = message[1]
+        size = header_size(message)
+        if kind in (TYPE_CMD, TYPE_ACK) and len(message) > size:
+            cmd = message[size]
+            return TYPE_NAMES[kind], CMD_NAMES[cmd] if cmd < len(CMD_NAMES) else None
+        return TYPE_NAMES.get(kind), None
+
+    match = JSON_TYPE.search(message)
+    if not match:
+        return None, None
+    kind = match.group(1).decode()
+    if kind in ("cmd", "ack"):
+        match = JSON_CMD.search(message)
+        return kind, match.group(1).decode() if match else None
+    return kind, None
+
+JSON_VID = re.compile(rb'"vid"\s*:\s*(\d+)')
+
+def peek_vid(message):
+    """ Vehicle id of a packet without decoding it, None when the packet names no vehicle """
+    if is_binary(message):
+        return message[2] if message[0] == VERSION_VID and len(message) >= HEADER_VID.size else None
+    match = JSON_VID.search(message)
+    return int(match.group(1)) if match else None
+
+def with_vid(message, vid):
+    """ The packet with its vehicle id set, without decoding a binary frame """
+    if is_binary(message):
+        return HEADER_VID.pack(VERSION_VID, message[1], vid) + message[header_size(message):]
+    return encode_json(dict(decode(message), vid=vid))
+
+def decode(message):
+    """ Unpack bytes into a packet dict, accepting both binary frames and JSON """
+    if not is_binary(message):
+        try:
+            packet = json.loads(message.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError) as msg:
+            raise DecodeError(msg)
+        if not isinstance(packet, dict):
+            raise DecodeError("Not a JSON object: {}".format(message))
+        return packet
+
+    try:
+        packet = _decode_frame(message)
+    except (struct.error, IndexError) as msg:
+        raise DecodeError("Truncated or corrupt frame: {}".format(msg))
+    if packet is None:
+        raise DecodeError("Unknown frame type {}".format(message[1]))
+    if message[0] == VERSION_VID:
+        packet["vid"] = message[2]
+    return packet
+
+def _decode_frame(message):
+    kind = message[1]
+    payload = memoryview(message)[header_size(message):]
+    if kind == TYPE_TELEM:
+        heartbeat, bearing, flags, Kp, Ki, Kd, pitch, yaw = TELEM.unpack_from(payload)
+        packet = {"type": "telem",
+                  "heartbeat": heartbeat,
+                  "bearing": None if bearing == NO_BEARING else bearing/10,
+                  "confident": bool(flags & TELEM_CONFIDENT),
+                  "arm": bool(flags & TELEM_ARM),
+                  "pidparams": [round(Kp, 6), round(Ki, 6), round(Kd, 6)],
+                  "effort(p,y)": [pitch, yaw]}
+        offset = TELEM.size
+        if flags & TELEM_SIGNAL:
+            power, confidence = SIGNAL.unpack_from(payload, offset)
+            packet["power"], packet["confidence"] = power/10, confidence/10
+            offset += SIGNAL.size
+        if flags & TELEM_BEACON:
+            packet["beacon"] = None
+            if len(payload) >= offset + BEACON.size:
+                lat, lon, std = BEACON.unpack_from(payload, offset)
+                packet["beacon"] = [round(lat/1e7, 7), round(lon/1e7, 7), std/10]
+        return packet
+
+    elif kind == TYPE_JS:
+        x, y, z, count, mask = JS.unpack_from(payload)
+        return {"type": "js", "ax": [x/1000, y/1000, z/1000], "bt": [(mask >> i) & 1 for i in range(count)]}
+
+    elif kind == TYPE_CMD:
+        cmd = CMD_NAMES[CMD.unpack_from(payload)[0]]
+        packet = {"type": "cmd", "cmd": cmd}
+        layout, keys = CMD_PARAMS.get(cmd, (None, ()))
+        offset = CMD.size
+        if layout:
+            values = layout.unpack_from(payload, offset)
+            packet.update((k, round(v, 6) if isinstance(v, float) else v) for k, v in zip(keys, values))
+            offset += layout.size
+        return _read_command_id(packet, payload, offset)
+
+    elif kind == TYPE_ACK:
+        packet = {"type": "ack", "cmd": CMD_NAMES[ACK.unpack_from(payload)[0]]}
+        return _read_command_id(packet, payload, ACK.size)
+
+    return None
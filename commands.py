@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Asynchronous command pipeline of the ground station
+A command is tagged with a sequence number, sent, and left in flight while the caller carries on. The ack naming the
+same sequence number completes it, so several commands can be in flight at once and a late ack of one is never taken
+for another. Commands also carry the session ("sid") picked at each start, the vehicle orders commands within a
+session only, since sequence numbers of different runs say nothing about which was sent last. A command without an ack is sent again after a timeout that doubles every try, and fails after MAX_TRIES.
+Results go back through the callback given with the command, called from the pipeline's threads.
+"""
+import time
+import random
+import threading
+import logging as log
+
+RETRY_TIMEOUT = 0.5     # s before the first retransmission over UDP, the LoRa link passes its own
+BACKOFF = 2             # timeout multiplier per try
+MAX_TRIES = 4
+SEQ_MODULO = 65536      # sequence numbers are 16 bit on the wire
+
+class Pending:
+    """ Convenient class for one command in flight """
+    def __init__(self, seq, packet, callback, now, timeout):
+        self.seq = seq
+        self.packet = packet
+        self.callback = callback
+        self.tries = 1
+        self.first_sent = now
+        self.timeout = timeout
+        self.next_try = now + timeout
+
+    @property
+    def cmd(self):
+        return self.packet["cmd"]
+
+    @property
+    def vid(self):
+        return self.packet.get("vid")
+
+    def from_vehicle(self, ack):
+        """ False for an ack of another vehicle, a command or ack naming no vehicle matches any """
+        return self.vid is None or ack.get("vid") is None or ack.get("vid") == self.vid
+
+class CommandPipeline:
+    """ Convenient class for sending commands without blocking, matching acks by sequence number and retransmitting """
+    def __init__(self, send, retry_timeout=RETRY_TIMEOUT, max_tries=MAX_TRIES, clock=time.monotonic):
+        self.send = send                    # called with each packet dict to transmit, from any thread
+        self.retry_timeout = retry_timeout
+        self.max_tries = max_tries
+        self.clock = clock
+        self.seq = random.randrange(SEQ_MODULO)
+        self.session = random.randrange(SEQ_MODULO)     # a restarted GUI does not take acks meant for its previous run
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.acked = 0
+        self.failed = 0
+        self.retransmissions = 0
+        self.stray_acks = 0
+
+    def submit(self, cmd, params={}, callback=None):
+        """ Send a command now and return its sequence number, callback(ok, pending, round trip s) is called once """
+        with self.condition:
+            self.seq = (self.seq + 1) % SEQ_MODULO
+            packet = {"type": "cmd", "cmd": cmd}
+            packet.update(params)
+            packet["seq"] = self.seq
+            packet["sid"] = self.session
+            pending = Pending(self.seq, packet, callback, self.clock(), self.retry_timeout)
+            self.pending[self.seq] = pending
+            self.condition.notify()
+        self.transmit(pending)
+        return pending.seq
+
+    def transmit(self, pending):
+        try:
+            self.send(pending.packet)
+        except OSError as msg:
+            log.error("Sending %s: %s", pending.cmd, msg)
+
+    def on_ack(self, packet):
+        """ Ack from the vehicle side, from the receiving thread """
+        with self.condition:
+            pending = self.pending.pop(packet.get("seq"), None)
+            session = packet.get("sid", self.session)       # relays and vehicles that predate sessions echo none
+            if pending is None or pending.cmd != packet.get("cmd") or session != self.session or not pending.from_vehicle(packet):
+                if pending:
+                    self.pending[pending.seq] = pending
+                self.stray_acks += 1        # duplicate ack of a retransmission, or an ack of another GUI or vehicle
+                return
+            self.acked += 1
+        self.complete(pending, True)
+
+    def complete(self, pending, ok):
+        if pending.callback:
+            try:
+                pending.callback(ok, pending, self.clock() - pending.first_sent)
+            except Exception as msg:
+                log.error("Command callback: %s", msg)
+
+    def poll(self, now=None):
+        """ Retransmit what is due and fail what ran out of tries, returns the time of the next deadline or None """
+        now = self.clock() if now is None else now
+        resend, failed = [], []
+        with self.condition:
+            for pending in list(self.pending.values()):
+                if now < pending.next_try:
+                    continue
+                if pending.tries >= self.max_tries:
+                    del self.pending[pending.seq]
+                    failed.append(pending)
+                else:
+                    pending.tries += 1
+                    pending.timeout *= BACKOFF
+                    pending.next_try = now + pending.timeout
+                    resend.append(pending)
+            self.retransmissions += len(resend)
+            self.failed += len(failed)
+            deadline = min((p.next_try for p in self.pending.values()), default=None)
+        for pending in resend:
+            log.debug("Retransmitting %s #%d, try %d", pending.cmd, pending.seq, pending.tries)
+            self.transmit(pending)
+        for pending in failed:
+            self.complete(pending, False)
+        return deadline
+
+    def run(self):
+        """ Retransmission thread, sleeps until the next command is due or a new one is submitted """
+        while not self.stop_event.is_set():
+            deadline = self.poll()
+            with self.condition:
+                timeout = None if deadline is None else max(0, deadline - self.clock())
+                if not self.pending or timeout:
+                    self.condition.wait(timeout if self.pending else 1)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+
+    def stats(self):
+        return {"in_flight": len(self.pending), "acked": self.acked, "failed": self.failed,
+                "retransmissions": self.retransmissions, "stray_acks": self.stray_acks}
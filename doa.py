@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Direction of arrival estimation from 4-channel IQ blocks, without the Hydra GUI
+Takes the array parameters from the KerberosSDR settings file and returns bearing, power and confidence
+All methods work on a batch of frames at once: iq has shape (frames, channels, samples)
+"""
+import json
+import numpy as np
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+SETTINGS = "settings.json.immutable"
+SPEED_OF_LIGHT = 299792458
+ARRANGEMENTS = ["ULA", "UCA"]       # order of ant_arrangement_index in the KerberosSDR GUI
+CHANNELS = 4
+
+def load_settings(path=SETTINGS):
+    with open(path) as f:
+        return json.load(f)
+
+def uca_positions(spacing, channels=CHANNELS):
+    """ (x, y) of each element in metres, neighbouring elements `spacing` apart, element 0 at bearing 0 """
+    radius = spacing / (2*np.sin(np.pi/channels))
+    angles = 2*np.pi*np.arange(channels)/channels
+    return radius*np.sin(angles), radius*np.cos(angles)
+
+def ula_positions(spacing, channels=CHANNELS):
+    return spacing*np.arange(channels), np.zeros(channels)
+
+class DOAEngine:
+    """ Convenient class for batched Bartlett / Capon / MUSIC estimation over a precomputed steering matrix """
+    def __init__(self, center_freq, spacing, arrangement="UCA", methods=("MUSIC",), fbavg=False, resolution=1, channels=CHANNELS):
+        """ center_freq in MHz and spacing in metres, as they appear in the settings file """
+        if not methods:
+            raise ValueError("At least one DOA method must be enabled")
+        self.methods = tuple(methods)
+        self.fbavg = fbavg
+        self.channels = channels
+        self.angles = np.arange(0, 360, resolution, dtype=float)
+
+        wavelength = SPEED_OF_LIGHT / (float(center_freq)*1e6)
+        if arrangement == "UCA":
+            x, y = uca_positions(float(spacing), channels)
+        else:
+            x, y = ula_positions(float(spacing), channels)
+        theta = np.deg2rad(self.angles)
+        # phase of a plane wave arriving from bearing theta at each element, shape (channels, angles)
+        delay = np.outer(x, np.sin(theta)) + np.outer(y, np.cos(theta))
+        self.steering = np.exp(2j*np.pi*delay/wavelength)
+        self.exchange = np.eye(channels)[::-1]
+
+    @classmethod
+    def from_settings(cls, settings):
+        methods = [name for key, name in (("en_bartlett", "Bartlett"), ("en_capon", "Capon"), ("en_MUSIC", "MUSIC")) if settings.get(key)]
+        return cls(center_freq=settings["center_freq"],
+                   spacing=settings["ant_spacing"],
+                   arrangement=ARRANGEMENTS[int(settings.get("ant_arrangement_index", 1))],
+                   methods=methods or ["MUSIC"],
+                   fbavg=bool(settings.get("en_fbavg")))
+
+    def covariance(self, iq):
+        """ Sample covariance of each frame, shape (frames, channels, channels) """
+        iq = np.asarray(iq)
+        if iq.ndim == 2:
+            iq = iq[np.newaxis]
+        R = (iq @ iq.conj().swapaxes(1, 2)) / iq.shape[-1]
+        if self.fbavg:
+            R = 0.5*(R + self.exchange @ R.conj() @ self.exchange)
+        return R
+
+    def bartlett(self, R):
+        return np.einsum("mk,fmn,nk->fk", self.steering.conj(), R, self.steering).real
+
+    def capon(self, R):
+        loading = 1e-6*np.trace(R, axis1=1, axis2=2).real[:, np.newaxis, np.newaxis]/self.channels
+        Rinv = np.linalg.inv(R + loading*np.eye(self.channels))
+        return 1/np.einsum("mk,fmn,nk->fk", self.steering.conj(), Rinv, self.steering).real
+
+    def music(self, R, sources=1):
+        _, vectors = np.linalg.eigh(R)                  # eigenvalues ascending, so noise subspace comes first
+        noise = vectors[:, :, :self.channels-sources]
+        projection = np.einsum("fmn,mk->fnk", noise.conj(), self.steering)
+        return 1/np.sum(np.abs(projection)**2, axis=1)
+
+    def spectrum(self, R):
+        """ Sum of the enabled spectra, each normalised to a peak of 1, shape (frames, angles) """
+        combined = 0
+        for method in self.methods:
+            P = getattr(self, method.lower())(R)
+            combined = combined + P/np.max(P, axis=1, keepdims=True)
+        return combined/len(self.methods)
+
+    def estimate(self, iq):
+        """ Returns (bearing in degrees, power in dB, confidence in dB), each with shape (frames,) """
+        R = self.covariance(iq)
+        P = self.spectrum(R)
+        peak = np.argmax(P, axis=1)
+        bearing = self.angles[peak]
+        confidence = 10*np.log10(P[np.arange(len(peak)), peak]/np.mean(P, axis=1))
+        power = 10*np.log10(np.trace(R, axis1=1, axis2=2).real/self.channels + 1e-12)
+        return bearing, power, confidence
+
+def synthetic_iq(engine, bearing, frames=1, samples=1024, snr=10, rng=None):
+    """ Narrowband source from `bearing` degrees plus white noise at `snr` dB, shape (frames, channels, samples) """
+    rng = rng or np.random.default_rng()
+    k = int(np.argmin(np.abs(engine.angles - bearing % 360)))
+    source = np.exp(2j*np.pi*rng.random((frames, 1, samples)))
+    noise = (rng.standard_normal((frames, engine.channels, samples)) + 1j*rng.standard_normal((frames, engine.channels, samples)))/np.sqrt(2)
+    return (10**(snr/20)*engine.steering[:, k][np.newaxis, :, np.newaxis]*source + noise).astype(np.complex64)
+
+
+if __name__ == "__main__":
+    engine = DOAEngine.from_settings(load_settings())
+    iq = synthetic_iq(engine, 123, frames=4)
+    for bearing, power, confidence in zip(*engine.estimate(iq)):
+        log.info("Bearing: %d\tPower: %.1f\tConfidence: %.1f", bearing, power, confidence)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Per vehicle state of the ground station
+Every packet from the relays names the vehicle it comes from ("vid"), the fleet keeps the latest telemetry, the plot
+history and the time last heard of each one, so the GUI shows and commands one vehicle while tracking all of them.
+Packets naming no vehicle (the LORA link, older relays) are kept under None.
+"""
+import timeseries
+
+LOST_AFTER = 3          # s without telemetry before a vehicle is shown as lost
+
+class Vehicle:
+    """ Convenient class for what the ground station knows of one vehicle """
+    def __init__(self, vid, capacity=timeseries.CAPACITY):
+        self.vid = vid
+        self.history = timeseries.TelemetryHistory(capacity)
+        self.telem = None           # latest telemetry packet
+        self.last_seen = None       # receive time of the latest packet
+        self.packets = 0
+
+    def add(self, t, packet):
+        self.history.add(t, packet)
+        self.telem = packet
+        self.last_seen = t
+        self.packets += 1
+
+    def lost(self, now):
+        return self.last_seen is None or now - self.last_seen > LOST_AFTER
+
+    def status(self, now):
+        if self.lost(now):
+            return "{}: lost".format(self.vid)
+        return "{}: {}".format(self.vid, "armed" if self.telem.get("arm") else "disarmed")
+
+class Fleet:
+    """ Convenient class for the vehicles heard so far, by id """
+    def __init__(self, capacity=timeseries.CAPACITY):
+        self.capacity = capacity
+        self.vehicles = {}
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def __getitem__(self, vid):
+        return self.vehicles[vid]
+
+    def get(self, vid):
+        """ The vehicle of this id, created the first time it is heard """
+        vehicle = self.vehicles.get(vid)
+        if vehicle is None:
+            vehicle = self.vehicles[vid] = Vehicle(vid, self.capacity)
+        return vehicle
+
+    def add(self, t, packet):
+        """ Telemetry packet received at t, returns its vehicle """
+        vehicle = self.get(packet.get("vid"))
+        vehicle.add(t, packet)
+        return vehicle
+
+    def ids(self):
+        return sorted(self.vehicles, key=lambda vid: -1 if vid is None else vid)
+
+    def status(self, now):
+        return " | ".join(self.vehicles[vid].status(now) for vid in self.ids())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Flight recorder: every inbound UDP packet, every MANUAL_CONTROL effort sent and every Pixhawk heartbeat,
+appended with a monotonic timestamp to a preallocated memory-mapped ring file
+The file is a fixed header followed by a ring of variable length records. When the ring is full the oldest
+records are overwritten, so the file keeps the most recent runs and never grows.
+Replay feeds the recorded UDP packets back into their ports (5001-5004) at 1x or Nx speed.
+"""
+import os
+import sys
+import mmap
+import time
+import socket
+import struct
+import argparse
+import threading
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+RECORD_FILE = "flight.rec"
+RECORD_SIZE = 64*1024*1024      # bytes, preallocated once
+MAGIC = b"FREC"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHQQQQQ")   # magic, version, reserved, capacity, head, tail, end of data before the wrap, records held
+RECORD = struct.Struct("<dBHH")         # monotonic time, kind, port, payload length
+
+""" Record kinds """
+RUN = 1             # start of a recording, payload is the wall clock time as a double
+PACKET = 2          # inbound UDP packet, port is the local port it arrived on
+EFFORT = 3          # MANUAL_CONTROL sent, payload pitch and yaw
+HEARTBEAT = 4       # Pixhawk heartbeat, payload system status, base mode, custom mode
+KIND_NAMES = {RUN: "run", PACKET: "packet", EFFORT: "effort", HEARTBEAT: "heartbeat"}
+
+EFFORT_PAYLOAD = struct.Struct("<hh")
+HEARTBEAT_PAYLOAD = struct.Struct("<BBI")
+RUN_PAYLOAD = struct.Struct("<d")
+
+REPLAY_PORTS = range(5001, 5005)        # kerberos, joystick, cmd, vision
+LOCALHOST = "127.0.0.1"
+
+class FlightRecorder:
+    """
+    Convenient class for appending records to the ring file
+    Writes are a struct pack into the mapping, the kernel writes the pages back, so a crash loses nothing already appended
+    """
+    def __init__(self, path=RECORD_FILE, size=RECORD_SIZE):
+        self.mutex = threading.Lock()       # the MANUAL_CONTROL streamer appends from its own thread
+        new = not os.path.exists(path) or os.path.getsize(path) != size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if new:
+            os.ftruncate(self.fd, size)
+            try:
+                os.posix_fallocate(self.fd, 0, size)    # reserve the blocks now rather than on first write
+            except (AttributeError, OSError):
+                pass
+        self.map = mmap.mmap(self.fd, size)
+        self.capacity = size - HEADER.size
+
+        magic, version, _, capacity, head, tail, end, records = HEADER.unpack_from(self.map)
+        if new or magic != MAGIC or version != VERSION or capacity != self.capacity:
+            head = tail = end = records = 0
+        self.head, self.tail, self.end, self.records = head, tail, end, records
+        self.write_header()
+        self.append(RUN, 0, RUN_PAYLOAD.pack(time.time()))
+
+    def write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, 0, self.capacity, self.head, self.tail, self.end, self.records)
+
+    def record_size(self, offset):
+        return RECORD.size + RECORD.unpack_from(self.map, HEADER.size + offset)[3]
+
+    def make_room(self, start, size):
+        """ Drop the oldest records overlapping [start, start + size) """
+        while self.records and start <= self.tail < start + size:
+            self.tail += self.record_size(self.tail)
+            self.records -= 1
+            if self.tail >= self.end:
+                self.tail = 0           # oldest record is now the first one after the wrap
+
+    def append(self, kind, port, payload=b''):
+        size = RECORD.size + len(payload)
+        if size > self.capacity:
+            return
+        with self.mutex:
+            if self.map.closed:
+                return
+            start = self.head
+            if start + size > self.capacity:
+                # no room before the end of the ring, mark where the data stops and wrap
+                self.make_room(start, self.capacity - start)
+                self.end = start
+                start = 0
+            self.make_room(start, size)
+            if self.records == 0:
+                self.tail = start
+
+            offset = HEADER.size + start
+            RECORD.pack_into(self.map, offset, time.monotonic(), kind, port, len(payload))
+            self.map[offset + RECORD.size:offset + size] = payload
+            self.head = start + size
+            if self.head > self.end:
+                self.end = self.head
+            self.records += 1
+            self.write_header()
+
+    """ Hooks for the control software """
+    def packet(self, port, message):
+        self.append(PACKET, port, message)
+
+    def effort(self, pitch, yaw):
+        self.append(EFFORT, 0, EFFORT_PAYLOAD.pack(int(pitch), int(yaw)))
+
+    def heartbeat(self, message):
+        """ Pixhawk HEARTBEAT subscriber """
+        self.append(HEARTBEAT, 0, HEARTBEAT_PAYLOAD.pack(message.system_status, message.base_mode, message.custom_mode))
+
+    def close(self):
+        with self.mutex:
+            self.map.flush()
+            self.map.close()
+            os.close(self.fd)
+
+def read_records(path=RECORD_FILE):
+    """ Yield (time, kind, port, payload) from the oldest record to the newest """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, capacity, head, tail, end, records = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a flight record".format(path))
+
+    offset = tail
+    for i in range(records):
+        if offset >= end:
+            offset = 0
+        t, kind, port, length = RECORD.unpack_from(data, HEADER.size + offset)
+        start = HEADER.size + offset + RECORD.size
+        yield t, kind, port, bytes(data[start:start + length])
+        offset += RECORD.size + length
+
+def runs(path=RECORD_FILE):
+    """ Split the records into recordings, each a list starting with its RUN record """
+    recording = None
+    for record in read_records(path):
+        if record[1] == RUN:
+            recording = [record]
+            yield recording
+        elif recording is not None:
+            recording.append(record)
+
+def describe(record):
+    t, kind, port, payload = record
+    if kind == RUN:
+        detail = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(RUN_PAYLOAD.unpack(payload)[0]))
+    elif kind == EFFORT:
+        detail = "pitch {} yaw {}".format(*EFFORT_PAYLOAD.unpack(payload))
+    elif kind == HEARTBEAT:
+        detail = "status {} base mode {} custom mode {}".format(*HEARTBEAT_PAYLOAD.unpack(payload))
+    else:
+        detail = "port {} {}".format(port, payload)
+    return "{:.3f}\t{}\t{}".format(t, KIND_NAMES.get(kind, kind), detail)
+
+def replay(records, speed=1, host=LOCALHOST, ports=REPLAY_PORTS):
+    """ Send the recorded UDP packets back to their ports, keeping their timing divided by speed (0 for no waiting) """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    origin = start = None
+    sent = 0
+    for t, kind, port, payload in records:
+        if kind != PACKET or port not in ports:
+            continue
+        if origin is None:
+            origin, start = t, time.monotonic()
+        if speed:
+            delay = start + (t - origin)/speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        sock.sendto(payload, (host, port))
+        sent += 1
+    return sent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["list", "dump", "replay"])
+    parser.add_argument("--file", default=RECORD_FILE)
+    parser.add_argument("--run", type=int, default=-1, help="recording to dump or replay, negative counts from the latest")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed multiplier, 0 sends as fast as possible")
+    parser.add_argument("--host", default=LOCALHOST, help="where the control software listens")
+    args = parser.parse_args()
+
+    recordings = list(runs(args.file))
+    if not recordings:
+        log.error("No recording in %s", args.file)
+        sys.exit(1)
+
+    if args.action == "list":
+        for i, recording in enumerate(recordings):
+            print("{}\t{}\t{} records\t{:.1f} s".format(i, describe(recording[0]).split("\t")[2], len(recording),
+                                                       recording[-1][0] - recording[0][0]))
+    elif args.action == "dump":
+        for record in recordings[args.run]:
+            print(describe(record))
+    else:
+        started = time.monotonic()
+        sent = replay(recordings[args.run], args.speed, args.host)
+        log.info("Replayed %d packets in %.1f s", sent, time.monotonic() - started)
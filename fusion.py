@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Heading-aided bearings between radio compass updates
+The Pixhawk heading (ATTITUDE, or VFR_HUD when ATTITUDE is not streamed) turns every bearing into a world frame
+bearing when it arrives. On each new heading the world bearings are turned back into fresh relative bearings,
+so the controller sees the boat's own yaw at the autopilot's attitude rate instead of waiting for the next DOA fix.
+"""
+import math
+import time
+from pymavlink import mavutil
+import logging as log
+
+ATTITUDE_RATE = 20          # Hz requested from the autopilot
+HEADING_TIMEOUT = 1         # s, VFR_HUD is only used when no ATTITUDE came for this long
+
+class HeadingFusion:
+    """ Convenient class feeding the autopilot heading to the bearing receivers and signalling a fresh bearing """
+    def __init__(self, receivers, clock=time.monotonic):
+        self.receivers = receivers          # objects with predict(heading), e.g. RadioCompass and Vision
+        self.clock = clock
+        self.heading = None                 # degrees clockwise from north
+        self.attitude_time = None
+        self.updates = 0
+        self.on_update = None               # called after each new heading, e.g. to trigger a control step
+
+    def attach(self, pixhawk, rate=ATTITUDE_RATE):
+        """ Subscribe to the heading messages and ask the autopilot to stream ATTITUDE at rate. Returns the request future """
+        pixhawk.subscribe('ATTITUDE', self.on_attitude)
+        pixhawk.subscribe('VFR_HUD', self.on_vfr_hud)
+        return pixhawk.command(mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE, 1e6/rate)
+
+    def on_attitude(self, message):
+        self.attitude_time = self.clock()
+        self.update(math.degrees(message.yaw) % 360)
+
+    def on_vfr_hud(self, message):
+        if self.attitude_time is None or self.clock() - self.attitude_time > HEADING_TIMEOUT:
+            self.update(message.heading % 360)
+
+    def update(self, heading):
+        if self.heading is None:
+            log.info("Heading aiding on, first heading %.0f deg", heading)
+        self.heading = heading
+        self.updates += 1
+        for receiver in self.receivers:
+            receiver.predict(heading)
+        if self.on_update:
+            self.on_update()
@@ -7,7 +7,14 @@ import socket
 import signal
 import atexit
 import PySimpleGUI as sg
-import json
+import codec
+import telemetry
+import lora_link
+import timeseries
+from fleet import Fleet
+from commands import CommandPipeline
+from joystick_stream import JoystickStream
+import queue
 import threading
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.DEBUG)
@@ -29,84 +36,57 @@ Setup LORA UART
 lora_unavailable = True
 DEVICE = "/dev/serial/by-id/usb-FTDI_FT232R_USB_UART_AB0LNG4V-if00-port0"       # requires platformio UDEV
 BAUD = 115200    # baud of LORA UART
+LORA_RETRY_TIMEOUT = 2.5   # s before a command is sent again, a turn of the half duplex link can take a second
+LORA_MAX_TRIES = 3
 
 class Lora:
     def __init__(self):
         global lora_unavailable
-        self.telem_packet = None
-        self.read_mutex = threading.Lock()   # mutex to make sure ack won't be consumed by another thread
-        self.send_mutex = threading.Lock()   # mutex to make sure only one command is being sent when waiting for ack
+        self.telem_queue = queue.SimpleQueue()      # (receive time, telem packet), drained by the render loop
+        self.telem = telemetry.TelemetryDecoder()     # rebuilds the full state from the keyframes and deltas the relay sends
         self.js_signal = threading.Event()
+        self.js_stream = JoystickStream(self.send_joystick)
+        self.vehicle = None     # the relay at the other end of the radio serves its default vehicle
         try:
-            self.ser = serial.Serial(DEVICE, BAUD, timeout=2)
+            self.ser = serial.Serial(DEVICE, BAUD, timeout=lora_link.TICK)
             time.sleep(1)   # a bug in pyserial requires to wait a little before it can be used (or flush)
             self.ser.reset_input_buffer()
+            self.link = lora_link.LoraLink(self.ser, master=True, on_receive=self.receive)     # takes turns with the relay, the radios are half duplex
+            self.commands = CommandPipeline(self.send_packet, LORA_RETRY_TIMEOUT, LORA_MAX_TRIES).start()
             lora_unavailable = False
         except Exception as msg:
             log.warning("Lora UART module not available, LORA option disabled\n")
             # log.error(msg)
 
 
-    def send_command(self, cmd, params={}, signal=True):
-        try:
-
-            tries = 3
-            packet = {}
-            # Reducing message size to save serial bandwidth
-            # packet["origin"] = WHOAMI
-            # packet["target"] = TARGET
-            packet["type"] = "cmd"
-            packet["cmd"] = cmd
-            packet.update(params)
-            message = json.dumps(packet, separators=(',', ':')) + '\n'
-            # log.debug("Sending: %s", message)
-
-            self.read_mutex.acquire()
-            self.send_mutex.acquire()
-            self.ser.reset_input_buffer()
-
-            if signal:
-                reply = None
-                for i in range (tries):
-                    if reply == b'\n':
-                        break
-                    else:
-                        self.ser.write(b'\n')        # empty message to signal real messages coming next
-                        reply = self.get_feedback(label="Handshake")
+    def send_command(self, cmd, params={}, callback=None):
+        """ Send to the selected vehicle without waiting, callback(ok, pending, round trip s) reports the ack or the last try failing """
+        return self.commands.submit(cmd, with_vehicle(params, self.vehicle), callback)
 
-            self.ser.write(message.encode())
-            packet = self.get_feedback("ack", label="Ack")
+    def send_packet(self, packet):
+        # Reducing message size to save serial bandwidth
+        # packet["origin"] = WHOAMI
+        # packet["target"] = TARGET
+        self.link.send(codec.encode_json(packet), lora_link.COMMAND)     # LORA UART is newline framed, keep it JSON
 
-            self.read_mutex.release()
-            self.send_mutex.release()
-
-            if packet and packet.get("cmd") == cmd:
-                log.info("Command was acknowleged properly.")
-                return True
-            else:
-                log.warning("Command was not acknowleged properly.")
-                return False
-
-        except TypeError as msg:
-            log.error(msg)
-        
-    def get_feedback(self, type="raw", label="Serial"):
+    def receive(self, message):
+        """ Payload of every LORA frame, from the link thread """
         try:
-            message = self.ser.readline()
-            if message:
-                log.debug(message)
-                if type == "raw":
-                    return message
-                else:
-                    packet = json.loads(message.decode())
-                    if packet.get("type") == type:
-                        return packet
-            else:
-                log.debug("%s read timed out.", label)
-
-        except UnicodeDecodeError:
-            log.error("Gargabe characters received: %s", message)
-        except json.JSONDecodeError:
+            log.debug(message)
+            packet = codec.decode(message)
+            if packet.get("type") in (telemetry.TYPE_KEYFRAME, telemetry.TYPE_DELTA):
+                packet = self.telem.apply(packet)
+                if packet:
+                    self.telem_queue.put((time.monotonic(), packet))
+                report = self.telem.report()
+                if report:
+                    self.link.send(report, lora_link.TELEMETRY, replace=True)     # goes back with the token
+            elif packet.get("type") == "ack":
+                self.commands.on_ack(packet)
+            elif packet.get("type") == "job":
+                log_job(packet)
+
+        except codec.DecodeError:
             # log.debug("Packet received corrupted")
             pass
         except Exception as msg:
@@ -122,40 +102,27 @@ class Lora:
             packet["type"] = "js"
             packet["ax"] = [round(num, 3) for num in axes[0:3]]      # only need 3 axes, with 3 decimal places
             packet["bt"] = btns[0:2]      # only need 2 buttons
-            message = json.dumps(packet) + '\n'
+            message = codec.encode_json(with_vehicle(packet, self.vehicle))
             # log.debug("Sending: %s", message)
-            self.ser.write(message.encode())
+            self.link.send(message, lora_link.JOYSTICK, replace=True)     # only the latest stick position is worth airtime
 
         except TypeError as msg:
             log.error(msg)
 
     
     def get_feedback_thread(self):
-        while(1):
-            self.read_mutex.acquire()
-            self.telem_packet = self.get_feedback("telem", label="Telem")
-            self.read_mutex.release()
-
-            time.sleep(1)
+        self.link.run()
 
     def joystick_thread(self):
         if js_unavailable:
             return
 
         log.info("Hold LT and use left joystick to control.")
-        
-        while True:
-            self.js_signal.wait()
-            joy.joystick_update()
-            self.send_mutex.acquire()
-            self.send_joystick(joy.axes, joy.btns)
-            self.send_mutex.release()
-            time.sleep(0.2)
+        stream_joystick(self)
 
     def close(self):
-        self.read_mutex.acquire()    # lock read threads
-        self.send_mutex.acquire()    # lock write threads
-        # ser.write(b"\n")
+        self.commands.stop()
+        self.link.stop()
         self.ser.close()
 
 lora = Lora()
@@ -170,10 +137,12 @@ PORT_RELAY = 5000
 
 class UDP:
     def __init__(self):
-        self.telem_packet = None
+        self.telem_queue = queue.SimpleQueue()      # (receive time, telem packet), drained by the render loop
         self.js_signal = threading.Event()
-        self.read_mutex = threading.Lock()   # mutex to make sure ack won't be consumed by another thread
-        self.send_mutex = threading.Lock()   # mutex to make sure only one command is being sent when waiting for ack
+        self.js_stream = JoystickStream(self.send_joystick)
+        self.commands = CommandPipeline(self.send_packet).start()       # acks come back through the feedback thread
+        self.vehicle = None     # vid commands and joystick go to, None until a vehicle is heard
+        self.relays = {}        # vid -> address of the relay serving it, written by the feedback thread
 
         try:
             self.sock = socket.socket(socket.AF_INET,   # Internet
@@ -185,52 +154,23 @@ class UDP:
         except Exception as msg:
             log.error(msg)
 
-    def send_command(self, cmd, params={}, signal=True):
-        try:
-            tries = 3
-            packet = {}
-            packet["type"] = "cmd"
-            packet["cmd"] = cmd
-            packet.update(params)
-            message = json.dumps(packet, separators=(',', ':')) + '\n'
-            # log.debug("Sending: %s", message)
+    def send_command(self, cmd, params={}, callback=None):
+        """
+        Send to the selected vehicle without waiting, callback(ok, pending, round trip s) reports the ack or the last try failing
+        Nothing is sent before a vehicle is selected, every relay on the network would apply a command naming none
+        """
+        if self.vehicle is None:
+            log.warning("No vehicle selected yet, %s not sent", cmd)
+            return None
+        return self.commands.submit(cmd, with_vehicle(params, self.vehicle), callback)
 
-            self.send_mutex.acquire()
-            self.read_mutex.acquire()
-            # old_timeout = self.sock.gettimeout()
-            # self.sock.settimeout(1)
-         
-            if signal:
-                reply = None
-                self.sock.sendto(b'\n', (IP_BROADCAST, PORT_RELAY))        # empty message to signal real messages coming next
-                for i in range(tries):
-                    if reply == b'\n':
-                        break
-                    else:
-                       reply = self.get_feedback(label="Handshake")
-            
-            self.sock.sendto(message.encode(), (IP_BROADCAST, PORT_RELAY))            
-            reply = self.get_feedback("ack", label="Ack")
-                
-            # self.sock.settimeout(old_timeout)
-            # self.send_mutex.release()
-            # self.read_mutex.release()
-            
+    def relay(self, vid):
+        """ Address of the relay of a vehicle, broadcast until it has been heard """
+        return (self.relays.get(vid, IP_BROADCAST), PORT_RELAY)
 
-            if reply and reply.get("cmd") == cmd:
-                log.info("Command was acknowleged properly.")
-                return True
-            else:
-                log.warning("Command was not acknowleged properly.")
-                return False
+    def send_packet(self, packet):
+        self.sock.sendto(codec.encode(packet), self.relay(packet.get("vid")))
 
-        except TypeError as msg:
-            log.error(msg)
-        finally:
-            # self.sock.settimeout(old_timeout)
-            self.send_mutex.release()
-            self.read_mutex.release()
-         
     def send_joystick(self, axes, btns):
         try:
             packet = {}
@@ -238,34 +178,36 @@ class UDP:
             # packet["origin"] = WHOAMI
             # packet["target"] = TARGET
             packet["type"] = "js"
-            packet["ax"] = [round(num, 3) for num in axes[0:3]]      # only need 3 axes, with 3 decimal places
+            packet["ax"] = axes[0:3]      # only need 3 axes, the codec keeps 3 decimal places
             packet["bt"] = btns[0:2]      # only need 2 buttons
-            message = json.dumps(packet) + '\n'
+            vid = self.vehicle
+            if vid is None:
+                return      # no vehicle selected, see send_command
+            message = codec.encode(with_vehicle(packet, vid))
             log.debug("Sending: %s", message)
-            self.sock.sendto(message.encode(), (IP_BROADCAST, PORT_RELAY))  
+            self.sock.sendto(message, self.relay(vid))
 
         except TypeError as msg:
             log.error(msg)   
      
-    def get_feedback(self, type="raw", label="UDP"):
+    def receive(self):
         try:
             message, addr = self.sock.recvfrom(1024)
-            if message:
-                log.debug(message)
-                if type == "raw":
-                    return message
-                else:
-                    packet = json.loads(message.decode())
-                    if packet.get("type") == type:
-                        return packet
-            else:
-                log.debug("%s read timed out.", label)
+            if message and message != b'\n':       # the relay still answers the handshake of older GUIs
+                packet = codec.decode(message)
+                if packet.get("vid") is not None:
+                    self.relays[packet["vid"]] = addr[0]
+                if packet.get("type") == "telem":
+                    self.telem_queue.put((time.monotonic(), packet))
+                elif packet.get("type") == "ack":
+                    log.debug(message)
+                    self.commands.on_ack(packet)
+                elif packet.get("type") == "job":
+                    log_job(packet)
 
         except socket.timeout:
-            log.debug("%s read timed out.", label)
-        except UnicodeDecodeError:
-            log.error("Gargabe characters received: %s", message)
-        except json.JSONDecodeError:
+            pass
+        except codec.DecodeError:
             # log.debug("Packet received corrupted")
             pass
         except Exception as msg:
@@ -273,28 +215,50 @@ class UDP:
 
     def get_feedback_thread(self):
         while(1):
-            self.read_mutex.acquire()
-            self.telem_packet = self.get_feedback("telem", label="Telem")
-            self.read_mutex.release()
-            time.sleep(0.1)
+            self.receive()      # no lock held while blocking, telemetry and acks are never held back by each other
 
     def joystick_thread(self):
         if js_unavailable:
             return
 
         log.info("Hold LT and use left joystick to control.")
-        
-        while True:
-            self.js_signal.wait()
-            joy.joystick_update()
-            self.send_joystick(joy.axes, joy.btns)
-            time.sleep(0.1)
+        stream_joystick(self)
 
 udp = UDP()
 
 """
 Helper functions
 """
+def with_vehicle(packet, vid):
+    """ The packet addressed to vehicle vid, as is for None """
+    if vid is None:
+        return packet
+    return dict(packet, vid=vid)
+
+def log_job(packet):
+    """ Output and state changes of sync/restart jobs running on the Pi """
+    if packet.get("state") == "refused":
+        log.warning("Job %s refused: %s", packet.get("job"), packet.get("line"))
+    elif packet.get("line") is not None:
+        log.info("%s: %s", packet.get("job"), packet.get("line"))
+    else:
+        log.info("Job %s %s", packet.get("job"), packet.get("state"))
+
+def stream_joystick(comm):
+    """ Joystick thread: a packet on every input change while the joystick is enabled, keepalives in between """
+    stream = comm.js_stream
+    while True:
+        if not comm.js_signal.is_set():
+            comm.js_signal.wait()
+            joy.joystick_update()       # start from the current state, whatever moved while disabled
+            stream.reset()
+            stream.update(joy.axes, joy.btns)
+        deadline = stream.deadline()
+        if joy.wait_input(None if deadline is None else max(0, deadline - time.monotonic())) and comm.js_signal.is_set():
+            stream.update(joy.axes, joy.btns, joy.last_event)
+        if comm.js_signal.is_set():
+            stream.poll()
+
 def update_gui(window, packet):
     try:
         window["heartbeat"].update(packet.get("heartbeat"))
@@ -305,13 +269,42 @@ def update_gui(window, packet):
         window["confident"].update(packet.get("confident"))
         window["vision"].update(packet.get("vision"))
         window["distance"].update(packet.get("distance"))
+        beacon = packet.get("beacon")
+        window["beacon"].update("{:.6f}, {:.6f} +-{} m".format(*beacon) if beacon else None)
     except TypeError as msg:
         log.debug(msg)
+
+def draw_plots(window, history, now):
+    """ Redraw the time series of the last PLOT_SECONDS, x in seconds before now """
+    times, values = history.window(PLOT_SECONDS, now, PLOT_POINTS)
+    times = times - now
+    for key, (lines, limits) in PLOTS.items():
+        graph = window[key]
+        columns = [values[:, history.channel(name)] for name, colour in lines]
+        if limits is None:
+            limits = timeseries.span(*columns)
+            if limits:
+                graph.change_coordinates((-PLOT_SECONDS, limits[0]), (0, limits[1]))
+        graph.erase()
+        graph.draw_line((-PLOT_SECONDS, 0), (0, 0), color="gray")
+        for (name, colour), column in zip(lines, columns):
+            for run in timeseries.segments(times, column):
+                graph.draw_lines(run, color=colour)
     
 
 """ 
 Setup main GUI window 
 """
+RENDER_FPS = 10         # widgets and plots are redrawn at this rate, whatever the telemetry rate
+PLOT_SECONDS = 60       # history shown in the plots, the ring buffers hold timeseries.CAPACITY samples
+PLOT_SIZE = (300, 120)  # pixels
+PLOT_POINTS = 300       # points drawn per line at most, about one per pixel
+PLOTS = {               # graph key: ((channel, colour), ...), fixed y range or None to follow the data
+    "plot_bearing": ((("bearing", "red"),), (-180, 180)),
+    "plot_effort": ((("pitch", "cyan"), ("yaw", "yellow")), (-1000, 1000)),
+    "plot_signal": ((("power", "orange"), ("confidence", "green")), None),
+}
+
 demo_mode = False
 sg.ChangeLookAndFeel("Black")
 
@@ -319,9 +312,13 @@ layout = [
           [sg.Button("Calibrate"), sg.Frame("!!!CRITICAL!!!", [[sg.Text("Calibration is required everytime WaterPi software has been reset.\n"
                                                                          "Make sure that either all antennas (including cables) are disconnected,\n"
                                                                          "or all nearby beacons transmitting around 121.65Mhz are off before calibrating.")]])],
+          [sg.Text("Vehicle"), sg.Combo([], size=(6,1), key="vehicle", enable_events=True, readonly=True),
+           sg.Text("Commands and joystick go to the selected vehicle"), sg.Text(size=(60,1), key="fleet")],
           [sg.Button("ARM"), sg.Button("DISARM")],
           [sg.Checkbox("Joystick", key="JS", default=demo_mode, disabled=js_unavailable)],
           [sg.Button("Restart"), sg.Text("Attemp to restart the control software on Pi")],
+          [sg.Button("CancelJob"), sg.Text("Stop a calibration or restart still running on Pi")],
+          [sg.Button("Profile"), sg.Input("30", size=(4,1), key="profile_s"), sg.Text("s of CPU profile of the relay and control software, written to /tmp on Pi")],
           [sg.Button("RebootPi"), sg.Text("Attempt to reboot operating system on WaterPi")],
           [sg.Button("StartPiSerialShell", disabled=demo_mode), sg.Text("Turn off WaterPi relay server and turn on WaterPi Serial Shell for troubleshooting")],
           [sg.Frame(
@@ -339,7 +336,12 @@ layout = [
            sg.Frame("Radio bearing", [[sg.Text(size=(10,1), text_color="red", key="bearing")]]),
            sg.Frame("Confident", [[sg.Text(size=(10,1), text_color="red", key="confident")]]),
            sg.Frame("Vision bearing", [[sg.Text(size=(10,1), text_color="red", key="vision")]]),
-           sg.Frame("Vision distance", [[sg.Text(size=(10,1), text_color="red", key="distance")]])
+           sg.Frame("Vision distance", [[sg.Text(size=(10,1), text_color="red", key="distance")]]),
+           sg.Frame("Beacon estimate", [[sg.Text(size=(30,1), text_color="red", key="beacon")]])
+          ],
+          [sg.Frame("Radio bearing (red)", [[sg.Graph(PLOT_SIZE, (-PLOT_SECONDS, -180), (0, 180), key="plot_bearing")]]),
+           sg.Frame("Pitch (cyan), yaw (yellow) effort", [[sg.Graph(PLOT_SIZE, (-PLOT_SECONDS, -1000), (0, 1000), key="plot_effort")]]),
+           sg.Frame("Power (orange), confidence (green)", [[sg.Graph(PLOT_SIZE, (-PLOT_SECONDS, 0), (0, 100), key="plot_signal")]])
           ],
           [sg.Frame("Log", [[sg.Output(size=(125, 5), key="log")]])]
           ]
@@ -350,7 +352,7 @@ event, input = sg.Window("Comm link", keep_on_top=True, layout=[[sg.Button("WIFI
 
 if event == "LORA":
     comm = lora
-    sg.popup("Each button attempts to send a command to WaterPi through LORA uart, but might fail due to packet collision.\n"
+    sg.popup("Each button attempts to send a command to WaterPi through LORA uart, but might fail when the radio drops it.\n"
           "Acked mean successful.\nNot acked mean unknown if successful or not.\n"
           "Check the response message to confirm and try again if it really failed.", keep_on_top=True, title="Attention")
 else:
@@ -398,21 +400,68 @@ if __name__ == "__main__":
     joystick_task.start()
     get_feedback_task.start()
     
-    ack = False
+    fleet = Fleet()
+    results = queue.SimpleQueue()       # (acked, cmd, vid, tries, round trip s) of finished commands, from the pipeline threads
+    report = lambda ok, pending, round_trip: results.put((ok, pending.cmd, pending.vid, pending.tries, round_trip))
+    next_frame = time.monotonic()
+    serial_shell = False
     while True:
-        if comm.telem_packet:
-            update_gui(window, comm.telem_packet)
-            
+        while not results.empty():
+            ok, cmd, vid, tries, round_trip = results.get_nowait()
+            if ok:
+                log.info("Command %s to vehicle %s was acknowleged properly, %.2f s, %d tries.", cmd, vid, round_trip, tries)
+                sg.popup_quick_message("{} acked".format(cmd), keep_on_top=True)
+            else:
+                log.warning("Command %s to vehicle %s was not acknowleged properly after %d tries.", cmd, vid, tries)
+                sg.popup_quick_message("{} not acked".format(cmd), keep_on_top=True)
+            if cmd == "exit" and ok:
+                serial_shell = True
+
+        if serial_shell:
+            """ For turning of Pi"s relay server and turn on serial terminal mode """
+            window["log"].__del__() # work around pysimplegui Output bug not returning stdio
+            window.close()
+            comm.close()
+            miniterm.main(DEVICE,BAUD)
+            break
+
+        now = time.monotonic()
+        if now >= next_frame:
+            heard = len(fleet)
+            while not comm.telem_queue.empty():     # everything received since the last frame goes in the plots of its vehicle
+                t, telem_packet = comm.telem_queue.get_nowait()
+                fleet.add(t, telem_packet)
+            if len(fleet) != heard:
+                if comm.vehicle not in fleet.vehicles:
+                    comm.vehicle = fleet.ids()[0]       # nothing selected yet, the first vehicle heard
+                window["vehicle"].update(value=comm.vehicle, values=fleet.ids())
+            if comm.vehicle in fleet.vehicles:
+                vehicle = fleet[comm.vehicle]
+                if vehicle.telem:
+                    update_gui(window, vehicle.telem)
+                draw_plots(window, vehicle.history, now)
+            window["fleet"].update(fleet.status(now))
+            next_frame += 1/RENDER_FPS
+            if next_frame < now:
+                next_frame = now + 1/RENDER_FPS     # a popup held the loop, skip the missed frames
+
         # window.Refresh()
-        event, input = window.read(timeout=1000)
+        event, input = window.read(timeout=max(0, int((next_frame - time.monotonic())*1000)))
         # log.debug("{}, {}".format(event, input))
         
         if event == sg.WINDOW_CLOSED:
             window.close()
             break
         
+        elif event == "vehicle":
+            # every joystick packet carries the whole stick state, the next one goes to the new vehicle and the
+            # previous one neutralises its sticks when the keepalives stop
+            comm.vehicle = input["vehicle"]
+            log.info("Commanding vehicle %s", comm.vehicle)
+            next_frame = time.monotonic()
+
         elif event == "Calibrate":
-            ack = comm.send_command("sync", signal=True)
+            comm.send_command("sync", callback=report)
             # if ack:
             #     log.info("Kerberos Sync procedure started")
             #     sg.popup_timed("Kerberos Sync procedure started", keep_on_top=True)
@@ -422,7 +471,7 @@ if __name__ == "__main__":
         elif event == "SetGains":
             try:
                 params = {"Kp":float(input.get("Kp") or 0), "Ki":float(input.get("Ki") or 0), "Kd":float(input.get("Kd") or 0)}
-                ack = comm.send_command("tune", params, signal=True)
+                comm.send_command("tune", params, report)
                 # log.debug("PID params sent: %s", params)
             except Exception as msg:
                 log.debug(msg)
@@ -430,37 +479,39 @@ if __name__ == "__main__":
         elif event == "SetThresholds":
             try:
                 params = {"power":int(input.get("minpow") or 0), "conf":int(input.get("minconf") or 0)}
-                ack = comm.send_command("threshold", params, signal=True)
+                comm.send_command("threshold", params, report)
             except Exception as msg:
                 log.debug(msg)
 
         elif event == "ARM":
             params = {"arm":True}
-            ack = comm.send_command("arm", params, signal=True)
+            comm.send_command("arm", params, report)
             # send_joystick([0,0,1], [1,0])
 
         elif event == "DISARM":
             params = {"arm":False}
-            ack = comm.send_command("arm", params, signal=True)
+            comm.send_command("arm", params, report)
             # send_joystick([0,0,1], [0,1])
 
         elif event == "Restart":
-            ack = comm.send_command("restart", signal=True)
+            comm.send_command("restart", callback=report)
             # log.info("Sent signal to restart control software on Pi side")
 
+        elif event == "CancelJob":
+            comm.send_command("cancel", callback=report)
+
+        elif event == "Profile":
+            try:
+                comm.send_command("profile", {"seconds": int(input.get("profile_s") or 0), "rate": 0}, report)
+            except ValueError as msg:
+                log.debug(msg)
+
         elif event == "StartPiSerialShell":
-            """ For turning of Pi"s relay server and turn on serial terminal mode """
-            ack = comm.send_command("exit", signal=True)
-            if ack:
-                window["log"].__del__() # work around pysimplegui Output bug not returning stdio
-                window.close()
-                comm.close()
-                miniterm.main(DEVICE,BAUD)
-                break
+            comm.send_command("exit", callback=report)     # the shell starts once the ack is in
 
         elif event == "RebootPi":
             # Pi unable to reboot properly. Problem with Pi hang if rebooting with Kerberos backfeed power into USB port
-            ack = comm.send_command("reboot", signal=True)
+            comm.send_command("reboot", callback=report)
           
         elif input["JS"]:
             if not comm.js_signal.is_set():
@@ -469,12 +520,7 @@ if __name__ == "__main__":
             
         elif not input["JS"]:
             if comm.js_signal.is_set():
-                log.info("Stop using Joystick")
+                log.info("Stop using Joystick, stream: %s", comm.js_stream.stats())
                 comm.js_signal.clear()
-    
-        if event != "__TIMEOUT__":
-            if ack:
-                sg.popup_quick_message("Acked", keep_on_top=True)
-            else:
-                sg.popup_quick_message("Not Acked", keep_on_top=True)
+
             
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Long running shell commands (kerberos sync, control restart) run as jobs next to the relay's packet routing
+A job's stdout is read without blocking from the same selector loop, and its lines are reported through
+a callback at a limited rate. Jobs have a state and can be cancelled, which terminates their whole process group.
+"""
+import os
+import time
+import signal
+import selectors
+import subprocess
+import logging as log
+
+LINE_RATE = 5           # lines per second reported per job, the rest are counted and summarised
+LINE_BURST = 10         # lines that can be reported at once after a quiet period
+KILL_TIMEOUT = 3        # seconds between SIGTERM and SIGKILL on cancel
+TICK = 0.5              # seconds between housekeeping passes while a job is active
+
+""" Job states """
+RUNNING = "running"
+DONE = "done"               # done marker seen, the process may keep running (e.g. the DOA server)
+EXITED = "exited"           # process ended with status 0
+FAILED = "failed"           # process ended with a non zero status
+CANCELLING = "cancelling"
+CANCELLED = "cancelled"
+
+class Job:
+    """ Convenient class for one subprocess, its output buffer and its state """
+    def __init__(self, name, args, done_marker=None, preexec_fn=None):
+        self.name = name
+        self.args = args
+        self.done_marker = done_marker
+        self.state = RUNNING
+        self.started = time.monotonic()
+        self.ended = None
+        self.buffer = b''
+        self.lines = 0
+        self.suppressed = 0             # lines not reported since the last report
+        self.tokens = LINE_BURST
+        self.refilled = self.started
+        self.kill_time = None
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                        preexec_fn=preexec_fn, start_new_session=True)
+        os.set_blocking(self.process.stdout.fileno(), False)
+
+    @property
+    def finished(self):
+        return self.state in (EXITED, FAILED, CANCELLED)
+
+    def allow_line(self, now):
+        self.tokens = min(LINE_BURST, self.tokens + (now - self.refilled)*LINE_RATE)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def status(self):
+        end = self.ended or time.monotonic()
+        return {"state": self.state, "pid": self.process.pid, "lines": self.lines,
+                "elapsed": round(end - self.started, 1), "returncode": self.process.returncode}
+
+class JobManager:
+    """
+    Convenient class for starting, watching and cancelling jobs from a selectors loop
+    report(job, line) is called with each output line that passes the rate limit and on every state change (line None)
+    """
+    def __init__(self, selector, report):
+        self.selector = selector
+        self.report = report
+        self.jobs = {}          # name -> latest Job of that name
+        self.replaced = []      # jobs cancelled to start a new one of their name, watched until they exit
+
+    def start(self, name, args, done_marker=None, preexec_fn=None):
+        """
+        Start a job unless one of the same name is still working towards done. Returns the job, or None if refused
+        A job of the same name past its done marker is cancelled and replaced, e.g. a new sync while the DOA server of
+        the previous one runs
+        """
+        job = self.jobs.get(name)
+        if job and job.state == DONE:
+            self.cancel(name)
+            self.replaced.append(job)
+        elif job and not job.finished:
+            log.warning("Job %s is already %s", name, job.state)
+            return None
+        try:
+            job = Job(name, args, done_marker, preexec_fn)
+        except OSError as msg:
+            log.error("Job %s could not start: %s", name, msg)
+            return None
+        self.jobs[name] = job
+        self.selector.register(job.process.stdout, selectors.EVENT_READ, lambda: self.read(job))
+        log.info("Job %s started, pid %d", name, job.process.pid)
+        self.report(job, None)
+        return job
+
+    def cancel(self, name=None):
+        """ Cancel the named job, or every job still running or past its done marker. Returns the names being cancelled """
+        names = [name] if name else [name for name, job in self.jobs.items() if job.state in (RUNNING, DONE)]
+        cancelled = []
+        for name in names:
+            job = self.jobs.get(name)
+            if job and job.state in (RUNNING, DONE):
+                job.signal(signal.SIGTERM)
+                job.state = CANCELLING
+                job.kill_time = time.monotonic() + KILL_TIMEOUT
+                log.info("Job %s cancelling", name)
+                self.report(job, None)
+                cancelled.append(name)
+        return cancelled
+
+    def active(self):
+        return bool(self.replaced) or any(not job.finished for job in self.jobs.values())
+
+    def read(self, job):
+        try:
+            data = os.read(job.process.stdout.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            self.close_output(job)
+            self.reap(job)
+            return
+
+        now = time.monotonic()
+        job.buffer += data
+        *lines, job.buffer = job.buffer.split(b'\n')
+        for line in lines:
+            self.line(job, line.decode(errors="replace").rstrip(), now)
+
+    def line(self, job, text, now):
+        job.lines += 1
+        if job.state == DONE:
+            log.debug("%s: %s", job.name, text)     # keep draining the pipe, but the GUI only cares until done
+            return
+
+        marker = job.done_marker and job.done_marker in text
+        if marker or job.allow_line(now):
+            log.info("%s: %s", job.name, text)
+            self.flush_suppressed(job)
+            self.report(job, text)
+        else:
+            job.suppressed += 1
+
+        if marker and job.state == RUNNING:
+            job.state = DONE
+            log.info("Job %s done after %.1f s", job.name, now - job.started)
+            self.report(job, None)
+
+    def flush_suppressed(self, job):
+        if job.suppressed:
+            count, job.suppressed = job.suppressed, 0
+            self.report(job, "... {} lines not shown".format(count))
+
+    def close_output(self, job):
+        try:
+            self.selector.unregister(job.process.stdout)
+        except KeyError:
+            pass
+        job.process.stdout.close()
+
+    def reap(self, job):
+        if job.finished or job.process.poll() is None:
+            return
+        job.ended = time.monotonic()
+        self.flush_suppressed(job)
+        if job.state == CANCELLING:
+            job.state = CANCELLED
+        elif job.process.returncode == 0:
+            job.state = EXITED
+        else:
+            job.state = FAILED
+        log.info("Job %s %s with status %s", job.name, job.state, job.process.returncode)
+        self.report(job, None)
+
+    def tick(self):
+        """ Housekeeping from the loop: report held back lines, reap exited processes, escalate cancels """
+        now = time.monotonic()
+        self.replaced = [job for job in self.replaced if not job.finished]
+        for job in list(self.jobs.values()) + self.replaced:
+            if job.finished:
+                continue
+            if job.suppressed and job.allow_line(now):
+                self.flush_suppressed(job)
+            if job.process.stdout.closed:
+                self.reap(job)
+            if job.state == CANCELLING and now > job.kill_time:
+                log.warning("Job %s ignored SIGTERM, killing", job.name)
+                job.signal(signal.SIGKILL)
+                job.kill_time = now + KILL_TIMEOUT
+
+    def stats(self):
+        return {name: job.status() for name, job in self.jobs.items()}
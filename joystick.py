@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import time
+import math
 import sys
 import numpy as np
 import serial
@@ -34,9 +35,46 @@ axes = [0]*axis_count
 btns = [0]*btn_count
 arrws = [0]*arrw_count
 deadband = 0.05
+last_event = None       # time.monotonic() the latest input event was taken from pygame's queue
+
+pygame.event.set_blocked(None)        # block every event type, set_allowed(None) would allow them all
+pygame.event.set_allowed([pygame.JOYAXISMOTION, pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP, pygame.JOYHATMOTION])
+
+def apply_event(event):
+    """ Update axes, btns and arrws from one pygame event, True if it was input from our joystick """
+    if getattr(event, "joy", choice) != choice:
+        return False
+    if event.type == pygame.JOYAXISMOTION:
+        axes[event.axis] = 0 if abs(event.value) < deadband else event.value
+    elif event.type in (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP):
+        btns[event.button] = int(event.type == pygame.JOYBUTTONDOWN)
+    elif event.type == pygame.JOYHATMOTION:
+        arrws[event.hat] = event.value
+    else:
+        return False
+    return True
+
+def wait_input(timeout=None):
+    """ Block until joystick input arrives, at most timeout s. Applies every event already queued, True if any was input """
+    global last_event
+    if timeout is None:
+        event = pygame.event.wait()
+    elif timeout <= 0:
+        event = pygame.event.poll()         # deadline passed, wait(0) would block for good
+    else:
+        event = pygame.event.wait(max(1, math.ceil(timeout*1000)))     # never round a short timeout down to 0
+    if event.type == pygame.NOEVENT:
+        return False
+    last_event = time.monotonic()
+    changed = apply_event(event)
+    for event in pygame.event.get():        # a stick sweep queues many, one state covers them all
+        changed = apply_event(event) or changed
+    return changed
 
 def joystick_update():
+    """ Poll every input, e.g. to start from the current state. Events queued until now are older, they are dropped """
     pygame.event.pump()
+    pygame.event.clear()
     for i in range (axis_count):
         axes[i] = js.get_axis(i)
         if abs(axes[i]) < deadband:
@@ -47,7 +85,7 @@ def joystick_update():
         arrws[i] = js.get_hat(i)
 
 if __name__ == "__main__":
+    joystick_update()
     while(1):
-        joystick_update()
-        log.debug("\n\tAxes value: {}\n\tButtons value: {}\n\tArrows value: {}".format(axes, btns, arrws))
-        time.sleep(0.1)
+        if wait_input():
+            log.debug("\n\tAxes value: {}\n\tButtons value: {}\n\tArrows value: {}".format(axes, btns, arrws))
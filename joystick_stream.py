@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Change driven joystick transmission for the ground station
+A packet goes out as soon as a stick moved by more than AXIS_STEP or a button changed since the last packet, and
+otherwise every KEEPALIVE, since the vehicle neutralises the sticks after 1 s without a packet. While a stick keeps
+moving, packets are MIN_INTERVAL apart at least, the latest state going out at the end of the interval. The time from
+an input event to its packet being handed to the link is kept in a histogram.
+"""
+import time
+from scheduler import Histogram
+
+KEEPALIVE = 0.5     # s between packets while the input is unchanged, half the vehicle's joystick timeout
+AXIS_STEP = 0.01    # stick movement worth a packet, the codec keeps 0.001
+MIN_INTERVAL = 0.05 # s between packets while the sticks move, 20 Hz is more than the vehicle's control step needs
+AXES = 3            # axes and buttons the vehicle uses
+BUTTONS = 2
+LATENCY_BOUNDS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1]     # s
+
+class JoystickStream:
+    """ Convenient class deciding when the joystick state is worth a packet, and counting what it saved """
+    def __init__(self, send, keepalive=KEEPALIVE, step=AXIS_STEP, min_interval=MIN_INTERVAL, clock=time.monotonic):
+        self.send = send                # called with (axes, btns) for every packet
+        self.keepalive = keepalive
+        self.step = step
+        self.min_interval = min_interval
+        self.clock = clock
+        self.last = None                # (axes, btns) last sent
+        self.last_sent = None
+        self.held = None                # (axes, btns, event time) of a change waiting for min_interval
+        self.latency = Histogram(LATENCY_BOUNDS)    # s, input event to packet sent
+        self.changes = 0
+        self.keepalives = 0
+        self.suppressed = 0             # input events not worth a packet
+
+    def reset(self):
+        """ Forget what was sent, the next update goes out whatever it holds """
+        self.last = None
+        self.held = None
+
+    def changed(self, axes, btns):
+        if self.last is None:
+            return True
+        last_axes, last_btns = self.last
+        return btns != last_btns or any(abs(a - b) >= self.step for a, b in zip(axes, last_axes))
+
+    def update(self, axes, btns, event_time=None):
+        """ Input state after an input event at event_time, sent at once if it changed enough. Returns True if sent """
+        axes = [round(a, 3) for a in axes[:AXES]]
+        btns = list(btns[:BUTTONS])
+        if not self.changed(axes, btns):
+            self.held = None            # back where the last packet left it
+            self.suppressed += 1
+            return False
+        if self.last_sent is not None and self.clock() - self.last_sent < self.min_interval:
+            event_time = self.held[2] if self.held and self.held[2] is not None else event_time
+            self.held = (axes, btns, event_time)
+            self.suppressed += 1
+            return False
+        self.send_change(axes, btns, event_time)
+        return True
+
+    def send_change(self, axes, btns, event_time):
+        self.held = None
+        self.transmit(axes, btns)
+        self.changes += 1
+        if event_time is not None:
+            self.latency.observe(self.last_sent - event_time)
+
+    def transmit(self, axes, btns):
+        self.send(axes, btns)
+        self.last = (axes, btns)
+        self.last_sent = self.clock()
+
+    def poll(self, now=None):
+        """ Send a held change once min_interval is over, or the unchanged state when the keepalive is due """
+        now = self.clock() if now is None else now
+        deadline = self.deadline()
+        if deadline is None or now < deadline:
+            return
+        if self.held:
+            self.send_change(*self.held)
+        else:
+            self.transmit(*self.last)
+            self.keepalives += 1
+
+    def deadline(self):
+        """ Time poll() has something to send, None before anything was sent """
+        if self.last_sent is None:
+            return None
+        return self.last_sent + (self.min_interval if self.held else self.keepalive)
+
+    def stats(self):
+        return {"changes": self.changes, "keepalives": self.keepalives, "suppressed": self.suppressed,
+                "latency_ms": {"p50": round(self.latency.quantile(0.5)*1e3, 3), "p99": round(self.latency.quantile(0.99)*1e3, 3),
+                               "max": round(self.latency.max*1e3, 3)}}
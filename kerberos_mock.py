@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the KerberosSDR web servers, for exercising radio_compass.py and kerberos_sync.py without the receiver
+Port 8081 serves the compass page and the DOA_value.html file that Hydra rewrites on every DOA update
+Port 8080 serves the init, sync and doa control pages and keeps the state their forms set
+"""
+import time
+import threading
+import itertools
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+LOCALHOST = "127.0.0.1"
+PORT_CONTROL = 8080
+PORT_COMPASS = 8081
+
+COMPASS_HTML = b"""<html><head><script>
+function update() {
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        var xml = req.responseXML;
+        document.getElementById("doa").innerHTML = "DOA: " + xml.getElementsByTagName("DOA")[0].textContent;
+        document.getElementById("conf").innerHTML = "Confidence: " + xml.getElementsByTagName("CONF")[0].textContent;
+        document.getElementById("pwr").innerHTML = "Power: " + xml.getElementsByTagName("PWR")[0].textContent;
+    };
+    req.open("GET", "DOA_value.html");
+    req.send();
+}
+setInterval(update, 100);
+</script></head>
+<body onload="update()"><p id="doa">DOA: 0</p><p id="pwr">Power: 0</p><p id="conf">Confidence: 0</p></body></html>
+"""
+
+class DOASource:
+    """ Convenient class producing a slowly rotating bearing, so every read returns fresh values """
+    def __init__(self, step=1, power=20, confidence=30):
+        self.mutex = threading.Lock()
+        self.counter = itertools.count()
+        self.step = step
+        self.power = power
+        self.confidence = confidence
+
+    def __call__(self):
+        with self.mutex:
+            n = next(self.counter)
+        return (n*self.step) % 360, self.power, self.confidence
+
+class CompassHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive, like the bottle server behind Hydra
+    disable_nagle_algorithm = True      # headers and body go out in separate writes
+
+    def do_GET(self):
+        if self.path.startswith("/DOA_value.html"):
+            doa, pwr, conf = self.server.source()
+            body = "<DATA>\n<DOA>{}</DOA>\n<CONF>{}</CONF>\n<PWR>{}</PWR>\n</DATA>".format(doa, conf, pwr).encode()
+            self.server.hits += 1
+        elif self.path.startswith("/compass.html"):
+            body = COMPASS_HTML
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockCompassServer(ThreadingHTTPServer):
+    """ Convenient class for serving compass.html and DOA_value.html on a background thread """
+    daemon_threads = True
+
+    def __init__(self, IP=LOCALHOST, PORT=PORT_COMPASS, source=None):
+        super().__init__((IP, PORT), CompassHandler)
+        self.source = source or DOASource()
+        self.hits = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+""" Control pages: {path: [(submit name, button label, [(field name, type)])]}, one form per button
+A button without a name is not in the POST body, its form posts to a path of its own, like Calibrate IQ here """
+CONTROL_FORMS = {
+    "/init": [("rcv_params", "Update Receiver Paramaters", [("center_freq", "text"), ("gain_index", "text")]),
+              ("iq_params", "Update IQ Paramaters", [("dc_comp", "checkbox"), ("fir_size", "text"), ("decimation", "text")]),
+              ("start", "Start Processing", [])],
+    "/sync": [("update_sync", "Update", [("en_sync", "checkbox"), ("en_noise", "checkbox")]),
+              ("samp_sync", "Sample Sync", []),
+              (None, "Calibrate IQ", [])],
+    "/doa": [("update_doa", "Update DOA", [("en_doa", "checkbox"), ("ant_spacing", "text")])],
+}
+
+def form_action(path, submit, label):
+    return path if submit else "{}/{}".format(path, label.lower().replace(" ", "_"))
+
+class ControlHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def render(self, path):
+        state = self.server.state
+        html = ["<html><body>"]
+        for submit, label, fields in CONTROL_FORMS[path]:
+            html.append('<form action="{}" method="post">'.format(form_action(path, submit, label)))
+            for name, kind in fields:
+                if kind == "checkbox":
+                    html.append('<input type="checkbox" name="{}"{}>'.format(name, " checked" if state.get(name) else ""))
+                else:
+                    html.append('<input type="text" name="{}" value="{}">'.format(name, state.get(name, "")))
+            if submit:
+                html.append('<input type="submit" name="{}" value="{}"></form>'.format(submit, label))
+            else:
+                html.append('<input type="submit" value="{}"></form>'.format(label))
+        html.append("</body></html>")
+        return "\n".join(html).encode()
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path not in CONTROL_FORMS:
+            self.send_error(404)
+            return
+        self.reply(self.render(path))
+
+    def do_POST(self):
+        action = self.path.split("?")[0]
+        path = action if action in CONTROL_FORMS else action.rpartition("/")[0]
+        if path not in CONTROL_FORMS:
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        data = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode(), keep_blank_values=True).items()}
+
+        for submit, label, fields in CONTROL_FORMS[path]:
+            if action == form_action(path, submit, label) and (submit is None or data.get(submit) == label):
+                time.sleep(self.server.delay)       # the real handlers reconfigure the receiver before answering
+                with self.server.mutex:
+                    for name, kind in fields:
+                        self.server.state[name] = (name in data) if kind == "checkbox" else data.get(name, "")
+                    self.server.presses.append(label)
+                break
+        else:
+            self.send_error(400)
+            return
+        self.reply(self.render(path))
+
+    def log_message(self, format, *args):
+        pass
+
+class MockControlServer(ThreadingHTTPServer):
+    """ Convenient class for serving the init, sync and doa pages on a background thread """
+    daemon_threads = True
+
+    def __init__(self, IP=LOCALHOST, PORT=PORT_CONTROL, delay=0):
+        super().__init__((IP, PORT), ControlHandler)
+        self.mutex = threading.Lock()
+        self.delay = delay
+        self.presses = []       # button labels in the order they were submitted
+        self.state = {"center_freq": "121.65", "gain_index": "9", "dc_comp": True, "fir_size": "100", "decimation": "1",
+                      "en_sync": False, "en_noise": False, "en_doa": False, "ant_spacing": "0.3048"}
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    control = MockControlServer().start()
+    log.info("Mock control server on http://%s:%d/init", LOCALHOST, control.port)
+    server = MockCompassServer()
+    log.info("Mock compass server on http://%s:%d/compass.html", LOCALHOST, server.port)
+    server.serve_forever()
@@ -1,153 +1,222 @@
 #!/usr/bin/env python3
-
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.chrome.options import Options
+"""
+Go through the KerberosSDR init, sync and doa pages and submit the same forms the buttons would, directly over HTTP
+Each step waits until the page reflects the new settings instead of sleeping a fixed time, and reports how long it took
+"""
+import sys
 import time
+import argparse
+import http.client
+from html.parser import HTMLParser
+from urllib.parse import urlencode
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.INFO)
 
 SERVERIP = '127.0.0.1'
-
-print("Make sure that either the radio band of interest is completely silent (no beacons or radio station broadcasting), or all kerberos antenna are disconnected from the board, in order to perform sync process correctly")
-print("Going through kerberos settings and syncing sequence, will take about 30 secs. Be patient...")
-
-options = Options()
-options.headless = True
-driver = webdriver.Chrome(options=options)
-driver.implicitly_wait(10)
-max_tries = 10
-""" Init page: disable DC compensation and FIR filter, and start processing """
-for i in range(max_tries):     # try 10 times   
-    try:
-        driver.get("http://" + SERVERIP + ":8080/init")
-        break
-    except ec.WebDriverException as msg:
-        if i == max_tries-1:
-            raise
-        log.debug(msg)
-        time.sleep(1)
-    
-print("Use Firefox to access\nhttp://192.168.43.10:8080/sync\nto visually confirm the syncing process.")
-
-config_set_btn = driver.find_element_by_css_selector("input[value='Update Receiver Paramaters']")
-config_set_btn.click()
-time.sleep(1)
-
-dc_comp = driver.find_element_by_css_selector("input[name='dc_comp']")
-if (dc_comp.is_selected()):
-    dc_comp.click()
-
-fir_size = driver.find_element_by_css_selector("input[name='fir_size']")
-fir_size.clear()
-fir_size.send_keys('0')
-
-iq_set_btn = driver.find_element_by_css_selector("input[value='Update IQ Paramaters']")
-iq_set_btn.click()
-time.sleep(1)
-
-start_btn = driver.find_element_by_css_selector("input[value='Start Processing']")
-start_btn.click()
-time.sleep(1)
-
-""" Sync page: enable noise source and do sample sync and IQ calibration, then disable noise source """
-for i in range(max_tries):     # try 10 times
-    try:    
-        driver.get("http://" + SERVERIP + ":8080/sync")
-        break
-    except ec.webdriverException as msg:
-        if i == max_tries-1:
-            raise
-        log.debug(msg)
-        time.sleep(1)
-
-# check_sync_btn = driver.find_element_by_css_selector("input[value='Enable Noise Source & Sync Display']")
-# check_sync_btn.click()
-
-sync  = driver.find_element_by_css_selector("input[name='en_sync']")
-if (not sync.is_selected()):
-    sync.click()
-
-noise = driver.find_element_by_css_selector("input[name='en_noise']")
-if (not noise.is_selected()):
-    noise.click()
-
-update = driver.find_element_by_css_selector("input[value='Update']")
-update.click()
-time.sleep(1)
-
-sync_btn = driver.find_element_by_css_selector("input[value='Sample Sync']")
-sync_btn.click()
-for i in range(5):
-    print("Wait some time for sample sync:" + str(5-i))
-    time.sleep(1)
-
-cal_btn = driver.find_element_by_css_selector("input[value='Calibrate IQ']")
-cal_btn.click()
-for i in range(5):
-    print("Wait some time for IQ calibration:" + str(5-i))
-    time.sleep(1)
-
-# uncheck_sync_btn = driver.find_element_by_css_selector("input[value='Disable Noise Source & Sync Display']")
-# uncheck_sync_btn.click()
-
-sync  = driver.find_element_by_css_selector("input[name='en_sync']")
-if (sync.is_selected()):
-    sync.click()
-
-noise = driver.find_element_by_css_selector("input[name='en_noise']")
-if (noise.is_selected()):
-    noise.click()
-
-update = driver.find_element_by_css_selector("input[value='Update']")
-update.click()
-time.sleep(1)
-
-""" Init page: enable DC comp and filter again """
-for i in range(max_tries):     # try 10 times
-    try:
-        driver.get("http://" + SERVERIP + ":8080/init")
-        break
-    except ec.webdriverException as msg:
-        if i == max_tries-1:
-            raise
-        log.debug(msg)
-        time.sleep(1)
-
-dc_comp = driver.find_element_by_css_selector("input[name='dc_comp']")
-if (not dc_comp.is_selected()):
-    dc_comp.click()
-
-fir_size = driver.find_element_by_css_selector("input[name='fir_size']")
-fir_size.clear()
-fir_size.send_keys('100')
-
-iq_set_btn = driver.find_element_by_css_selector("input[value='Update IQ Paramaters']")
-iq_set_btn.click()
-time.sleep(1)
-
-""" DOA page: enable DOA """
-for i in range(10):     # try 10 times
+SERVERPORT = 8080
+STEP_TIMEOUT = 10       # seconds before a step is considered failed
+POLL_INTERVAL = 0.1     # seconds between completion checks
+SETTLE_TIME = 5         # seconds the receiver is given to run sample sync / IQ calibration, the pages expose no completion state
+
+class StepTimeout(Exception):
+    pass
+
+class FormParser(HTMLParser):
+    """ Convenient class for collecting the forms of a page and the current state of their inputs """
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.forms.append({"action": attrs.get("action"), "method": (attrs.get("method") or "get").lower(), "inputs": []})
+        elif not self.forms:
+            return
+        elif tag == "input" and (attrs.get("name") or (attrs.get("type") or "").lower() == "submit"):
+            self.forms[-1]["inputs"].append({"name": attrs.get("name"),    # None for a submit button found by its label only
+                                             "type": (attrs.get("type") or "text").lower(),
+                                             "value": attrs.get("value") or "",
+                                             "checked": "checked" in attrs})
+        elif tag == "select" and attrs.get("name"):
+            self.select = {"name": attrs["name"], "type": "select", "value": None, "checked": False}
+            self.forms[-1]["inputs"].append(self.select)
+        elif tag == "option" and self.select is not None:
+            if self.select["value"] is None or "selected" in attrs:
+                self.select["value"] = attrs.get("value") or ""
+
+    def handle_endtag(self, tag):
+        if tag == "select":
+            self.select = None
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+def parse_forms(page):
+    parser = FormParser()
+    parser.feed(page)
+    return parser.forms
+
+def field_state(forms):
+    """ Flatten the forms of a page into {name: value}, checkboxes as True/False """
+    state = {}
+    for form in forms:
+        for field in form["inputs"]:
+            if field["type"] == "checkbox":
+                state[field["name"]] = field["checked"]
+            elif field["type"] not in ("submit", "button", "reset"):
+                state[field["name"]] = field["value"]
+    return state
+
+class KerberosWeb:
+    """ Convenient class for reading and submitting the KerberosSDR web forms over one keep-alive connection """
+    def __init__(self, host=SERVERIP, port=SERVERPORT, timeout=STEP_TIMEOUT):
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for retry in range(2):      # the server may have dropped an idle keep-alive connection
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                return response.status, response.read().decode(errors="replace")
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                if retry:
+                    raise
+
+    def get(self, path):
+        status, page = self.request("GET", path)
+        if status != 200:
+            raise http.client.HTTPException("GET {} returned HTTP {}".format(path, status))
+        return page
+
+    def submit(self, path, button, fields={}):
+        """ Submit the form containing the button labelled `button`, like a browser click would, with `fields` overridden """
+        for form in parse_forms(self.get(path)):
+            if any(f["type"] == "submit" and f["value"] == button for f in form["inputs"]):
+                break
+        else:
+            raise KeyError("No '{}' button on {}".format(button, path))
+
+        data = []
+        for field in form["inputs"]:
+            name, kind = field["name"], field["type"]
+            if kind == "submit":
+                if field["value"] == button and name:
+                    data.append((name, button))     # only the clicked button is submitted, and only if it has a name
+            elif kind == "checkbox":
+                if fields.get(name, field["checked"]):
+                    data.append((name, field["value"] or "on"))
+            elif kind not in ("button", "reset"):
+                data.append((name, str(fields.get(name, field["value"]))))
+
+        action = form["action"] or path
+        body = urlencode(data)
+        if form["method"] == "post":
+            status, page = self.request("POST", action, body)
+        else:
+            status, page = self.request("GET", action + "?" + body)
+        if status not in (200, 302, 303):
+            raise http.client.HTTPException("Submitting '{}' returned HTTP {}".format(button, status))
+
+    def close(self):
+        self.conn.close()
+
+class Step:
+    """ One button press: submit the form, then wait until the page shows the expected settings """
+    def __init__(self, name, path, button, fields={}, settle=0, timeout=STEP_TIMEOUT):
+        self.name = name
+        self.path = path
+        self.button = button
+        self.fields = fields
+        self.settle = settle
+        self.timeout = timeout
+        self.duration = None
+
+    def done(self, web):
+        expected = {k: (v if isinstance(v, bool) else str(v)) for k, v in self.fields.items()}
+        state = field_state(parse_forms(web.get(self.path)))
+        return all(state.get(k) == v for k, v in expected.items())
+
+    def run(self, web):
+        start = time.monotonic()
+        web.submit(self.path, self.button, self.fields)
+        deadline = start + self.timeout
+        while not self.done(web):
+            if time.monotonic() > deadline:
+                raise StepTimeout("'{}' not confirmed after {} s".format(self.name, self.timeout))
+            time.sleep(POLL_INTERVAL)
+
+        remaining = start + self.settle - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.duration = time.monotonic() - start
+        return self.duration
+
+def sync_sequence(settle=SETTLE_TIME, timeout=STEP_TIMEOUT):
+    return [
+        # Init page: disable DC compensation and FIR filter, and start processing
+        Step("Receiver parameters", "/init", "Update Receiver Paramaters", timeout=timeout),
+        Step("Disable DC comp and FIR", "/init", "Update IQ Paramaters", {"dc_comp": False, "fir_size": 0}, timeout=timeout),
+        Step("Start processing", "/init", "Start Processing", timeout=timeout),
+        # Sync page: enable noise source and do sample sync and IQ calibration, then disable noise source
+        Step("Enable noise source", "/sync", "Update", {"en_sync": True, "en_noise": True}, timeout=timeout),
+        Step("Sample sync", "/sync", "Sample Sync", settle=settle, timeout=timeout),
+        Step("Calibrate IQ", "/sync", "Calibrate IQ", settle=settle, timeout=timeout),
+        Step("Disable noise source", "/sync", "Update", {"en_sync": False, "en_noise": False}, timeout=timeout),
+        # Init page: enable DC comp and filter again
+        Step("Enable DC comp and FIR", "/init", "Update IQ Paramaters", {"dc_comp": True, "fir_size": 100}, timeout=timeout),
+        # DOA page: enable DOA
+        Step("Enable DOA", "/doa", "Update DOA", {"en_doa": True}, timeout=timeout),
+    ]
+
+def wait_for_server(web, max_tries=10):
+    for i in range(max_tries):     # try 10 times
+        try:
+            web.get("/init")
+            return
+        except (OSError, http.client.HTTPException) as msg:
+            if i == max_tries-1:
+                raise
+            log.debug(msg)
+            time.sleep(1)
+
+def run(web, steps):
+    """ Run the steps in order, returns [(name, seconds)] """
+    timings = []
+    for step in steps:
+        duration = step.run(web)
+        timings.append((step.name, duration))
+        print("{:<28}{:6.2f} s".format(step.name, duration))
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default=SERVERIP)
+    parser.add_argument("--port", type=int, default=SERVERPORT)
+    parser.add_argument("--settle", type=float, default=SETTLE_TIME, help="seconds given to sample sync and IQ calibration")
+    parser.add_argument("--timeout", type=float, default=STEP_TIMEOUT, help="per-step timeout in seconds")
+    args = parser.parse_args()
+
+    print("Make sure that either the radio band of interest is completely silent (no beacons or radio station broadcasting), or all kerberos antenna are disconnected from the board, in order to perform sync process correctly")
+    print("Use Firefox to access\nhttp://192.168.43.10:8080/sync\nto visually confirm the syncing process.")
+
+    web = KerberosWeb(args.host, args.port, args.timeout)
+    wait_for_server(web)
+    start = time.monotonic()
     try:
-        driver.get("http://" + SERVERIP + ":8080/doa")
-        break
-    except ec.webdriverException as msg:
-        if i == 9:
-            raise
-        log.debug(msg)
-        time.sleep(1)
-
-doa = driver.find_element_by_css_selector("input[name='en_doa']")
-if (not doa.is_selected()):
-    doa.click()
-
-update = driver.find_element_by_css_selector("input[value='Update DOA']")
-update.click()
-time.sleep(1)
-
-
-driver.quit()
-print("Sync process done")
-
-exit(0)
+        run(web, sync_sequence(args.settle, args.timeout))
+    except (StepTimeout, KeyError, OSError, http.client.HTTPException) as msg:
+        log.error(msg)
+        print("Sync process failed")
+        sys.exit(1)
+    finally:
+        web.close()
+
+    print("Sync process done in {:.1f} s".format(time.monotonic() - start))
+    sys.exit(0)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Beacon localization from radio compass bearings and the autopilot GPS
+Every confident bearing taken at a known position is a line the beacon should lie on. The lines are intersected by
+recursive least squares: each one adds to a 2x2 normal matrix and its right hand side, so a sample costs the same
+whether it is the 10th or the 10000th, and the fix is a 2x2 solve. Old lines fade with FORGET_TAU so a drifting beacon
+is followed. A line weighs in proportion to the time since the previous one, up to SAMPLE_PERIOD, so a DOA estimate
+polled several times counts as one line in all and the residual does not shrink with the poll rate. The residual of the lines around the fix scales the inverse normal matrix into a covariance in metres.
+"""
+import math
+import time
+from bearing_filter import SAMPLE_PERIOD
+import logging as log
+
+EARTH_RADIUS = 6371000      # m
+FORGET_TAU = 300            # s, weight half life is about 0.7 of this, 0 keeps every line forever
+MIN_CROSSING = 10           # deg, lines must cross at least this much (in a least squares sense) for a fix
+MIN_LINES = 5               # effective number of lines needed for a fix
+MAX_STD = 20                # m, standard deviation of the fix along its worst axis up to which it is trusted
+POSITION_TIMEOUT = 2        # s, a bearing is only paired with a position fresher than this
+NO_HEADING = 65535          # GLOBAL_POSITION_INT.hdg when unknown
+
+def to_local(lat, lon, origin):
+    """ East and north in metres from origin (lat, lon), equirectangular, fine over a few km """
+    east = math.radians(lon - origin[1])*EARTH_RADIUS*math.cos(math.radians(origin[0]))
+    north = math.radians(lat - origin[0])*EARTH_RADIUS
+    return east, north
+
+def to_latlon(east, north, origin):
+    lat = origin[0] + math.degrees(north/EARTH_RADIUS)
+    lon = origin[1] + math.degrees(east/(EARTH_RADIUS*math.cos(math.radians(origin[0]))))
+    return lat, lon
+
+class BeaconLocalizer:
+    """ Convenient class for a recursive least squares fix of the beacon position from bearing lines """
+    def __init__(self, forget_tau=FORGET_TAU, clock=time.monotonic):
+        self.forget_tau = forget_tau
+        self.clock = clock
+        self.origin = None              # (lat, lon) of the first GPS fix, local coordinates are metres east and north of it
+        self.position = None            # (east, north) of the vehicle
+        self.heading = None             # GPS heading, degrees clockwise from north
+        self.position_time = None
+        self.reset()
+
+    def reset(self):
+        self.a11 = self.a12 = self.a22 = 0      # sum of w n n', n the unit normal of each line
+        self.b1 = self.b2 = 0                   # sum of w n (n . p), p the position the bearing was taken from
+        self.c = 0                              # sum of w (n . p)^2, for the residual
+        self.w = 0                              # sum of weights
+        self.decayed = None
+        self.previous = None                    # time of the last line added
+        self.lines = 0
+        self.estimate = None                    # (east, north) of the beacon
+        self.covariance = None                  # 2x2 as (var east, cov, var north), m^2
+        self.std = None                         # m, along the worst axis
+
+    def attach(self, pixhawk):
+        pixhawk.subscribe('GLOBAL_POSITION_INT', self.on_position)
+
+    def on_position(self, message):
+        """ GLOBAL_POSITION_INT subscriber """
+        if message.lat == 0 and message.lon == 0:
+            return                      # no GPS fix yet
+        lat, lon = message.lat/1e7, message.lon/1e7
+        if self.origin is None:
+            self.origin = (lat, lon)
+            log.info("Localization origin %.7f, %.7f", lat, lon)
+        heading = None if message.hdg == NO_HEADING else message.hdg/100
+        self.set_position(*to_local(lat, lon, self.origin), heading)
+
+    def set_position(self, east, north, heading=None, t=None):
+        self.position = (east, north)
+        self.heading = heading
+        self.position_time = self.clock() if t is None else t
+
+    def add(self, bearing, weight=1, heading=None, t=None):
+        """
+        Add a bearing in degrees relative to the bow, taken at the latest position. heading overrides the GPS heading,
+        e.g. with the ATTITUDE yaw. Returns True if the line was used
+        """
+        t = self.clock() if t is None else t
+        heading = self.heading if heading is None else heading
+        if self.position is None or heading is None or weight <= 0 or t - self.position_time > POSITION_TIMEOUT:
+            return False
+        if self.previous is not None:
+            weight *= min(1, max(0, t - self.previous)/SAMPLE_PERIOD)     # repeats of one estimate share its weight
+        self.previous = t
+        if weight <= 0:
+            return False
+
+        if self.forget_tau and self.decayed is not None:
+            decay = math.exp(-(t - self.decayed)/self.forget_tau)
+            self.a11 *= decay
+            self.a12 *= decay
+            self.a22 *= decay
+            self.b1 *= decay
+            self.b2 *= decay
+            self.c *= decay
+            self.w *= decay
+        self.decayed = t
+
+        theta = math.radians(bearing + heading)
+        nx, ny = math.cos(theta), -math.sin(theta)      # normal to the line pointing along (sin, cos)
+        d = nx*self.position[0] + ny*self.position[1]
+        self.a11 += weight*nx*nx
+        self.a12 += weight*nx*ny
+        self.a22 += weight*ny*ny
+        self.b1 += weight*nx*d
+        self.b2 += weight*ny*d
+        self.c += weight*d*d
+        self.w += weight
+        self.lines += 1
+        self.solve(theta)
+        return True
+
+    def solve(self, theta):
+        """ Fix and covariance from the sums, theta the direction of the latest line in radians """
+        self.estimate = self.covariance = self.std = None
+        det = self.a11*self.a22 - self.a12*self.a12
+        # det/(w/2)^2 is sin^2 of the crossing angle for two equal lines
+        if self.w < MIN_LINES or det <= (self.w/2)**2*math.sin(math.radians(MIN_CROSSING))**2:
+            return
+        east = (self.a22*self.b1 - self.a12*self.b2)/det
+        north = (self.a11*self.b2 - self.a12*self.b1)/det
+        # the lines are not directed, a fix behind the latest bearing is the wrong intersection
+        if (east - self.position[0])*math.sin(theta) + (north - self.position[1])*math.cos(theta) <= 0:
+            return
+        residual = max(0, self.c - (east*self.b1 + north*self.b2))     # sum w (n . fix - n . p)^2 at the solution
+        scale = residual/(self.w - 2)
+        self.estimate = (east, north)
+        self.covariance = (scale*self.a22/det, -scale*self.a12/det, scale*self.a11/det)
+        var_e, cov, var_n = self.covariance
+        self.std = math.sqrt((var_e + var_n)/2 + math.hypot((var_e - var_n)/2, cov))
+
+    @property
+    def confident(self):
+        return self.std is not None and self.std <= MAX_STD
+
+    def distance(self):
+        if self.estimate is None or self.position is None:
+            return None
+        return math.hypot(self.estimate[0] - self.position[0], self.estimate[1] - self.position[1])
+
+    def bearing(self, heading=None):
+        """ Bearing of the fix relative to the bow, the steering target when the radio compass has nothing better """
+        heading = self.heading if heading is None else heading
+        if self.estimate is None or self.position is None or heading is None:
+            return None
+        world = math.degrees(math.atan2(self.estimate[0] - self.position[0], self.estimate[1] - self.position[1]))
+        return (world - heading + 180) % 360 - 180
+
+    def telemetry(self):
+        """ Fix as [lat, lon, std m], or None """
+        if self.estimate is None or self.origin is None:
+            return None
+        lat, lon = to_latlon(*self.estimate, self.origin)
+        return [round(lat, 7), round(lon, 7), round(self.std, 1)]
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Half-duplex link layer for the LoRa UART, shared by relayserver.py (vehicle) and gui.py (ground station)
+The radios cannot send and receive at once, so the two ends take turns with a token. Only the end holding the token
+writes: queued frames in priority order (commands, then joystick, then telemetry) up to SLOT_BYTES, the last of them
+carrying the token across. An end with nothing to send keeps the token for its idle time, then passes it in an empty frame.
+The vehicle waits longer, its telemetry comes every few hundred ms and then carries the token back for free.
+The ground station is the master: it starts with the token and takes it back after TOKEN_TIMEOUT of silence, the vehicle
+only after twice that, so a lost token frame stalls the link for a moment rather than for good.
+Frames stay newline terminated: kind byte, payload, '*', CRC-16/CCITT of kind and payload as 4 hex digits
+    D  data, the sender keeps the token
+    T  data, the token passes to the receiver
+    P  no data, the token passes to the receiver
+Run as a script for a simulated half-duplex, bandwidth limited radio between two pseudo terminals, e.g.
+    lora_link.py sim --rate 300 --loss 0.05      then relayserver.py --serial <vehicle end>, gui.py DEVICE = <gcs end>
+"""
+import os
+import pty
+import tty
+import time
+import random
+import select
+import argparse
+import binascii
+import threading
+from collections import deque
+import serial
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+""" Priorities, lowest number goes first """
+COMMAND = 0         # commands, acks
+JOYSTICK = 1
+TELEMETRY = 2       # telemetry and its reports
+PRIORITIES = (COMMAND, JOYSTICK, TELEMETRY)
+
+AIR_RATE = 300              # bytes/s over the air, a 2.4 kbps LoRa air data rate
+SLOT_BYTES = 240            # bytes written per turn at most, one module packet
+IDLE_HOLD = 0.5             # s the vehicle keeps an idle token before passing it, at most the command latency it adds
+MASTER_IDLE_HOLD = 0.1      # s the ground station keeps an idle token
+TOKEN_TIMEOUT = 2           # s of silence, after our own transmission is over, before the master takes the token back
+QUEUE_LIMIT = 50            # frames queued per priority, oldest dropped first
+TICK = 0.05                 # s, read timeout of the threaded run loop
+
+DATA = b'D'
+DATA_TOKEN = b'T'
+PASS = b'P'
+
+def frame(kind, payload=b''):
+    body = kind + payload
+    return body + b'*%04x\n' % binascii.crc_hqx(body, 0xFFFF)
+
+def unframe(line):
+    """ (kind, payload) of a received line without its newline, None if it is corrupt """
+    if len(line) < 6 or line[-5:-4] != b'*':
+        return None
+    body = line[:-5]
+    try:
+        if int(line[-4:], 16) != binascii.crc_hqx(body, 0xFFFF):
+            return None
+    except ValueError:
+        return None
+    if body[:1] not in (DATA, DATA_TOKEN, PASS):
+        return None
+    return body[:1], body[1:]
+
+class LoraLink:
+    """ Convenient class for token based turn taking over the LoRa UART, with priority queues and link counters """
+    def __init__(self, ser, master, on_receive, idle_hold=None, clock=time.monotonic):
+        self.ser = ser
+        self.master = master
+        self.on_receive = on_receive            # called with every payload received
+        self.idle_hold = idle_hold if idle_hold is not None else (MASTER_IDLE_HOLD if master else IDLE_HOLD)
+        self.timeout = TOKEN_TIMEOUT if master else 2*TOKEN_TIMEOUT
+        self.clock = clock
+        self.fill = None                        # optional callable returning a TELEMETRY payload when the turn has room left
+        self.mutex = threading.Lock()           # guards the queues, the ground station queues from several threads
+        self.queues = [deque() for priority in PRIORITIES]
+        self.buffer = b''
+        self.stop_event = threading.Event()
+
+        now = clock()
+        self.token = master
+        self.token_since = now
+        self.quiet_since = now                  # last frame heard, or end of our own last transmission
+        self.started = now
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0                     # payload bytes, framing excluded
+        self.bytes_received = 0
+        self.air_bytes = 0                      # everything written, framing and token passes included
+        self.crc_errors = 0
+        self.passes = 0
+        self.reclaims = 0
+        self.dropped = 0
+
+    def send(self, payload, priority=COMMAND, replace=False):
+        """ Queue a payload for the next turn. replace drops what is still queued at that priority, for latest-value streams """
+        if b'\n' in payload:
+            raise ValueError("LoRa payloads are newline framed, send JSON")
+        with self.mutex:
+            queue = self.queues[priority]
+            if replace:
+                queue.clear()
+            elif len(queue) >= QUEUE_LIMIT:
+                queue.popleft()
+                self.dropped += 1
+            queue.append(payload)
+
+    def pending(self):
+        return any(self.queues)
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    """ Receiving """
+    def read(self):
+        """ Selector callback: read what the UART has, handle every complete frame, then take a turn if it is ours """
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as msg:
+            log.error(msg)
+            return
+        self.feed(data)
+        self.poll()
+
+    def feed(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            self.receive(line)
+
+    def receive(self, line):
+        now = self.clock()
+        self.quiet_since = now
+        parsed = unframe(line)
+        if parsed is None:
+            if line:
+                self.crc_errors += 1
+            return
+        kind, payload = parsed
+        if payload:
+            self.frames_received += 1
+            self.bytes_received += len(payload)
+            try:
+                self.on_receive(payload)
+            except Exception as msg:
+                log.error("Receive handler: %s", msg)
+        if kind != DATA:
+            self.token = True
+            self.token_since = now
+
+    """ Sending """
+    def turn(self, now):
+        """ Frames for one turn, highest priority first, within SLOT_BYTES but at least one """
+        payloads, size = [], 0
+        with self.mutex:
+            for queue in self.queues:
+                while queue and (not payloads or size + len(queue[0]) + 8 <= SLOT_BYTES):
+                    payload = queue.popleft()
+                    payloads.append(payload)
+                    size += len(payload) + 8
+        if self.fill and size < SLOT_BYTES:
+            payload = self.fill(SLOT_BYTES - size)
+            if payload:
+                payloads.append(payload)
+        return payloads
+
+    def poll(self, now=None):
+        """ Take the token back if it was lost, and take our turn if we hold it """
+        now = self.clock() if now is None else now
+        if not self.token:
+            if now - self.quiet_since < self.timeout:
+                return
+            self.token = True
+            self.token_since = now
+            self.reclaims += 1
+            log.debug("Token reclaimed after %.1f s of silence", now - self.quiet_since)
+
+        payloads = self.turn(now)
+        if payloads:
+            message = b''.join(frame(DATA, p) for p in payloads[:-1]) + frame(DATA_TOKEN, payloads[-1])
+            self.frames_sent += len(payloads)
+            self.bytes_sent += sum(len(p) for p in payloads)
+        elif now - self.token_since >= self.idle_hold:
+            message = frame(PASS)
+        else:
+            return
+        self.ser.write(message)
+        self.air_bytes += len(message)
+        self.token = False
+        self.passes += 1
+        self.quiet_since = now + len(message)/AIR_RATE      # silence only counts once our own frames are off the air
+
+    def deadline(self):
+        """ Latest time poll() has to run again without any input """
+        if self.token:
+            return self.clock() if self.pending() else self.token_since + self.idle_hold
+        return self.quiet_since + self.timeout
+
+    def run(self):
+        """ Threaded alternative to the selector: read with a short timeout and take turns until stop() """
+        self.ser.timeout = TICK
+        while not self.stop_event.is_set():
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except serial.SerialException as msg:
+                log.error(msg)
+                break
+            if data:
+                self.feed(data)
+            self.poll()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        elapsed = max(1e-9, self.clock() - self.started)
+        return {"goodput_tx": round(self.bytes_sent/elapsed, 1), "goodput_rx": round(self.bytes_received/elapsed, 1),
+                "air_tx": round(self.air_bytes/elapsed, 1), "frames_tx": self.frames_sent, "frames_rx": self.frames_received,
+                "crc_errors": self.crc_errors, "passes": self.passes, "reclaims": self.reclaims, "dropped": self.dropped,
+                "queued": [len(q) for q in self.queues]}
+
+class HalfDuplexChannel:
+    """
+    Simulated LoRa modules between two pseudo terminals. Each burst written to one end goes on the air at rate bytes/s
+    after whatever that module is still sending, and comes out of the other end once sent. Bursts of the two ends that
+    overlap on the air collide and are both lost, the rest are lost with probability loss. A module holding more than
+    buffer bytes drops what is written to it.
+    """
+    def __init__(self, rate=AIR_RATE, loss=0, buffer=512, seed=None):
+        self.rate = rate
+        self.loss = loss
+        self.buffer = buffer
+        self.rng = random.Random(seed)
+        self.masters, self.slaves, self.names = [], [], []
+        for end in range(2):
+            master, slave = pty.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            self.masters.append(master)
+            self.slaves.append(slave)       # kept open so the masters never see EOF
+            self.names.append(os.ttyname(slave))
+        self.busy_until = [0, 0]
+        self.on_air = [[], []]          # per end, [start, end, data, collided]
+        self.bytes = [0, 0]
+        self.collisions = 0
+        self.lost = 0
+        self.overflows = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        for fd in self.masters + self.slaves:
+            os.close(fd)
+
+    def transmit(self, end, data, now):
+        if (self.busy_until[end] - now)*self.rate + len(data) > self.buffer:
+            self.overflows += 1
+            return
+        start = max(now, self.busy_until[end])
+        burst = [start, start + len(data)/self.rate, data, False]
+        self.busy_until[end] = burst[1]
+        for other in self.on_air[1 - end]:
+            if other[0] < burst[1] and burst[0] < other[1]:
+                other[3] = burst[3] = True
+        self.on_air[end].append(burst)
+        self.bytes[end] += len(data)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            pending = [b[1] for bursts in self.on_air for b in bursts]
+            timeout = max(0, min(pending) - now) if pending else 0.1
+            readable, _, _ = select.select(self.masters, [], [], min(timeout, 0.1))
+            now = time.monotonic()
+            for end, master in enumerate(self.masters):
+                if master in readable:
+                    try:
+                        data = os.read(master, 4096)
+                    except (BlockingIOError, OSError):
+                        continue
+                    if data:
+                        self.transmit(end, data, now)
+            for end in range(2):
+                arrived = [b for b in self.on_air[end] if b[1] <= now]
+                self.on_air[end] = [b for b in self.on_air[end] if b[1] > now]
+                for start, stop, data, collided in arrived:
+                    if collided:
+                        self.collisions += 1
+                    elif self.rng.random() < self.loss:
+                        self.lost += 1
+                    else:
+                        try:
+                            os.write(self.masters[1 - end], data)
+                        except OSError:
+                            pass
+
+    def stats(self):
+        return {"air_bytes": self.bytes, "collisions": self.collisions, "lost": self.lost, "overflows": self.overflows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["sim"])
+    parser.add_argument("--rate", type=float, default=AIR_RATE, help="air rate in bytes/s")
+    parser.add_argument("--loss", type=float, default=0, help="fraction of bursts lost besides collisions")
+    args = parser.parse_args()
+
+    channel = HalfDuplexChannel(args.rate, args.loss).start()
+    log.info("Vehicle end %s, ground station end %s", *channel.names)
+    try:
+        while True:
+            time.sleep(10)
+            log.info("Channel: %s", channel.stats())
+    except KeyboardInterrupt:
+        channel.stop()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Stand-in autopilot speaking MAVLink over UDP, for exercising pixhawk.py and autohoming.py without the Pixhawk
+Sends a heartbeat every second, acks SET_MODE and arm/disarm COMMAND_LONGs, and records every MANUAL_CONTROL it receives
+Given heading and position sources it also streams ATTITUDE, VFR_HUD and GLOBAL_POSITION_INT
+Point the Pixhawk class at the listening side of the link, e.g. Pixhawk("udpin:127.0.0.1:14551", BAUD)
+"""
+import math
+import time
+import threading
+from pymavlink import mavutil
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+LINK = "udpout:127.0.0.1:14551"
+ROVER_MODES = {v: k for k, v in mavutil.mode_mapping_rover.items()}
+POSITION_PERIOD = 0.2       # s between GLOBAL_POSITION_INT, ArduRover streams it at a few Hz
+
+class StandinAutopilot:
+    """ Convenient class for an autopilot that answers the way ArduRover does on the messages the vehicle uses """
+    def __init__(self, link=LINK, ack_delay=0, drop_acks=False, heartbeat_period=1):
+        self.master = mavutil.mavlink_connection(link, source_system=1, source_component=1)
+        self.mutex = threading.Lock()
+        self.ack_delay = ack_delay
+        self.drop_acks = drop_acks
+        self.heartbeat_period = heartbeat_period
+        self.armed = False
+        self.custom_mode = ROVER_MODES.get('HOLD', 4)
+        self.manual_control = []            # (monotonic time, x, r) of every MANUAL_CONTROL received
+        self.on_manual_control = None       # optional callback(x, y, z, r)
+        self.heading = None                 # optional callable returning the heading in degrees, streamed as ATTITUDE and VFR_HUD
+        self.attitude_period = None         # set by MAV_CMD_SET_MESSAGE_INTERVAL
+        self.position = None                # optional callable returning (lat, lon) in degrees, streamed as GLOBAL_POSITION_INT
+        self.stop_event = threading.Event()
+        self.threads = [threading.Thread(target=self.heartbeat_thread, daemon=True),
+                        threading.Thread(target=self.receive_thread, daemon=True),
+                        threading.Thread(target=self.attitude_thread, daemon=True),
+                        threading.Thread(target=self.position_thread, daemon=True)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.master.close()
+
+    def send_heartbeat(self):
+        base_mode = mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED
+        if self.armed:
+            base_mode |= mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED
+        status = mavutil.mavlink.MAV_STATE_ACTIVE if self.armed else mavutil.mavlink.MAV_STATE_STANDBY
+        with self.mutex:
+            self.master.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GROUND_ROVER, mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                                           base_mode, self.custom_mode, status)
+
+    def heartbeat_thread(self):
+        while not self.stop_event.is_set():
+            self.send_heartbeat()
+            self.stop_event.wait(self.heartbeat_period)
+
+    def attitude_thread(self):
+        """ ATTITUDE at the requested interval, and VFR_HUD with every heartbeat, as ArduRover streams them """
+        next_hud = time.monotonic()
+        while not self.stop_event.is_set():
+            period = self.attitude_period or self.heartbeat_period
+            if self.heading is not None:
+                heading = self.heading() % 360
+                boot_ms = int(time.monotonic()*1000) & 0xFFFFFFFF
+                with self.mutex:
+                    if self.attitude_period:
+                        yaw = (heading + 180) % 360 - 180
+                        self.master.mav.attitude_send(boot_ms, 0, 0, math.radians(yaw), 0, 0, 0)
+                    if time.monotonic() >= next_hud:
+                        self.master.mav.vfr_hud_send(0, 0, int(round(heading)) % 360, 0, 0, 0)
+                        next_hud = time.monotonic() + self.heartbeat_period
+            self.stop_event.wait(period)
+
+    def position_thread(self):
+        while not self.stop_event.is_set():
+            if self.position is not None:
+                lat, lon = self.position()
+                hdg = int(round(self.heading() % 360*100)) % 36000 if self.heading else 65535
+                boot_ms = int(time.monotonic()*1000) & 0xFFFFFFFF
+                with self.mutex:
+                    self.master.mav.global_position_int_send(boot_ms, int(round(lat*1e7)), int(round(lon*1e7)), 0, 0, 0, 0, 0, hdg)
+            self.stop_event.wait(POSITION_PERIOD)
+
+    def send_ack(self, command, result=mavutil.mavlink.MAV_RESULT_ACCEPTED):
+        if self.drop_acks:
+            return
+        def send():
+            with self.mutex:
+                self.master.mav.command_ack_send(command, result)
+        if self.ack_delay:
+            threading.Timer(self.ack_delay, send).start()
+        else:
+            send()
+
+    def handle(self, message):
+        type = message.get_type()
+        if type == 'MANUAL_CONTROL':
+            self.manual_control.append((time.monotonic(), message.x, message.r))
+            if self.on_manual_control:
+                self.on_manual_control(message.x, message.y, message.z, message.r)
+
+        elif type == 'SET_MODE':
+            self.custom_mode = message.custom_mode
+            self.send_ack(mavutil.mavlink.MAVLINK_MSG_ID_SET_MODE)
+
+        elif type == 'COMMAND_LONG':
+            if message.command == mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM:
+                self.armed = message.param1 == 1
+                log.info("Stand-in %s", "armed" if self.armed else "disarmed")
+                self.send_ack(message.command)
+            elif message.command == mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL and int(message.param1) == mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE:
+                self.attitude_period = message.param2/1e6 if message.param2 > 0 else None
+                self.send_ack(message.command)
+            else:
+                self.send_ack(message.command, mavutil.mavlink.MAV_RESULT_UNSUPPORTED)
+
+    def receive_thread(self):
+        while not self.stop_event.is_set():
+            message = self.master.recv_match(blocking=True, timeout=0.2)
+            if message is not None:
+                self.handle(message)
+
+
+if __name__ == "__main__":
+    autopilot = StandinAutopilot().start()
+    log.info("Stand-in autopilot sending to %s", LINK)
+    while True:
+        time.sleep(1)
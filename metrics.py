@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Process metrics: counters, gauges and fixed-bucket histograms, served as Prometheus text on a local HTTP port
+Metrics are plain objects created once, at import or construction, and updated in place on the hot path: a counter
+increment is an attribute add, a histogram observation a bisect into fixed bounds. Nothing is formatted, locked or
+allocated until a scrape, which reads the values from the HTTP server's thread. A metric can also read its value from
+a function at scrape time, to expose counters a class already keeps without counting twice.
+    curl -s 127.0.0.1:9101/metrics
+"""
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scheduler import Histogram as _Histogram, LATENCY_BOUNDS
+import logging as log
+
+LOCALHOST = "127.0.0.1"
+PORT_AUTOHOMING = 9101     # metrics ports of the vehicle processes, 0 disables the endpoint
+PORT_RELAY = 9102
+PORT_COMPASS = 9103
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items())) + "}"
+
+def _number(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """ Convenient class for a count that only goes up, inc() on the hot path """
+    kind = "counter"
+
+    def __init__(self, name, help="", labels=None, function=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.function = function        # value read at scrape time instead of the one kept here
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.function() if self.function else self.value
+
+class Gauge(Counter):
+    """ Convenient class for a value that goes up and down, set() on the hot path """
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+def _histogram_samples(metric, histogram):
+    counts, total, count = list(histogram.counts), histogram.total, histogram.count
+    cumulative = 0
+    for bound, n in zip(histogram.bounds + [float("inf")], counts):
+        cumulative += n
+        yield metric.name + "_bucket", dict(metric.labels, le=_number(float(bound))), cumulative
+    yield metric.name + "_sum", metric.labels, total
+    yield metric.name + "_count", metric.labels, count
+
+class Histogram(_Histogram):
+    """ Convenient class for a histogram over fixed bucket upper bounds, observe() on the hot path, see scheduler.Histogram """
+    kind = "histogram"
+
+    def __init__(self, name, help="", labels=None, bounds=LATENCY_BOUNDS):
+        super().__init__(bounds)
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+
+    def samples(self):
+        return _histogram_samples(self, self)
+
+class AdoptedHistogram:
+    """ A scheduler.Histogram kept and observed elsewhere, exposed as it is """
+    kind = "histogram"
+
+    def __init__(self, histogram, name, help="", labels=None):
+        self.histogram = histogram
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+
+    def samples(self):
+        return _histogram_samples(self, self.histogram)
+
+class Registry:
+    """ Convenient class for the metrics of a process, rendered in the Prometheus text format """
+    def __init__(self):
+        self.metrics = {}                   # (name, labels) -> metric, in registration order
+        self.mutex = threading.Lock()       # registration only, updates never take it
+
+    def register(self, metric):
+        """ Add a metric, or return the one already registered under the same name and labels """
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        with self.mutex:
+            existing = self.metrics.get(key)
+            if existing is not None and existing.kind == metric.kind:
+                if isinstance(existing, AdoptedHistogram):
+                    existing.histogram = metric.histogram   # the newest owner, e.g. a restarted scheduler
+                elif getattr(metric, "function", None):
+                    existing.function = metric.function
+                return existing
+            self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help="", function=None, **labels):
+        return self.register(Counter(name, help, labels, function))
+
+    def gauge(self, name, help="", function=None, **labels):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help="", bounds=LATENCY_BOUNDS, **labels):
+        return self.register(Histogram(name, help, labels, bounds))
+
+    def adopt(self, histogram, name, help="", **labels):
+        return self.register(AdoptedHistogram(histogram, name, help, labels))
+
+    def render(self):
+        with self.mutex:
+            metrics = list(self.metrics.values())
+        families = {}           # name -> its series, in order of first registration
+        for metric in metrics:
+            families.setdefault(metric.name, []).append(metric)
+        lines = []
+        for name, family in families.items():
+            # the text format wants every series of a name in one block under a single header
+            lines.append("# HELP {} {}".format(name, family[0].help))
+            lines.append("# TYPE {} {}".format(name, family[0].kind))
+            for metric in family:
+                try:
+                    for sample, labels, value in metric.samples():
+                        lines.append("{}{} {}".format(sample, _labels(labels), _number(value)))
+                except Exception as msg:
+                    log.error("Metric %s: %s", metric.name, msg)
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()       # the process wide registry the module functions below use
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+adopt = REGISTRY.adopt
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass        # a scrape every few seconds is not worth a log line
+
+def serve(port, host=LOCALHOST, registry=REGISTRY):
+    """ Serve the registry on http://host:port/ from a daemon thread, returns the server or None if port is 0 """
+    if not port:
+        return None
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as msg:
+        log.error("Metrics endpoint on port %d: %s", port, msg)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Metrics on http://%s:%d/metrics", host, port)
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    import urllib.request
+    parser = argparse.ArgumentParser(description="Print the metrics of a running process")
+    parser.add_argument("port", type=int, nargs="?", default=PORT_AUTOHOMING)
+    args = parser.parse_args()
+    print(urllib.request.urlopen("http://{}:{}/metrics".format(LOCALHOST, args.port), timeout=2).read().decode(), end="")
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 import threading
+import asyncio
 import time
 import sys
+from collections import deque
+from concurrent.futures import Future, TimeoutError, CancelledError
 from pymavlink import mavutil
+from scheduler import Histogram
+import metrics
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.DEBUG)
 
@@ -12,16 +17,44 @@ log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.DEBU
 DEVICE = "/dev/serial/by-id/usb-ArduPilot_Pixhawk1_360027001051303239353934-if00"
 BAUD = 115200
 
-class Pixhawk:
+COMMAND_TIMEOUT = 3     # seconds to wait for a COMMAND_ACK
+QUEUE_LENGTH = 100      # messages kept per subscribed type, oldest dropped first
+
+""" MANUAL_CONTROL streaming settings """
+STREAM_RATE = 20        # Hz
+STALE_TIMEOUT = 0.5     # seconds without a new setpoint before ramping to neutral
+RAMP_RATE = 2000        # effort units per second while ramping to neutral
 
+MESSAGES = metrics.counter("pixhawk_messages_total", "MAVLink messages received and dispatched")
+BAD_DATA = metrics.counter("pixhawk_bad_data_total", "MAVLink bytes pymavlink could not parse into a message")
+CALLBACK_ERRORS = metrics.counter("pixhawk_callback_errors_total", "Message callbacks that raised")
+FEEDBACK_TIMEOUTS = metrics.counter("pixhawk_feedback_timeouts_total", "get_feedback calls without a message before their timeout")
+COMMAND_TIMEOUTS = metrics.counter("pixhawk_command_timeouts_total", "Commands given up on without a COMMAND_ACK")
+MANUAL_CONTROL_SENT = metrics.counter("pixhawk_manual_control_total", "MANUAL_CONTROL messages sent")
+
+class Pixhawk:
+    """
+    Convenient class for the MAVLink link to the Pixhawk
+    A single reader decodes every inbound message once and dispatches it to per-type queues and callbacks,
+    either from its own thread (start) or from an event loop reader (poll). Commands return futures resolved
+    by the matching COMMAND_ACK.
+    """
     def __init__(self, DEVICE, BAUD):
-        self.mutex = threading.Lock()
+        self.mutex = threading.Lock()       # guards writes to the link and the pending commands
         self.armed = False
         self.heartbeat = 0
+        self.callbacks = {}                 # message type -> [callback(message)]
+        self.queues = {}                    # message type -> deque of messages
+        self.pending = {}                   # command id -> (future, params)
+        self.reader = None
+        self.recorder = None                # flight recorder getting every MANUAL_CONTROL sent
+        self.stop_event = threading.Event()
         self.master = mavutil.mavlink_connection(DEVICE, BAUD)
 
+        self.subscribe('HEARTBEAT', self.on_heartbeat)
+        self.subscribe('COMMAND_ACK', self.on_command_ack)
+
         # Wait a heartbeat before sending commands
-        # self.mutex.acquire()
         # self.master.reboot_autopilot()
         # time.sleep(10)
         # self.master = mavutil.mavlink_connection(DEVICE, BAUD)
@@ -33,120 +66,301 @@ class Pixhawk:
         # Get mode ID
         mode_id = self.master.mode_mapping()[mode]
 
-        # Set new mode
-        self.master.mav.set_mode_send(
-            self.master.target_system,
-            mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
-            mode_id)
+        # Set new mode, ArduPilot acks the SET_MODE message with a COMMAND_ACK carrying its message id
+        ack = self.expect_ack(mavutil.mavlink.MAVLINK_MSG_ID_SET_MODE)
+        with self.mutex:
+            self.master.mav.set_mode_send(
+                self.master.target_system,
+                mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                mode_id)
 
-        ack = self.get_ack(mavutil.mavlink.MAVLINK_MSG_ID_SET_MODE, retry=3)
-        # self.mutex.release()
-        if ack:
+        if self.wait(ack) == mavutil.mavlink.MAV_RESULT_ACCEPTED:
             log.info("Manual mode success")
         else:
             log.info("Manual mode failed")
 
-    def arm(self):
+    """ Inbound messages """
+    def subscribe(self, type, callback=None):
+        """ Register a callback for a message type, and return the queue that collects messages of that type """
+        if callback:
+            self.callbacks.setdefault(type, []).append(callback)
+        return self.queues.setdefault(type, deque(maxlen=QUEUE_LENGTH))
+
+    def dispatch(self, message):
+        type = message.get_type()
+        if type == 'BAD_DATA':
+            BAD_DATA.inc()
+            return
+        MESSAGES.inc()
+        queue = self.queues.get(type)
+        if queue is not None:
+            queue.append(message)
+        for callback in self.callbacks.get(type, ()):
+            try:
+                callback(message)
+            except Exception as msg:
+                CALLBACK_ERRORS.inc()
+                log.error("%s callback failed: %s", type, msg)
+
+    def read(self, timeout=1):
+        """ Receive and dispatch one message, blocking up to timeout. Returns the message or None """
+        message = self.master.recv_match(blocking=True, timeout=timeout)
+        if message is not None:
+            self.dispatch(message)
+        return message
+
+    def poll(self):
+        """ Dispatch every message already received without blocking, for use as an event loop reader callback """
+        while True:
+            message = self.master.recv_match(blocking=False)
+            if message is None:
+                break
+            self.dispatch(message)
+
+    def start(self):
+        """ Run the reader on its own thread, again after a stop() """
+        self.stop_event.clear()
+        def reader():
+            while not self.stop_event.is_set():
+                self.read()
+        self.reader = threading.Thread(target=reader, daemon=True)
+        self.reader.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.reader:
+            self.reader.join()
+            self.reader = None
+
+    def get_feedback(self, timeout=5):
+        if self.read(timeout) is None:
+            FEEDBACK_TIMEOUTS.inc()
+            log.error("No message from the Pixhawk for %s s", timeout)
+
+    def on_heartbeat(self, message):
+        if message.system_status == 3:
+            self.armed = False
+            log.info("Pixhawk ready, waiting to be armed")
+
+        if message.system_status == 4:
+            self.armed = True
+
+        else:
+            self.armed = False
 
+        log.debug(mavutil.mavlink.enums['MAV_STATE'][message.system_status].description)
+        self.heartbeat += 1
+
+    def on_command_ack(self, message):
+        with self.mutex:
+            if message.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS or message.command not in self.pending:
+                return
+            future, params = self.pending.pop(message.command)
+
+        if message.result == mavutil.mavlink.MAV_RESULT_ACCEPTED:
+            if message.command == mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM:
+                self.armed = bool(params[0])
+        else:
+            log.debug(mavutil.mavlink.enums['MAV_RESULT'][message.result].description)
+        if not future.done():
+            future.set_result(message.result)
+
+    """ Commands """
+    def expect_ack(self, command, params=()):
+        """ Future resolved with the MAV_RESULT of the next COMMAND_ACK for command, replacing any older wait """
+        future = Future()
+        with self.mutex:
+            old = self.pending.get(command)
+            self.pending[command] = (future, params)
+        if old:
+            old[0].cancel()
+        return future
+
+    def command(self, command, *params):
+        """ Send a COMMAND_LONG and return a future resolved by its COMMAND_ACK """
+        params = (list(params) + [0]*7)[:7]
+        future = self.expect_ack(command, params)
+        with self.mutex:
+            self.master.mav.command_long_send(self.master.target_system, self.master.target_component,
+                                              command, 0, *params)
+        return future
+
+    def wait(self, future, timeout=COMMAND_TIMEOUT):
+        """ Block until the future resolves, reading the link ourselves if no reader is running. Returns None on timeout """
+        deadline = time.monotonic() + timeout
+        try:
+            if self.reader is None:
+                while not future.done() and time.monotonic() < deadline:
+                    self.read(deadline - time.monotonic())
+            return future.result(max(0, deadline - time.monotonic()))
+
+        except TimeoutError:
+            log.warning("No COMMAND_ACK after %s s", timeout)
+            self.forget(future)
+            return None
+        except CancelledError:
+            return None     # superseded by a newer request for the same command
+
+    def forget(self, future):
+        """ Give up on a command without its COMMAND_ACK """
+        COMMAND_TIMEOUTS.inc()
+        with self.mutex:
+            for command, (pending, params) in list(self.pending.items()):
+                if pending is future:
+                    del self.pending[command]
+        future.cancel()
+
+    def request_arm(self):
         # https://mavlink.io/en/messages/common.html
-        # Arm
-        self.mutex.acquire()
-        self.master.arducopter_arm()
-        self.armed = self.get_ack(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, retry=3)
-        self.mutex.release()
+        return self.command(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, 1)
+
+    def request_disarm(self):
+        return self.command(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, 0)
+
+    def arm(self, timeout=COMMAND_TIMEOUT):
+        self.wait(self.request_arm(), timeout)
 
         if self.armed:
             log.info("Arming success.")
         else:
             log.info("Arming failed")
+        return self.armed
 
-
-
-    def disarm(self):
-        self.mutex.acquire()
-        self.armed = self.master.arducopter_disarm()
-        self.armed = not self.get_ack(mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM, retry=3)
-        self.mutex.release()
+    def disarm(self, timeout=COMMAND_TIMEOUT):
+        self.wait(self.request_disarm(), timeout)
 
         if not self.armed:
             log.info("Disarming success.")
         else:
             log.warning("Disarming failed")
-
-    def get_ack(self, cmd, retry=1):
-        try:
-            for i in range(retry):
-                # Wait for ACK command
-                    ack_msg = self.master.recv_match(type='COMMAND_ACK', blocking=True).to_dict()
-                    if ack_msg["command"] == cmd and ack_msg['result'] == 0:
-                        return True
-                    else:
-                        log.debug(mavutil.mavlink.enums['MAV_RESULT'][ack_msg['result']].description)
-
-        except KeyError as msg:
-            log.debug("Packet received has no [%s] key", msg)
-
-        return False
+        return not self.armed
 
     def send_cmd(self, pitch, yaw):
         # https://mavlink.io/en/messages/common.html#MANUAL_CONTROL
         # Warning: Because of some legacy workaround, z will work between [0-1000]
         # where 0 is full reverse, 500 is no output and 1000 is full throttle.
         # x,y and r will be between [-1000 and 1000].
-        self.master.mav.manual_control_send( self.master.target_system,
-                                        pitch,
-                                        0,
-                                        500,
-                                        yaw,
-                                        0)
-
-    def get_feedback(self):
-        try:
-            self.mutex.acquire()
-            message = self.master.recv_match(blocking=True, timeout=5).to_dict()
-            if message['mavpackettype'] == 'HEARTBEAT':
-                if message['system_status'] == 3:
-                    self.armed = False
-                    log.info("Pixhawk ready, waiting to be armed")
-
-                if message['system_status'] == 4:
-                    self.armed = True
-
-                else:
-                    self.armed = False
-
-                log.debug(mavutil.mavlink.enums['MAV_STATE'][message['system_status']].description)
-                self.heartbeat += 1
-
-            log.debug(message)
-
-        except KeyError as msg:
-            log.error("Packet received has no [%s] key", msg)
-        except AttributeError as msg:
-            log.error(msg)
-        finally:
-            self.mutex.release()
+        with self.mutex:
+            self.master.mav.manual_control_send( self.master.target_system,
+                                            pitch,
+                                            0,
+                                            500,
+                                            yaw,
+                                            0)
+        MANUAL_CONTROL_SENT.inc()
+        if self.recorder:
+            self.recorder.effort(pitch, yaw)
+
         # Request parameter
         # self.master.mav.param_request_list_send(
         #     self.master.target_system, self.master.target_component,
         # )
-
-        # while(1):
-        #     message = self.master.recv_match().to_dict()
-        #     log.debug(message)
-        #     time.sleep(0.01)
         # # log.debug('name: %s value:%d', message['param_id'], message['param_value'])
 
 
+class ManualControlStreamer:
+    """
+    Convenient class owning the outbound MANUAL_CONTROL channel
+    Sends the latest pitch/yaw setpoint at a fixed rate, so setpoints updated faster than the rate are coalesced
+    and the autopilot sees regular timing. A setpoint older than stale_timeout is ramped to neutral.
+    autohoming.py runs the stream as a task on its event loop (stream), so the loop thread is the only one touching
+    the link. Scripts without an event loop run it on a thread of its own (start), sends then take Pixhawk.mutex.
+    """
+    def __init__(self, pixhawk, rate=STREAM_RATE, stale_timeout=STALE_TIMEOUT, ramp_rate=RAMP_RATE, clock=time.monotonic):
+        self.pixhawk = pixhawk
+        self.clock = clock
+        self.period = 1/rate
+        self.stale_timeout = stale_timeout
+        self.ramp_step = ramp_rate*self.period
+        self.pitch = 0
+        self.yaw = 0
+        self.updated = 0                # monotonic time of the last setpoint
+        self.output = (0, 0)            # what was last sent
+        self.fresh = False              # setpoint not sent yet
+        self.sent = 0
+        self.coalesced = 0              # setpoints replaced before they were sent
+        self.stale = True               # no setpoint yet, send neutral
+        self.timing_error = Histogram([0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1])
+        self.started = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def set(self, pitch, yaw):
+        """ New setpoint, picked up on the next tick """
+        if self.fresh:
+            self.coalesced += 1
+        self.pitch, self.yaw = int(pitch), int(yaw)
+        self.updated = self.clock()
+        self.fresh = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def next_output(self, now):
+        if now - self.updated <= self.stale_timeout:
+            self.stale = False
+            return self.pitch, self.yaw
+        if not self.stale:
+            self.stale = True
+            log.warning("MANUAL_CONTROL setpoint stale, ramping to neutral")
+        ramp = lambda value: value - max(-self.ramp_step, min(self.ramp_step, value))
+        return tuple(int(ramp(value)) for value in self.output)
+
+    def tick(self, now):
+        """ Send one MANUAL_CONTROL, the stream calls this every period (sim.py calls it on virtual time) """
+        self.output = self.next_output(now)
+        self.fresh = False
+        self.pixhawk.send_cmd(*self.output)
+        self.sent += 1
+
+    def next_tick(self, next_time):
+        """ Send the tick due at next_time, returns when the following one is due """
+        now = time.monotonic()
+        self.timing_error.observe(now - next_time)
+        self.tick(now)
+        next_time += self.period
+        return max(next_time, time.monotonic())     # fell behind, skip the missed ticks instead of bursting
+
+    def run(self):
+        self.started = time.monotonic()
+        next_time = self.started
+        while not self.stop_event.is_set():
+            next_time = self.next_tick(next_time)
+            self.stop_event.wait(next_time - time.monotonic())
+
+    async def stream(self):
+        """ The stream as a task of the running event loop, until cancelled or stopped """
+        self.started = time.monotonic()
+        next_time = self.started
+        while not self.stop_event.is_set():
+            next_time = self.next_tick(next_time)
+            await asyncio.sleep(next_time - time.monotonic())
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        ms = lambda s: round(1000*s, 2)
+        return {"rate_hz": round(self.sent/elapsed, 2) if elapsed else 0,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "stale": self.stale,
+                "timing_error_ms": [ms(self.timing_error.quantile(0.5)), ms(self.timing_error.quantile(0.99)), ms(self.timing_error.max)]}
+
 
 if __name__ == "__main__":
-    target = Pixhawk(DEVICE, BAUD)
+    target = Pixhawk(DEVICE, BAUD).start()
+    streamer = ManualControlStreamer(target).start()
     target.arm()
-    for i in range(10):
-        target.send_cmd(200,0)
-        target.get_feedback()
-        time.sleep(1)
+    for i in range(100):
+        streamer.set(200,0)
+        time.sleep(0.1)
 
+    streamer.set(0,0)
     target.disarm()
-
-
+    log.info(streamer.stats())
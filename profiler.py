@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+On-demand sampling profiler for the running control processes
+Nothing runs until a profile is asked for, by a "profile" command packet or by SIGUSR1: no tracing hook is ever set
+and no thread exists while idle. A profile is a sampler thread reading every thread's Python stack through
+sys._current_frames() at a fixed rate for a bounded window, then writing the counts as collapsed stacks, one line per
+distinct stack, "thread;outer;...;inner count", which flamegraph.pl and speedscope read directly.
+By default a stack counts the microseconds of CPU its thread used since the previous sample (the thread's CPU clock),
+so threads blocked in select or sleep weigh next to nothing and the flame graph shows where the CPU went.
+mode="wall" counts every thread once on every sample instead.
+    kill -USR1 $(pgrep -f autohoming.py)         # start, or stop early
+    python3 profiler.py /tmp/autohoming-*.folded  # per thread totals and the hottest functions
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+from collections import Counter
+import logging as log
+
+RATE = 100              # Hz, samples per second
+SECONDS = 30            # s, default window
+MAX_SECONDS = 600       # s, longest window a command can ask for
+MAX_STACKS = 20000      # distinct stacks kept, samples of newer ones are counted under TRUNCATED
+MAX_DEPTH = 100         # frames kept per stack, innermost first
+PROFILE_DIR = "/tmp"
+TRUNCATED = "[truncated]"
+
+def _cpu_clock(ident):
+    """ CPU clock of a thread, None where the platform has no per thread clocks """
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+def _frame_name(code):
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+class Profiler:
+    """ Convenient class for sampling the stacks of every thread of this process for a bounded window """
+    def __init__(self, name, directory=PROFILE_DIR, rate=RATE, seconds=SECONDS, mode="cpu"):
+        self.name = name                # process name, the start of the file name
+        self.directory = directory
+        self.rate = rate
+        self.seconds = seconds
+        self.mode = mode                # "cpu" or "wall"
+        self.mutex = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.last_path = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=None, rate=None):
+        """ Start a profile of seconds at rate Hz unless one is running, returns True if started """
+        seconds = min(MAX_SECONDS, seconds or self.seconds)
+        rate = max(1, min(1000, rate or self.rate))
+        with self.mutex:
+            if self.running:
+                return False
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, args=(seconds, rate), name="profiler", daemon=True)
+            self.thread.start()
+        log.info("Profiling %s for %s s at %s Hz", self.name, seconds, rate)
+        return True
+
+    def stop(self):
+        """ End the running profile early, its file is still written """
+        self.stop_event.set()
+
+    def toggle(self, *args):
+        """ Start a profile with the defaults, or stop the running one. Signal handler signature """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        """ Toggle on a signal, only the main thread may call this """
+        signal.signal(signum, self.toggle)
+        return self
+
+    def run(self, seconds, rate):
+        stacks = Counter()
+        cpu = Counter()                 # thread name -> CPU seconds over the window
+        clocks = {}                     # thread ident -> (clock id, CPU time at the previous sample)
+        names = {}
+        period = 1/rate
+        own = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + seconds
+        samples = 0
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                thread = names.get(ident, str(ident))
+                weight = 1 if self.mode == "wall" else self.cpu_used(ident, thread, clocks, cpu)
+                if not weight:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(thread)
+                key = ";".join(reversed(stack))
+                if key not in stacks and len(stacks) >= MAX_STACKS:
+                    key = thread + ";" + TRUNCATED
+                stacks[key] += weight
+            samples += 1
+            self.stop_event.wait(period)
+        self.write(stacks, samples, time.monotonic() - started, cpu)
+
+    def cpu_used(self, ident, thread, clocks, cpu):
+        """ Microseconds of CPU the thread used since the previous sample, one sample period without a CPU clock """
+        clock, last = clocks.get(ident, (None, None))
+        if clock is None:
+            clock = _cpu_clock(ident)
+            if clock is None:
+                return int(1e6/self.rate)
+        try:
+            now = time.clock_gettime(clock)
+        except OSError:
+            return 0                # thread ended between the snapshot and now
+        clocks[ident] = (clock, now)
+        if last is None:
+            return 0                # first sample of this thread, nothing to compare with
+        cpu[thread] += now - last
+        return int((now - last)*1e6)
+
+    def write(self, stacks, samples, elapsed, cpu):
+        path = os.path.join(self.directory, "{}-{}.folded".format(self.name, time.strftime("%Y%m%d-%H%M%S")))
+        try:
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        except OSError as msg:
+            log.error("Writing profile %s: %s", path, msg)
+            return
+        self.last_path = path
+        busiest = ", ".join("{} {:.1f} s".format(name, seconds) for name, seconds in cpu.most_common(5))
+        log.info("Profile of %s (%s): %d samples over %.1f s in %s%s", self.name, self.mode, samples, elapsed, path,
+                 ", CPU by thread: " + busiest if busiest else "")
+
+def summary(lines, top=15):
+    """ (total, most per thread, most per innermost function) of collapsed stack lines, in samples or CPU us """
+    threads, functions = Counter(), Counter()
+    for line in lines:
+        stack, _, count = line.rstrip("\n").rpartition(" ")
+        if not stack:
+            continue
+        frames = stack.split(";")
+        threads[frames[0]] += int(count)
+        functions[frames[-1]] += int(count)
+    return sum(threads.values()), threads.most_common(top), functions.most_common(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="collapsed stack file written by a profile")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        total, threads, functions = summary(f, args.top)
+    total = total or 1
+    print("{:<50}{:>10}{:>8}".format("thread", "count", "%"))
+    for name, count in threads:
+        print("{:<50}{:>10}{:>8.1f}".format(name, count, 100*count/total))
+    print()
+    print("{:<50}{:>10}{:>8}".format("innermost function", "count", "%"))
+    for name, count in functions:
+        print("{:<50}{:>10}{:>8.1f}".format(name, count, 100*count/total))
@@ -1,60 +1,174 @@
 #!/usr/bin/env python3
-import os
+"""
+Read the DOA bearing, power and confidence from the KerberosSDR web server and send them to autohoming through UDP
+compass.html only fills its doa/pwr/conf elements by fetching DOA_value.html with javascript, so the values are read
+straight from DOA_value.html over a keep-alive HTTP connection instead of rendering the page in a headless browser
+"""
 import re
+import sys
 import socket
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.chrome.options import Options
+import argparse
+import http.client
 import json
 import time
+import metrics
+from profiler import Profiler, PROFILE_DIR
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
 
 SERVERIP = '127.0.0.1'
+SERVERPORT = 8081
+DOA_PAGE = "/DOA_value.html"
 BEARING_OFFSET = 45
-
-options = Options()
-options.headless = True
-driver = webdriver.Chrome(options=options)
-driver.implicitly_wait(10)
-
-""" Compass page: get the bearing info """
-max_tries = 10
-""" Init page: disable DC compensation and FIR filter, and start processing """
-for i in range(max_tries):     # try 10 times
-    try:
-        driver.get("http://" + SERVERIP + ":8081/compass.html")
-        break
-    except ec.webdriverException as msg:
-        if i == max_tries-1:
-            raise
-        log.debug(msg)
-        time.sleep(1)
-
-doa = driver.find_element_by_id("doa")
-pwr = driver.find_element_by_id("pwr")
-conf = driver.find_element_by_id("conf")
+POLL_RATE = 5           # Hz, a new Hydra estimate (about 1 Hz) is picked up quickly, the bearing filter weighs repeats down
 
 UDP_IP = "127.0.0.1"
 UDP_PORT = 5001
-print("Sending bearing value through UDP...")
-print("UDP target IP: %s" % UDP_IP)
-print("UDP target port: %s" % UDP_PORT)
-sock = socket.socket(socket.AF_INET, # Internet
-                     socket.SOCK_DGRAM) # UDP
-packet = {}
-print("Radio compass started")
-
-while(True):
-    bearing = re.findall(r'\d+', doa.text)[0]
-    power = re.findall(r'\d+', pwr.text)[0]
-    confidence = re.findall(r'\d+', conf.text)[0]
-    packet['bearing'] = int(bearing) - BEARING_OFFSET
-    packet['power'] = int(power)
-    packet['confidence'] = int(confidence)
-    message = json.dumps(packet)
-    log.debug(message)
-    sock.sendto(message.encode(), (UDP_IP, UDP_PORT))
-    time.sleep(1)
 
+READS = metrics.counter("compass_readings_total", "DOA readings sent to autohoming")
+READ_ERRORS = {reason: metrics.counter("compass_read_errors_total", "Polls of the DOA page without a reading", reason=reason)
+               for reason in ("connection", "status", "parse")}
+READ_SECONDS = metrics.histogram("compass_read_seconds", "Time of one poll of the DOA page",
+                                 bounds=[0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2])
+OVERRUNS = metrics.counter("compass_overruns_total", "Polls that took longer than the poll period")
+
+class HTTPFeed:
+    """ Convenient class for polling DOA_value.html over a single keep-alive HTTP connection """
+    pattern = re.compile(rb'<(DOA|PWR|CONF)>\s*(-?\d+)')
+
+    def __init__(self, host=SERVERIP, port=SERVERPORT, page=DOA_PAGE, timeout=2):
+        self.page = page
+        self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def read(self):
+        """ Return (bearing, power, confidence) as ints, or None if the page could not be read """
+        try:
+            self.conn.request("GET", self.page)
+            response = self.conn.getresponse()
+            body = response.read()      # always drain the body, otherwise the connection cannot be reused
+            if response.status != 200:
+                READ_ERRORS["status"].inc()
+                log.warning("%s returned HTTP %d", self.page, response.status)
+                return None
+
+        except (OSError, http.client.HTTPException) as msg:
+            READ_ERRORS["connection"].inc()
+            log.warning(msg)
+            self.conn.close()           # next request reconnects
+            return None
+
+        fields = dict(self.pattern.findall(body))
+        try:
+            return int(fields[b'DOA']), int(fields[b'PWR']), int(fields[b'CONF'])
+        except KeyError as msg:
+            READ_ERRORS["parse"].inc()
+            log.error("Page has no %s field\nReceived: %s", msg, body)
+            return None
+
+    def close(self):
+        self.conn.close()
+
+class SeleniumFeed:
+    """ Previous approach, kept for comparison: render compass.html in headless Chrome and scrape the elements """
+    def __init__(self, host=SERVERIP, port=SERVERPORT, page="/compass.html", max_tries=10):
+        from selenium import webdriver
+        from selenium.common.exceptions import WebDriverException
+        from selenium.webdriver.chrome.options import Options
+
+        options = Options()
+        options.headless = True
+        self.driver = webdriver.Chrome(options=options)
+        self.driver.implicitly_wait(10)
+
+        for i in range(max_tries):     # try 10 times
+            try:
+                self.driver.get("http://{}:{}{}".format(host, port, page))
+                break
+            except WebDriverException as msg:
+                if i == max_tries-1:
+                    raise
+                log.debug(msg)
+                time.sleep(1)
+
+        self.doa = self.driver.find_element_by_id("doa")
+        self.pwr = self.driver.find_element_by_id("pwr")
+        self.conf = self.driver.find_element_by_id("conf")
+
+    def read(self):
+        try:
+            bearing = re.findall(r'\d+', self.doa.text)[0]
+            power = re.findall(r'\d+', self.pwr.text)[0]
+            confidence = re.findall(r'\d+', self.conf.text)[0]
+            return int(bearing), int(power), int(confidence)
+        except IndexError:
+            return None
+
+    def close(self):
+        self.driver.quit()
+
+class CompassSender:
+    """ Convenient class for packing a reading into the UDP packet RadioCompass.update consumes """
+    def __init__(self, UDP_IP=UDP_IP, UDP_PORT=UDP_PORT):
+        self.addr = (UDP_IP, UDP_PORT)
+        self.sock = socket.socket(socket.AF_INET, # Internet
+                                  socket.SOCK_DGRAM) # UDP
+
+    def send(self, reading):
+        bearing, power, confidence = reading
+        packet = {}
+        packet['bearing'] = bearing - BEARING_OFFSET
+        packet['power'] = power
+        packet['confidence'] = confidence
+        message = json.dumps(packet)
+        self.sock.sendto(message.encode(), self.addr)
+        return message
+
+def run(feed, sender, rate=POLL_RATE, duration=None):
+    """ Poll the feed at a fixed rate and forward every reading. Returns the number of readings sent """
+    period = 1/rate
+    count = 0
+    start = time.monotonic()
+    next_time = start
+    while duration is None or time.monotonic() - start < duration:
+        started = time.perf_counter()
+        reading = feed.read()
+        READ_SECONDS.observe(time.perf_counter() - started)
+        if reading:
+            message = sender.send(reading)
+            READS.inc()
+            count += 1
+            log.debug(message)
+
+        next_time += period
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            OVERRUNS.inc()
+            next_time = time.monotonic()    # fell behind, don't try to catch up with a burst
+
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=float, default=POLL_RATE, help="poll rate in Hz")
+    parser.add_argument("--selenium", action="store_true", help="use the headless Chrome scraper instead of plain HTTP")
+    parser.add_argument("--metrics-port", type=int, default=metrics.PORT_COMPASS, help="local HTTP metrics endpoint, 0 to disable")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="where profiles started by SIGUSR1 go, this process takes no commands")
+    args = parser.parse_args()
+    metrics.serve(args.metrics_port)
+    Profiler("radio_compass", args.profile_dir).install_signal()
+
+    feed = SeleniumFeed() if args.selenium else HTTPFeed()
+    sender = CompassSender()
+    print("Sending bearing value through UDP...")
+    print("UDP target IP: %s" % UDP_IP)
+    print("UDP target port: %s" % UDP_PORT)
+    print("Radio compass started")
+
+    try:
+        run(feed, sender, args.rate)
+    finally:
+        feed.close()
+    sys.exit(0)
@@ -2,17 +2,31 @@
 """
 Act as relay server for the pi to compile and sort serial packet and send through UDP to the appropriate port, and vice versa
 Swith to Pi serial console mode when commanded to
+Packets are routed by their (type, cmd) key through a routing table, from one selector loop over the UDP socket and the serial port
+The LORA UART is half duplex, lora_link.py takes turns with the ground station and frames everything on it
+Commands for autohoming are acked by autohoming once applied, the relay only retries the localhost hop and routes the ack
+back to the link the command came from. Commands carrying an id ("seq") are applied once, retransmissions are just acked.
+A relay serves one or more vehicles (--vehicle), each with its own autohoming ports. Packets naming a vehicle ("vid")
+go to that vehicle and are dropped when it is not one of ours, so the ground station can address boats sharing a
+network. Packets going up are stamped with the vehicle they come from.
 """
 import subprocess
-from subprocess import PIPE, Popen
 
 import os
+import sys
 import time
-import threading
 import atexit
 import socket
+import argparse
+import selectors
+from collections import OrderedDict
 import serial
-import json
+import codec
+import telemetry
+import lora_link
+import metrics
+from profiler import Profiler, PROFILE_DIR
+from jobs import JobManager, TICK
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
 
@@ -43,159 +57,506 @@ IP_BROADCAST = "255.255.255.255"
 IP_ANY = "0.0.0.0"
 
 """ Device specific settings """
+USE_SERIAL = False     # LORA UART relay is off, WIFI only
 BAUD = 115200    # baud of LORA UART
 DEVICE = "/dev/serial0"
 # DEVICE = "./pttyout"
 
+STATS_PERIOD = 60      # seconds between route counter reports
+COMMAND_RETRY = 0.3    # seconds before a command is forwarded to autohoming again without its applied ack
+COMMAND_TRIES = 3      # forwards per command, the ground station retries over the radio after that
+APPLIED_CACHE = 256    # command ids remembered, their retransmissions are acked without applying or forwarding them
+EXIT_DRAIN = 2         # seconds the exit command waits for the LORA link to send its ack
+DEFAULT_VID = 0        # vehicle id of a relay started without --vehicle
+SYNC_DONE_MARKER = "done"      # kerberos_sync.py prints "Sync process done in X s"
+LOOP_BOUNDS = [0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05]     # s
+
+DECODE_ERRORS = metrics.counter("relay_decode_errors_total", "Packets the relay had to decode and could not")
+LOOP_SECONDS = metrics.histogram("relay_loop_seconds", "Time to handle the sockets ready after one select", bounds=LOOP_BOUNDS)
+
 def demote(user_uid):
    def result():
       os.setuid(user_uid)
    return result
 
+def demote_if_root(user_uid):
+    return demote(user_uid) if os.geteuid() == 0 else None
+
+def open_serial(device=DEVICE, baud=BAUD):
+    try:
+        ser = serial.Serial(device, baud, timeout=0)
+        time.sleep(1)   # a bug in pyserial requires to wait a little before it can be used (or flush)
+        ser.reset_input_buffer()
+        return ser
+    except serial.SerialException as msg:
+        log.error(msg)
+        raise
+
+class Vehicle:
+    """ Convenient class for the autohoming endpoints of one vehicle behind this relay """
+    def __init__(self, vid, cmd_port=PORT_CMD, js_port=PORT_JS):
+        self.vid = vid
+        self.cmd_addr = (LOCALHOST, cmd_port)
+        self.js_addr = (LOCALHOST, js_port)
+        self.up = 0                     # packets from this vehicle to the ground station
+        self.down = 0                   # packets from the ground station to this vehicle
+
+def parse_vehicle(text):
+    """ VID or VID:CMD_PORT:JS_PORT """
+    fields = [int(f) for f in text.split(":")]
+    if len(fields) not in (1, 3) or not 0 <= fields[0] <= 255:
+        raise argparse.ArgumentTypeError("expected VID or VID:CMD_PORT:JS_PORT with VID in 0-255: " + text)
+    return Vehicle(*fields)
+
+""" Destinations: anything with send(message, key) can be put in the routing table """
+class UDPDestination:
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+
+    def send(self, message, key):
+        self.sock.sendto(message, self.addr)
+
+class GCSDestination:
+    """ Broadcast to the ground stations, stamped with the vehicle the packet comes from """
+    def __init__(self, server, addr=(IP_BROADCAST, PORT_GUI)):
+        self.server = server
+        self.addr = addr
+
+    def send(self, message, key):
+        vehicle = self.server.vehicle
+        if codec.peek_vid(message) is None:
+            try:
+                message = codec.with_vid(message, vehicle.vid)
+            except codec.DecodeError as msg:
+                DECODE_ERRORS.inc()         # a JSON packet is decoded to stamp it, a broken one is dropped here
+                log.debug("Dropping malformed upstream packet: %s", msg)
+                return
+        vehicle.up += 1
+        self.server.sock.sendto(message, self.addr)
+
+class VehicleDestination:
+    """ Joystick port of the vehicle the packet is addressed to """
+    def __init__(self, server):
+        self.server = server
+
+    def send(self, message, key):
+        vehicle = self.server.vehicle
+        vehicle.down += 1
+        self.server.sock.sendto(message, vehicle.js_addr)
+
+class SerialTelemDestination:
+    """ Hands the latest telemetry to the delta encoder of the LORA UART """
+    def __init__(self, server):
+        self.server = server
+
+    def send(self, message, key):
+        if self.server.vehicle.vid != self.server.default_vid:
+            return              # one vehicle's telemetry fits the radio, the first one's
+        try:
+            self.server.telemetry.update(codec.decode(message))
+        except codec.DecodeError:
+            DECODE_ERRORS.inc()
+            log.debug("Corrupt telemetry: %s", message)
+
+def command_id(message):
+    """ (seq, sid) of a command or ack, seq is None for older GUIs that send none, sid for GUIs without sessions """
+    try:
+        packet = codec.decode(message)
+    except codec.DecodeError:
+        return None, None
+    return packet.get("seq"), packet.get("sid")
+
+class CommandDestination:
+    """ Forward a command to the autohoming of the vehicle it is addressed to, which acks it once applied """
+    def __init__(self, server):
+        self.server = server
+
+    def send(self, message, key):
+        vehicle = self.server.vehicle
+        vehicle.down += 1
+        self.server.forward_command(message, key[1], vehicle)
+
+class LocalCommand:
+    """
+    Command the relay applies itself, run once per id and acked once run, or again for a retransmission
+    A function returning False refused the command and reported why, the command is not acked then
+    """
+    def __init__(self, server, function, ack_first=False):
+        self.server = server
+        self.function = function
+        self.ack_first = ack_first      # ack before running it, for exit that does not come back
+
+    def send(self, message, key):
+        cmd = key[1]
+        seq, sid = command_id(message)
+        if not self.server.first_time(cmd, seq, sid):
+            self.server.send_ack(cmd, seq, sid=sid)
+            return
+        if self.ack_first:
+            self.server.send_ack(cmd, seq, sid=sid)
+        if self.function(message) is False:
+            self.server.forget_applied(cmd, seq, sid)
+            return
+        if not self.ack_first:
+            self.server.send_ack(cmd, seq, sid=sid)
+
+class ForwardedCommand:
+    """ Command forwarded to autohoming and waiting for its applied ack """
+    def __init__(self, message, vehicle, origin, now):
+        self.message = message
+        self.vehicle = vehicle
+        self.origin = origin
+        self.tries = 1
+        self.next_try = now + COMMAND_RETRY
+
+class Handler:
+    """ Call a function with the raw message """
+    def __init__(self, function):
+        self.function = function
+
+    def send(self, message, key):
+        self.function(message)
+
+class Route:
+    """ Destinations of one routing key, and counters of what went through it """
+    def __init__(self, destinations):
+        self.destinations = destinations
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def forward(self, message, key):
+        self.packets += 1
+        self.bytes += len(message)
+        for destination in self.destinations:
+            try:
+                destination.send(message, key)
+            except OSError as msg:
+                self.errors += 1
+                log.error("%s: %s", key, msg)
+
 class RelayServer:
-    """ Convenient class for forwarding JSON packet to the appropriate port """
-    def __init__(self):
-        self.serial_idle = threading.Event()       # the LORA module corrupt message a lot if sending & receiving at the same time. Use Event to cease sending telem if start receiving command, and start sending telem once no longer receiving command
-        self.to_be_written_to_serial = None
-        # try:
-        #     self.ser = serial.Serial(DEVICE, BAUD, timeout=1)
-        #     time.sleep(1)   # a bug in pyserial requires to wait a little before it can be used (or flush)
-        #     self.ser.reset_input_buffer()
-        # except serial.SerialException as msg:
-        #     log.error(msg)
-        #     raise
-        
+    """ Convenient class for forwarding packets to the appropriate port, table driven """
+    def __init__(self, port=PORT_RELAY, ser=None, sync_command=cmd_start_kerberos, restart_command=cmd_restart, vehicles=None):
+        self.ser = ser
+        vehicles = vehicles or [Vehicle(DEFAULT_VID)]
+        self.vehicles = {v.vid: v for v in vehicles}
+        self.default_vid = vehicles[0].vid  # packets naming no vehicle are for and from the first one
+        self.vehicle = vehicles[0]          # vehicle of the packet being processed
+        self.other_vehicles = 0             # packets for vehicles of another relay
+        self.sync_command = sync_command
+        self.restart_command = restart_command
+        self.telemetry = telemetry.TelemetryEncoder()
+        self.next_serial_telem = 0
+        self.origin = None                  # link the packet being processed came from, acks go back the same way
+        self.forwarded = {}                 # (vid, cmd, seq, sid) -> ForwardedCommand
+        self.applied = OrderedDict()        # (vid, cmd, seq, sid) of the latest commands applied
+        self.commands = {"forwarded": 0, "retries": 0, "expired": 0, "applied": 0, "duplicates": 0}
+        self.next_stats = time.monotonic() + STATS_PERIOD
+        self.unrouted = 0
+
         self.sock = socket.socket(socket.AF_INET,   # Internet
                                 socket.SOCK_DGRAM)  # UDP
-        self.sock.bind((IP_ANY, PORT_RELAY))
+        self.sock.bind((IP_ANY, port))
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.sock.setblocking(True)
-    
-    def process_serial(self):
-        try:
-            message = self.ser.readline()
-            log.debug(message)
-            if not message:
-                self.serial_idle.set()
-                # log.debug("serial_idle: Serial read timeout")
-                return
+        self.sock.setblocking(False)
 
-            else:
-                # Perform simple handshaking
-                self.serial_idle.clear()
-                tries = 5
-                for i in range (tries):
-                    if message == b'\n':      # empty message to signal real messages coming next
-                        self.ser.write(b'\n')
-                        message = self.ser.readline()
-                    else:
-                        break
-                
-                self.process(message)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.process_udp)
+        self.link = None
+        if self.ser:
+            self.link = lora_link.LoraLink(self.ser, master=False, on_receive=self.process_serial)
+            self.link.fill = self.serial_telem
+            self.selector.register(self.link.fileno(), selectors.EVENT_READ, self.link.read)
+        self.jobs = JobManager(self.selector, self.report_job)
+        self.profiler = Profiler("relayserver")
+
+        self.routes = {}
+        self.default_routes()
+        self.export_metrics()
+
+    def add_route(self, type, cmd=None, *destinations):
+        """ Route packets of this type (and command) to the destinations, cmd None matches any command """
+        self.routes[(type, cmd)] = Route(list(destinations))
+
+    def default_routes(self):
+        gui = GCSDestination(self)
+        autohoming_cmd = CommandDestination(self)
+        self.add_route("telem", None, gui, SerialTelemDestination(self))
+        self.add_route("stats", None, gui)
+        self.add_route("js", None, VehicleDestination(self))
+        for cmd in ("arm", "tune", "threshold"):
+            self.add_route("cmd", cmd, autohoming_cmd)
+        self.add_route("cmd", "profile", Handler(self.profile), autohoming_cmd)     # both processes, autohoming acks
+        self.add_route("ack", None, Handler(self.command_applied))
+        self.add_route("cmd", "sync", LocalCommand(self, self.start_kerberos))
+        self.add_route("cmd", "exit", LocalCommand(self, self.exit, ack_first=True))
+        self.add_route("cmd", "restart", LocalCommand(self, self.restart))
+        self.add_route("cmd", "cancel", LocalCommand(self, self.cancel))
+        self.add_route(telemetry.TYPE_REPORT, None, Handler(self.telemetry_report))
+
+    def export_metrics(self):
+        """ Counters the relay keeps anyway, read at scrape time """
+        for (type, cmd), route in self.routes.items():
+            name = type if cmd is None else type + "/" + cmd
+            metrics.counter("relay_route_packets_total", "Packets routed per routing key", function=lambda r=route: r.packets, route=name)
+            metrics.counter("relay_route_bytes_total", "Bytes routed per routing key", function=lambda r=route: r.bytes, route=name)
+            metrics.counter("relay_route_errors_total", "Send errors per routing key", function=lambda r=route: r.errors, route=name)
+        metrics.counter("relay_unrouted_total", "Packets without a route", function=lambda: self.unrouted)
+        metrics.counter("relay_other_vehicle_total", "Packets for vehicles of another relay", function=lambda: self.other_vehicles)
+        for vid, vehicle in self.vehicles.items():
+            metrics.counter("relay_vehicle_up_total", "Packets from a vehicle to the ground stations", function=lambda v=vehicle: v.up, vid=vid)
+            metrics.counter("relay_vehicle_down_total", "Packets from the ground stations to a vehicle", function=lambda v=vehicle: v.down, vid=vid)
+        for event in self.commands:
+            metrics.counter("relay_commands_total", "Commands for autohoming by outcome", function=lambda e=event: self.commands[e], event=event)
+        metrics.gauge("relay_commands_in_flight", "Commands forwarded and waiting for their applied ack", function=lambda: len(self.forwarded))
+        if self.link:
+            for key in ("frames_tx", "frames_rx", "crc_errors", "passes", "reclaims", "dropped"):
+                metrics.counter("relay_link_" + key + "_total", "LORA link " + key.replace("_", " "),
+                                function=lambda k=key: self.link.stats()[k])
+
+    def process(self, message, origin="udp"):
+        self.origin = origin
+        vid = codec.peek_vid(message)
+        self.vehicle = self.vehicles.get(self.default_vid if vid is None else vid)
+        if self.vehicle is None:
+            self.other_vehicles += 1
+            return
+        key = codec.peek(message)
+        route = self.routes.get(key) or self.routes.get((key[0], None))
+        if route is None:
+            self.unrouted += 1
+            log.debug("No route for %s: %s", key, message)
+            return
+        route.forward(message, key)
 
-        except Exception as msg:
-            log.error(msg)
-                    
     def process_udp(self):
-        try:
-            message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes    
-            
-            if message:
-                tries = 5
-                for i in range (tries):
-                    if message == b'\n':      # empty message to signal real messages coming next
-                        self.sock.sendto(b'\n', (IP_BROADCAST, PORT_GUI))
-                        message, addr = self.sock.recvfrom(1024)
-                    else:
-                        break
+        while True:
+            try:
+                message, addr = self.sock.recvfrom(1024) # buffer size is 1024 bytes
+            except BlockingIOError:
+                return
+            if message == b'\n':      # empty message to signal real messages coming next
+                self.sock.sendto(b'\n', (IP_BROADCAST, PORT_GUI))
+            elif message:
                 self.process(message)
 
-        except UnicodeDecodeError:
-            log.error("Gargabe characters received: %s", message)
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\n\tReceived msg: %s", message)
-    
-    def process(self, message):
+    def process_serial(self, payload):
+        """ Payload of a LORA frame, the link layer has done the framing and turn taking """
+        self.process(payload, "serial")
+
+    def serial_telem(self, room):
+        """ Link fill callback: the next telemetry packet when its rate allows one, sent in the turn being taken """
+        now = time.monotonic()
+        if now < self.next_serial_telem:
+            return None
+        self.next_serial_telem = now + self.telemetry.period()
+        return self.telemetry.next_packet(now)
+
+    def telemetry_report(self, message):
         try:
-            log.debug(message)
-            packet = json.loads(message.decode())
-
-            if packet.get("type") == "telem":
-                self.sock.sendto(message, (IP_BROADCAST, PORT_GUI))
-                self.to_be_written_to_serial = message
-
-            elif packet.get("type") == "js":
-                self.sock.sendto(message, (LOCALHOST, PORT_JS))
-
-            elif packet.get("type") == "cmd":
-                # time.sleep(0.1)     # wait a little before sending ack
-
-                if packet.get("cmd") == "arm":
-                    self.send_ack("arm")
-                    self.sock.sendto(message, (LOCALHOST, PORT_CMD))
-
-                elif packet.get("cmd") == "tune":
-                    self.send_ack("tune")
-                    self.sock.sendto(message, (LOCALHOST, PORT_CMD))
-                
-                elif packet.get("cmd") == "threshold":
-                    self.send_ack("threshold")
-                    self.sock.sendto(message, (LOCALHOST, PORT_CMD))
-
-                elif packet.get("cmd") == "sync":
-                    self.send_ack("sync")
-                    process = Popen(cmd_start_kerberos, preexec_fn=demote(1000), stdout=PIPE, stderr=PIPE, bufsize=1)
-
-                    for line in process.stdout:
-                        self.sock.sendto(line, (IP_BROADCAST, PORT_GUI))
-                        # self.ser.write(line)
-                        log.info(line.decode())
-                        if "done" in line.decode():
-                            break
-
-                    time.sleep(1)
-
-                elif packet.get("cmd") == "exit":
-                    self.send_ack("exit")
-                    time.sleep(1)
-                    exit(0)
-
-                elif packet.get("cmd") == "restart":
-                    self.send_ack("restart")
-                    process = Popen(cmd_restart, stdout=PIPE, stderr=PIPE, bufsize=1)
-                
-        except json.JSONDecodeError:
-            log.error("Corrupt or incorrect format\n\tReceived msg: %s", message)
-
-    def send_ack(self, cmd):
+            self.telemetry.report(codec.decode(message))
+        except codec.DecodeError:
+            DECODE_ERRORS.inc()
+            log.debug("Corrupt telemetry report: %s", message)
+
+    """ Commands """
+    def first_time(self, cmd, seq, sid=None):
+        """ Remember an applied command id of the current vehicle, False if it was applied already """
+        if seq is None:
+            return True
+        if (self.vehicle.vid, cmd, seq, sid) in self.applied:
+            self.commands["duplicates"] += 1
+            return False
+        self.applied[(self.vehicle.vid, cmd, seq, sid)] = True
+        if len(self.applied) > APPLIED_CACHE:
+            self.applied.popitem(last=False)
+        return True
+
+    def forget_applied(self, cmd, seq, sid=None):
+        """ A local command was refused, its retransmissions are tried again """
+        self.applied.pop((self.vehicle.vid, cmd, seq, sid), None)
+
+    def forward_command(self, message, cmd, vehicle):
+        seq, sid = command_id(message)
+        if seq is not None:
+            key = (vehicle.vid, cmd, seq, sid)
+            if key in self.applied:
+                self.commands["duplicates"] += 1        # applied, its ack was lost on the way to the ground station
+                self.send_ack(cmd, seq, sid=sid)
+                return
+            pending = self.forwarded.get(key)
+            if pending:
+                self.commands["duplicates"] += 1        # still being retried here, the ack goes wherever it came from last
+                pending.origin = self.origin
+                return
+            self.forwarded[key] = ForwardedCommand(message, vehicle, self.origin, time.monotonic())
+        self.commands["forwarded"] += 1
+        self.sock.sendto(message, vehicle.cmd_addr)
+
+    def command_applied(self, message):
+        """ Ack from autohoming, the command has been applied """
+        try:
+            packet = codec.decode(message)
+        except codec.DecodeError:
+            DECODE_ERRORS.inc()
+            log.debug("Corrupt ack: %s", message)
+            return
+        cmd, seq, sid = packet.get("cmd"), packet.get("seq"), packet.get("sid")
+        pending = self.forwarded.pop((self.vehicle.vid, cmd, seq, sid), None)
+        if seq is not None and pending is None and (self.vehicle.vid, cmd, seq, sid) in self.applied:
+            return          # ack of a retry that crossed the first ack
+        self.commands["applied"] += 1
+        self.first_time(cmd, seq, sid)
+        self.send_ack(cmd, seq, pending.origin if pending else "udp", sid)
+
+    def retry_commands(self, now):
+        for key, pending in list(self.forwarded.items()):
+            if now < pending.next_try:
+                continue
+            if pending.tries >= COMMAND_TRIES:
+                del self.forwarded[key]
+                self.commands["expired"] += 1
+                log.warning("No applied ack from autohoming of vehicle %s for %s #%s", *key[:3])
+                continue
+            pending.tries += 1
+            pending.next_try = now + COMMAND_RETRY
+            self.commands["retries"] += 1
+            try:
+                self.sock.sendto(pending.message, pending.vehicle.cmd_addr)
+            except OSError as msg:
+                log.error("%s: %s", key, msg)
+
+    def send_ack(self, cmd, seq=None, origin=None, sid=None):
         packet={}
         packet["type"] = "ack"
         packet["cmd"] = cmd
-        reply = (json.dumps(packet) + '\n')
-        # self.ser.write(reply.encode())    # endline is important for framing
-        self.sock.sendto(reply.encode(), (IP_BROADCAST, PORT_GUI))
+        if seq is not None:
+            packet["seq"] = seq
+            if sid is not None:
+                packet["sid"] = sid
+        packet["vid"] = self.vehicle.vid
+        origin = self.origin if origin is None else origin
+        if origin == "serial":
+            self.link.send(codec.encode_json(packet), lora_link.COMMAND)
+        else:
+            self.sock.sendto(codec.encode(packet), (IP_BROADCAST, PORT_GUI))
 
-    def serial_processing_thread(self):
-        while True:
-            self.process_serial()
+    def profile(self, message):
+        try:
+            packet = codec.decode(message)
+        except codec.DecodeError:
+            DECODE_ERRORS.inc()
+            return
+        self.profiler.start(packet.get("seconds"), packet.get("rate"))
 
-    def udp_processing_thread(self):
-        while True:
-            self.process_udp()
+    def start_kerberos(self, message):
+        """ Sync runs for 30+ s, its output is streamed to the GUI from the loop while routing carries on """
+        return self.start_job("sync", [self.sync_command], done_marker=SYNC_DONE_MARKER, preexec_fn=demote_if_root(1000))
 
-    def serial_telem_thread(self):
-        while True:
-            self.serial_idle.wait()
-            self.ser.write(self.to_be_written_to_serial + b'\n')    # endline is important for framing
-            time.sleep(1)       # LORA UART is slow
+    def restart(self, message):
+        return self.start_job("restart", [self.restart_command])
+
+    def start_job(self, name, args, **kwargs):
+        """ False, reported to the ground stations as a refused job, if the job cannot start now """
+        if self.jobs.start(name, args, **kwargs):
+            return True
+        job = self.jobs.jobs.get(name)
+        reason = "already {}".format(job.state) if job and not job.finished else "could not start"
+        self.send_job({"type": "job", "job": name, "state": "refused", "line": reason, "vid": self.default_vid})
+        return False
+
+    def cancel(self, message):
+        """ Cancel the job named in the packet, or every running job """
+        try:
+            name = codec.decode(message).get("job")
+        except codec.DecodeError:
+            name = None
+        if not self.jobs.cancel(name):
+            log.info("No job to cancel")
 
+    def report_job(self, job, line):
+        packet = {"type": "job", "job": job.name, "state": job.state, "vid": self.default_vid}
+        if line is not None:
+            packet["line"] = line
+        self.send_job(packet)
+
+    def send_job(self, packet):
+        self.sock.sendto(codec.encode(packet), (IP_BROADCAST, PORT_GUI))
+        # self.ser.write(codec.encode_json(packet) + b'\n')
+
+    def exit(self, message):
+        deadline = time.monotonic() + EXIT_DRAIN
+        while self.link and self.link.pending() and time.monotonic() < deadline:
+            if self.ser.in_waiting:
+                self.link.read()
+            else:
+                self.link.poll()        # the ack waits for our turn on the radio
+                time.sleep(lora_link.TICK)
+        time.sleep(1)
+        sys.exit(0)
+
+    def stats(self):
+        """ Per route counters, keyed 'type' or 'type/cmd' """
+        stats = {"unrouted": self.unrouted, "jobs": self.jobs.stats(), "commands": dict(self.commands, in_flight=len(self.forwarded)),
+                 "vehicles": {vid: {"up": v.up, "down": v.down} for vid, v in self.vehicles.items()},
+                 "other_vehicles": self.other_vehicles, "decode_errors": DECODE_ERRORS.value}
+        if self.link:
+            stats["serial_telem"] = self.telemetry.stats()
+            stats["link"] = self.link.stats()
+        for (type, cmd), route in self.routes.items():
+            stats[type if cmd is None else type + "/" + cmd] = {"packets": route.packets, "bytes": route.bytes, "errors": route.errors}
+        return stats
+
+    def run_once(self, timeout=None):
+        ready = self.selector.select(timeout)
+        if ready:
+            started = time.perf_counter()
+            for key, events in ready:
+                key.data()
+            LOOP_SECONDS.observe(time.perf_counter() - started)
+        if self.jobs.jobs:
+            self.jobs.tick()
+        if self.link:
+            self.link.poll()
+        now = time.monotonic()
+        if self.forwarded:
+            self.retry_commands(now)
+        if now >= self.next_stats:
+            log.info("Routes: %s", self.stats())
+            self.next_stats = now + STATS_PERIOD
+
+    def run(self):
+        while True:
+            timeout = STATS_PERIOD
+            if self.link:
+                # wake for the link's own timers, and for telemetry that may go in a turn we hold
+                due = self.link.deadline()
+                if self.link.token:
+                    due = min(due, self.next_serial_telem)
+                timeout = max(0, due - time.monotonic())
+            if self.jobs.active():
+                timeout = min(timeout, TICK)
+            if self.forwarded:
+                timeout = min(timeout, max(0, min(p.next_try for p in self.forwarded.values()) - time.monotonic()))
+            self.run_once(timeout)
 
-server = RelayServer()
 
 if __name__ == "__main__":
-    serial_processing_task = threading.Thread(target=server.serial_processing_thread)
-    udp_processing_task = threading.Thread(target=server.udp_processing_thread)
-    serial_telem_task = threading.Thread(target=server.serial_telem_thread)
-    # serial_telem_task.start()
-    # serial_processing_task.start()
-    udp_processing_task.start()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sync", default=cmd_start_kerberos, help="script run by the sync command")
+    parser.add_argument("--restart", default=cmd_restart, help="script run by the restart command")
+    parser.add_argument("--serial", default=DEVICE if USE_SERIAL else None, help="LORA UART, e.g. the vehicle end of lora_link.py sim")
+    parser.add_argument("--vehicle", type=parse_vehicle, action="append",
+                        help="VID or VID:CMD_PORT:JS_PORT of a vehicle served, repeatable, the first one is the default (0)")
+    parser.add_argument("--metrics-port", type=int, default=metrics.PORT_RELAY, help="local HTTP metrics endpoint, 0 to disable")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="where profiles started by SIGUSR1 or the profile command go")
+    args = parser.parse_args()
+
+    server = RelayServer(ser=open_serial(args.serial) if args.serial else None, sync_command=args.sync, restart_command=args.restart,
+                         vehicles=args.vehicle)
+    metrics.serve(args.metrics_port)
+    server.profiler.directory = args.profile_dir
+    server.profiler.install_signal()
+    server.run()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Event-triggered scheduling of the control step
+A step runs as soon as a new sample is signalled, but never more often than min_period and never less often than max_period
+Step latency, start jitter and overruns are kept in fixed-bucket histograms for logging and telemetry
+"""
+import time
+import asyncio
+from bisect import bisect_left
+import logging as log
+
+LATENCY_BOUNDS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]     # seconds
+
+class Histogram:
+    """ Convenient class for a running histogram over fixed bucket upper bounds, constant memory """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = list(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*(len(self.bounds) + 1)     # last bucket catches everything above the largest bound
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile, capped at the largest value seen """
+        if not self.count:
+            return 0
+        rank = q*self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "mean": self.total/self.count if self.count else 0,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "max": self.max,
+                "buckets": list(zip(self.bounds + [float("inf")], self.counts))}
+
+class ControlScheduler:
+    """ Convenient class for running a control step on new samples, within a minimum and maximum period """
+    def __init__(self, step, min_period=0.02, max_period=0.1, clock=time.monotonic):
+        self.step = step
+        self.min_period = min_period
+        self.max_period = max_period
+        self.clock = clock
+        self.pending = False                # a new sample arrived since the last step
+        self.waiter = None                  # future the scheduler sleeps on until a sample or the deadline
+        self.trigger_time = None            # arrival of the oldest sample not yet acted on
+        self.last_start = clock()
+
+        self.latency = Histogram()          # sample arrival (or deadline) to end of step
+        self.jitter = Histogram()           # actual start minus planned start
+        self.duration = Histogram()         # time spent in the step itself
+        self.overruns = 0                   # steps that ended more than max_period after their planned start
+        self.event_steps = 0
+        self.deadline_steps = 0
+
+    def notify(self):
+        """ Signal a new sample, safe to call from reader callbacks on the loop """
+        if self.trigger_time is None:
+            self.trigger_time = self.clock()
+        self.pending = True
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_trigger(self):
+        deadline = self.last_start + self.max_period
+        timeout = deadline - self.clock()
+        if timeout > 0 and not self.pending:
+            # a bare future and timer, wait_for would wrap the wait in a new task on every step
+            loop = asyncio.get_running_loop()
+            self.waiter = loop.create_future()
+            timer = loop.call_later(timeout, self.wake)
+            try:
+                await self.waiter
+            finally:
+                timer.cancel()
+                self.waiter = None
+
+        planned = deadline
+        if self.pending:
+            planned = max(self.trigger_time, self.last_start + self.min_period)
+            delay = planned - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)     # rate limit, samples arriving meanwhile are coalesced into this step
+        return planned, deadline
+
+    async def run_once(self):
+        planned, deadline = await self.wait_trigger()
+        triggered = self.pending
+        trigger_time = self.trigger_time if triggered else planned
+        self.pending = False
+        self.trigger_time = None
+
+        start = self.clock()
+        self.jitter.observe(max(0, start - planned))
+        self.last_start = start
+
+        result = self.step()
+        if asyncio.iscoroutine(result):
+            await result
+
+        end = self.clock()
+        self.duration.observe(end - start)
+        self.latency.observe(end - trigger_time)
+        if end > planned + self.max_period:
+            self.overruns += 1
+        if triggered:
+            self.event_steps += 1
+        else:
+            self.deadline_steps += 1
+
+    async def run(self):
+        while True:
+            await self.run_once()
+
+    def stats(self):
+        """ Compact summary in milliseconds, for the log and the telemetry stream """
+        ms = lambda s: round(1000*s, 2)
+        return {"steps": self.event_steps + self.deadline_steps,
+                "event_steps": self.event_steps,
+                "overruns": self.overruns,
+                "latency_ms": [ms(self.latency.quantile(0.5)), ms(self.latency.quantile(0.99)), ms(self.latency.max)],
+                "jitter_ms": [ms(self.jitter.quantile(0.5)), ms(self.jitter.quantile(0.99)), ms(self.jitter.max)],
+                "step_ms": [ms(self.duration.quantile(0.5)), ms(self.duration.quantile(0.99)), ms(self.duration.max)]}
+
+    def log_stats(self):
+        log.info("Control steps: %d (%d on new samples), overruns: %d, latency p50/p99/max ms: %s, jitter ms: %s, step ms: %s",
+                 self.event_steps + self.deadline_steps, self.event_steps, self.overruns,
+                 *[self.stats()[k] for k in ("latency_ms", "jitter_ms", "step_ms")])
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
 import time
-import threading
 try:
     import joystick as joy
 except Exception as msg:
     raise
-from pixhawk import Pixhawk     # pixhawk or nucleo
+from pixhawk import Pixhawk, ManualControlStreamer     # pixhawk or nucleo
 import logging as log
 log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.DEBUG)
 
@@ -14,15 +13,9 @@ log.basicConfig(format='[%(levelname)s][%(asctime)s]%(message)s', level=log.DEBU
 DEVICE = "/dev/serial/by-id/usb-Silicon_Labs_CP2104_USB_to_UART_Bridge_Controller_01E97D63-if00-port0"
 BAUD = 57200
 
-def telem_thread():
-    while True:
-        pixhawk.get_feedback()
-        time.sleep(1)
-
 if __name__ == "__main__":
-    pixhawk = Pixhawk(DEVICE, BAUD)
-    telem_task = threading.Thread(target=telem_thread)
-    telem_task.start()
+    pixhawk = Pixhawk(DEVICE, BAUD).start()      # reader thread dispatches heartbeats and command acks
+    streamer = ManualControlStreamer(pixhawk).start()
 
     while(1):
         joy.joystick_update()
@@ -43,6 +36,6 @@ if __name__ == "__main__":
                 pixhawk.disarm()
 
             if pixhawk.armed:
-                pixhawk.send_cmd(pitch, yaw)
+                streamer.set(pitch, yaw)
 
         time.sleep(0.1)
\ No newline at end of file
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Closed-loop simulation of a homing run: vessel yaw/surge dynamics driven by MANUAL_CONTROL, and a beacon
+producing radio compass packets in the format radio_compass.py sends to port 5001
+
+Two ways to run the unchanged autohoming control step against it:
+  fast      the Controller from autohoming.py runs in this process on a virtual clock, in lockstep with the
+            dynamics, so a 10 minute run takes seconds (simulate() is what tuners call)
+  realtime  the vessel answers MAVLink through the stand-in autopilot and the beacon sends real UDP packets,
+            run autohoming.py --device udpin:127.0.0.1:14551 --record "" next to it
+
+Conventions follow the control code: positive yaw effort turns to starboard, negative pitch effort goes forward,
+and the relative bearing is positive with the beacon to starboard.
+"""
+import math
+import time
+import random
+import socket
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+""" Vessel model """
+MAX_SPEED = 1.5         # m/s at full forward effort
+SURGE_TAU = 3           # s, time constant of the speed response
+MAX_YAW_RATE = 60       # deg/s at full yaw effort
+YAW_TAU = 0.8           # s, time constant of the yaw rate response
+YAW_DEADBAND = 50       # yaw effort below which the thrusters do not turn the hull
+
+""" Beacon and radio compass model """
+BEACON_POWER = 60       # dB at 1 m
+BEARING_NOISE = 4       # deg, standard deviation of the DOA estimate
+OUTLIER_RATE = 0.05     # fraction of DOA estimates that are multipath garbage
+COMPASS_RATE = 5        # Hz, radio_compass.py POLL_RATE
+DOA_RATE = 1            # Hz, new DOA estimates from Hydra, the polls in between read the same one again
+GPS_RATE = 5            # Hz, GLOBAL_POSITION_INT from the autopilot
+ORIGIN = (30.6186, -96.3365)    # lat, lon of the sim's (0, 0) in the realtime GLOBAL_POSITION_INT stream
+BEARING_OFFSET = 45     # autohoming.py takes 45 degrees off the bearing it receives
+ARRIVAL_RADIUS = 5      # m, the run succeeds within this distance of the beacon
+
+""" Run settings """
+DT = 0.02               # s, dynamics step
+DURATION = 600          # s, give up after this long
+LINK = "udpout:127.0.0.1:14551"
+PORT_KERB = 5001
+LOCALHOST = "127.0.0.1"
+
+def wrap180(angle):
+    return (angle + 180) % 360 - 180
+
+class VirtualClock:
+    """ Convenient class for a clock that only moves when the simulation advances it """
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+class Vessel:
+    """ Convenient class for first order surge and yaw rate responses to the MANUAL_CONTROL pitch and yaw efforts """
+    def __init__(self, x=0, y=0, heading=0, current=(0, 0)):
+        self.x = x                  # m east
+        self.y = y                  # m north
+        self.heading = heading      # deg clockwise from north
+        self.speed = 0              # m/s through the water
+        self.yaw_rate = 0           # deg/s
+        self.current = current      # m/s (east, north) drift
+        self.pitch = 0
+        self.yaw = 0
+        self.travelled = 0
+
+    def command(self, pitch, yaw):
+        self.pitch, self.yaw = pitch, yaw
+
+    def step(self, dt):
+        yaw = 0 if abs(self.yaw) < YAW_DEADBAND else self.yaw
+        target_speed = MAX_SPEED*max(-1, min(1, -self.pitch/1000))
+        target_rate = MAX_YAW_RATE*max(-1, min(1, yaw/1000))
+        self.speed += (target_speed - self.speed)*dt/SURGE_TAU
+        self.yaw_rate += (target_rate - self.yaw_rate)*dt/YAW_TAU
+        self.heading = (self.heading + self.yaw_rate*dt) % 360
+
+        dx = (self.speed*math.sin(math.radians(self.heading)) + self.current[0])*dt
+        dy = (self.speed*math.cos(math.radians(self.heading)) + self.current[1])*dt
+        self.x += dx
+        self.y += dy
+        self.travelled += math.hypot(dx, dy)
+
+class Beacon:
+    """ Convenient class for a beacon at a fixed position, seen through a noisy radio compass """
+    def __init__(self, x, y, power=BEACON_POWER, noise=BEARING_NOISE, outliers=OUTLIER_RATE, rng=None):
+        self.x = x
+        self.y = y
+        self.power = power
+        self.noise = noise
+        self.outliers = outliers
+        self.rng = rng or random.Random()
+        self.latest = None          # packet of the current DOA estimate
+        self.next_estimate = None
+
+    def distance(self, vessel):
+        return math.hypot(self.x - vessel.x, self.y - vessel.y)
+
+    def relative_bearing(self, vessel):
+        return wrap180(math.degrees(math.atan2(self.x - vessel.x, self.y - vessel.y)) - vessel.heading)
+
+    def reading(self, vessel):
+        """ (bearing, power, confidence) the way the KerberosSDR would report them """
+        distance = max(1, self.distance(vessel))
+        power = self.power - 20*math.log10(distance) + self.rng.gauss(0, 1)
+        if self.rng.random() < self.outliers:
+            bearing = self.rng.uniform(-180, 180)
+            confidence = self.rng.uniform(0, 5)
+        else:
+            bearing = self.relative_bearing(vessel) + self.rng.gauss(0, self.noise)
+            confidence = max(0, 0.5*power + self.rng.gauss(0, 1))
+        return wrap180(bearing), power, confidence
+
+    def packet(self, vessel):
+        """ Radio compass packet for port 5001, Hydra reports whole degrees """
+        bearing, power, confidence = self.reading(vessel)
+        return '{{"bearing": {}, "power": {:.1f}, "confidence": {:.1f}}}'.format(
+            int(round(bearing)) + BEARING_OFFSET, power, confidence).encode()
+
+    def poll(self, vessel, t):
+        """ The packet a poll at t reads: a new estimate every 1/DOA_RATE s, the current one in between """
+        if self.next_estimate is None or t >= self.next_estimate:
+            self.latest = self.packet(vessel)
+            self.next_estimate = t + 1/DOA_RATE
+        return self.latest
+
+class SimAutopilot:
+    """ In-process stand-in for the Pixhawk class, used on the virtual clock where there is no MAVLink link """
+    def __init__(self, vessel):
+        self.vessel = vessel
+        self.armed = False
+        self.heartbeat = 0
+
+    def command_done(self, armed):
+        self.armed = armed
+        future = Future()
+        future.set_result(0)        # MAV_RESULT_ACCEPTED
+        return future
+
+    def request_arm(self):
+        return self.command_done(True)
+
+    def request_disarm(self):
+        return self.command_done(False)
+
+    def forget(self, future):
+        pass
+
+    def send_cmd(self, pitch, yaw):
+        self.vessel.command(pitch if self.armed else 0, yaw if self.armed else 0)
+
+class SimLED:
+    def pulse_slow(self): pass
+    def blink_slow(self): pass
+    def blink_fast(self): pass
+    def flash(self): pass
+    def flash_inverse(self): pass
+
+class Scenario:
+    """ Start pose, beacon position and current of one homing run """
+    def __init__(self, beacon=(0, 200), start=(0, 0), heading=0, current=(0, 0), seed=0):
+        self.beacon = beacon
+        self.start = start
+        self.heading = heading
+        self.current = current
+        self.seed = seed
+
+    def __repr__(self):
+        return "Scenario(beacon={}, start={}, heading={}, current={}, seed={})".format(
+            self.beacon, self.start, self.heading, self.current, self.seed)
+
+def pid_settings(gains=None, sample_time=0.5, output_limits=(-0.2,0.2)):
+    """ PID keyword arguments as autohoming.py builds its yaw_pid, with other gains, sample time or limits """
+    Kp, Ki, Kd = gains or (0.5, 0.05, 0.5)
+    return {"Kp": Kp, "Ki": Ki, "Kd": Kd, "sample_time": sample_time, "output_limits": tuple(output_limits)}
+
+async def run_fast(scenario, pid=None, duration=DURATION, dt=DT, trace=None, heading_aided=True):
+    """
+    Run the autohoming Controller in lockstep with the dynamics on a virtual clock
+    pid holds the yaw PID keyword arguments, see pid_settings(). heading_aided feeds the vessel heading through HeadingFusion
+    as the autopilot ATTITUDE stream would
+    """
+    import autohoming
+    from simple_pid import PID
+    from pixhawk import ManualControlStreamer, STREAM_RATE
+    from fusion import HeadingFusion, ATTITUDE_RATE
+    from localize import BeaconLocalizer
+
+    clock = VirtualClock()
+    rng = random.Random(scenario.seed)
+    vessel = Vessel(*scenario.start, heading=scenario.heading, current=scenario.current)
+    beacon = Beacon(*scenario.beacon, rng=rng)
+    pixhawk = SimAutopilot(vessel)
+    streamer = ManualControlStreamer(pixhawk, clock=clock)
+
+    # the same objects autohoming.py builds in __main__, on ephemeral ports since packets are handed over directly
+    joy = autohoming.Joystick(LOCALHOST, 0)
+    compass = autohoming.RadioCompass(LOCALHOST, 0)
+    compass.filter.clock = clock
+    vision = autohoming.Vision(LOCALHOST, 0)
+    effort = autohoming.Effort()
+    yaw_pid = PID(setpoint=0, **(pid or pid_settings()))
+    yaw_pid.time_fn = clock
+    yaw_pid.reset()
+    cmdproc = autohoming.CMDProcessor(yaw_pid, compass, LOCALHOST, 0)
+    localizer = BeaconLocalizer(clock=clock)
+    controller = autohoming.Controller(pixhawk, streamer, joy, compass, vision, cmdproc, effort, yaw_pid, SimLED(), clock=clock, localizer=localizer)
+    cmdproc.arming = True
+    fusion = HeadingFusion([compass, vision], clock) if heading_aided else None
+    compass.on_fix = lambda bearing, weight: localizer.add(bearing, weight, fusion and fusion.heading)
+
+    start = clock()
+    next_compass = next_stream = next_attitude = next_gps = last_step = start
+    new_sample = False
+    heading_error = 0
+    bearing_error = 0           # squared error of the bearing the controller acted on, summed over steps
+    bearing_steps = 0
+    initial_side = 1 if beacon.relative_bearing(vessel) >= 0 else -1
+    overshoot = 0               # furthest the bearing went past dead ahead, on the other side from the start
+    settled_since = None        # bearing within SETPOINT_TOLERANCE since
+    time_to_heading = None      # first time the bearing stayed within tolerance for SETPOINT_REACHED_WAIT_PERIOD
+    tracking_error = 0          # absolute bearing integrated over time once the heading was first reached
+    tracking_time = 0
+    yaw_effort = 0
+    arrived = None
+    steps = 0
+    try:
+        while clock() - start < duration:
+            now = clock()
+            if fusion and now >= next_attitude:
+                fusion.update(vessel.heading)
+                new_sample = True
+                next_attitude += 1/ATTITUDE_RATE
+            if now >= next_gps:
+                localizer.set_position(vessel.x, vessel.y, vessel.heading)
+                next_gps += 1/GPS_RATE
+            if now >= next_compass:
+                compass.handle(beacon.poll(vessel, now))
+                new_sample = True
+                next_compass += 1/COMPASS_RATE
+            # same trigger rule as the ControlScheduler: on new samples, within the min and max period
+            since = now - last_step
+            if (new_sample and since >= autohoming.CONTROL_MIN_PERIOD) or since >= autohoming.CONTROL_MAX_PERIOD:
+                if compass.bearing is not None:
+                    bearing_error += wrap180(compass.bearing - beacon.relative_bearing(vessel))**2
+                    bearing_steps += 1
+                await controller.step()
+                new_sample = False
+                last_step = now
+                steps += 1
+            if now >= next_stream:
+                streamer.tick(now)
+                next_stream += 1/STREAM_RATE
+
+            vessel.step(dt)
+            clock.advance(dt)
+            bearing = beacon.relative_bearing(vessel)
+            heading_error += abs(bearing)*dt
+            if time_to_heading is not None:
+                tracking_error += abs(bearing)*dt
+                tracking_time += dt
+            yaw_effort += abs(vessel.yaw)/1000*dt
+            overshoot = max(overshoot, -initial_side*bearing)
+            if abs(bearing) < autohoming.SETPOINT_TOLERANCE:
+                if settled_since is None:
+                    settled_since = clock()
+                if time_to_heading is None and clock() - settled_since >= autohoming.SETPOINT_REACHED_WAIT_PERIOD:
+                    time_to_heading = settled_since - start
+            else:
+                settled_since = None
+            if trace is not None:
+                trace.append((clock() - start, vessel.x, vessel.y, vessel.heading, vessel.pitch, vessel.yaw))
+            if beacon.distance(vessel) < ARRIVAL_RADIUS:
+                arrived = clock() - start
+                break
+    finally:
+        for receiver in (joy, compass, vision, cmdproc):
+            receiver.sock.close()
+
+    elapsed = clock() - start
+    return {"arrived": arrived is not None,
+            "time": round(elapsed, 2),
+            "distance": round(beacon.distance(vessel), 1),
+            "travelled": round(vessel.travelled, 1),
+            "heading_error": round(heading_error/elapsed, 1),
+            "bearing_error": round(math.sqrt(bearing_error/max(1, bearing_steps)), 2),
+            "beacon_error": None if localizer.estimate is None else round(math.hypot(localizer.estimate[0] - beacon.x, localizer.estimate[1] - beacon.y), 1),
+            "beacon_std": None if localizer.std is None else round(localizer.std, 1),
+            "time_to_heading": None if time_to_heading is None else round(time_to_heading, 2),
+            "tracking_error": round(tracking_error/tracking_time, 1) if tracking_time else None,
+            "overshoot": round(overshoot, 1),
+            "yaw_effort": round(yaw_effort/elapsed, 3),
+            "steps": steps}
+
+def simulate(scenario, pid=None, duration=DURATION, dt=DT, trace=None, heading_aided=True):
+    """ Fast run of one scenario, returns the summary dict. Quiets the control loop logging while it runs """
+    logger = log.getLogger()
+    level = logger.level
+    logger.setLevel(log.WARNING)
+    try:
+        return asyncio.run(run_fast(scenario, pid, duration, dt, trace, heading_aided))
+    finally:
+        logger.setLevel(level)
+
+class RealtimeSim:
+    """
+    Convenient class for the realtime simulation: the stand-in autopilot drives the vessel from the MANUAL_CONTROL it
+    receives, and the beacon sends radio compass packets to autohoming.py over UDP
+    """
+    def __init__(self, scenario, link=LINK, kerb=(LOCALHOST, PORT_KERB)):
+        from mav_standin import StandinAutopilot
+        from localize import to_latlon
+        self.rng = random.Random(scenario.seed)
+        self.vessel = Vessel(*scenario.start, heading=scenario.heading, current=scenario.current)
+        self.beacon = Beacon(*scenario.beacon, rng=self.rng)
+        self.kerb = kerb
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.autopilot = StandinAutopilot(link)
+        self.autopilot.on_manual_control = self.on_manual_control
+        self.autopilot.heading = lambda: self.vessel.heading
+        self.autopilot.position = lambda: to_latlon(self.vessel.x, self.vessel.y, ORIGIN)
+        self.stop_event = threading.Event()
+
+    def on_manual_control(self, x, y, z, r):
+        if self.autopilot.armed:
+            self.vessel.command(x, r)
+        else:
+            self.vessel.command(0, 0)
+
+    def run(self, duration=DURATION, report_period=5):
+        self.autopilot.start()
+        start = last = time.monotonic()
+        next_compass = next_report = start
+        try:
+            while time.monotonic() - start < duration and not self.stop_event.is_set():
+                now = time.monotonic()
+                self.vessel.step(now - last)
+                last = now
+                if now >= next_compass:
+                    self.sock.sendto(self.beacon.poll(self.vessel, now), self.kerb)
+                    next_compass += 1/COMPASS_RATE
+                if now >= next_report:
+                    log.info("t %.0f s, position (%.1f, %.1f), heading %.0f, beacon %.1f m at %.0f deg, effort (%d, %d)",
+                             now - start, self.vessel.x, self.vessel.y, self.vessel.heading, self.beacon.distance(self.vessel),
+                             self.beacon.relative_bearing(self.vessel), self.vessel.pitch, self.vessel.yaw)
+                    next_report += report_period
+                if self.beacon.distance(self.vessel) < ARRIVAL_RADIUS:
+                    log.info("Arrived at the beacon after %.1f s", now - start)
+                    break
+                time.sleep(DT)
+        finally:
+            self.autopilot.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--realtime", action="store_true", help="serve MAVLink and UDP for a separate autohoming.py")
+    parser.add_argument("--beacon", type=float, nargs=2, default=(0, 200), metavar=("EAST", "NORTH"), help="beacon position in m")
+    parser.add_argument("--heading", type=float, default=0, help="start heading in degrees")
+    parser.add_argument("--current", type=float, nargs=2, default=(0, 0), metavar=("EAST", "NORTH"), help="drift in m/s")
+    parser.add_argument("--gains", type=float, nargs=3, default=None, metavar=("KP", "KI", "KD"), help="yaw PID gains for the fast run")
+    parser.add_argument("--duration", type=float, default=DURATION)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--relative", action="store_true", help="fast run without heading aiding, relative bearings only")
+    args = parser.parse_args()
+
+    scenario = Scenario(tuple(args.beacon), heading=args.heading, current=tuple(args.current), seed=args.seed)
+    if args.realtime:
+        RealtimeSim(scenario).run(args.duration)
+    else:
+        started = time.perf_counter()
+        result = simulate(scenario, pid_settings(args.gains), args.duration, heading_aided=not args.relative)
+        log.info("%s: %s, %.2f s wall clock", scenario, result, time.perf_counter() - started)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Delta telemetry for the LoRa UART, shared by relayserver.py (encoder) and gui.py (decoder)
+The vehicle sends a keyframe holding every field, then deltas holding only the fields that moved by more than their
+tolerance since a baseline the ground station has confirmed receiving. Every delta names its baseline, so any delta
+that arrives can be decoded and a lost packet costs nothing but its own update. Nothing is sent while nothing changed.
+The ground station reports the last packet it decoded, right after decoding it, and how many it received. The vehicle
+moves its baseline to the reported packet and adapts its rate: additive increase, multiplicative decrease when the
+packets start queueing (the time from sending a packet to getting its report grows past DELAY_TARGET over the
+smallest seen) or when most of them are lost. Random loss alone does not slow it down, a lossy link needs updates more.
+The rate never plans more bytes per second than LINK_BUDGET.
+JSON payloads of lora_link frames, field names shortened through FIELDS:
+    keyframe  {"type":"tk","s":seq,"h":12,"b":-3.5,...}
+    delta     {"type":"td","s":seq,"r":baseline seq,"b":-1.0}
+    report    {"type":"tr","s":last seq decoded,"n":packets received}
+"""
+import time
+from collections import deque
+import codec
+
+KEYFRAME_PERIOD = 10        # s, a full state at least this often
+HISTORY = 32                # packets whose state is kept on both ends to decode deltas against
+MIN_RATE = 0.5              # Hz
+MAX_RATE = 5                # Hz
+START_RATE = 1              # Hz, the rate of the old full snapshot
+RATE_STEP = 0.5             # Hz added per report without congestion
+BACKOFF = 0.5               # rate multiplier per report showing congestion
+DELAY_TARGET = 0.5          # s of queueing, over the smallest report delay, taken as congestion
+DELAY_WINDOW = 15           # reports the smallest report delay is taken over
+LOSS_LIMIT = 0.5            # fraction of packets lost taken as congestion whatever the delay
+LOSS_WINDOW = 10            # packets the loss is measured over, fewer make a coin toss of it
+LINK_BUDGET = 150           # bytes/s of LoRa airtime planned for telemetry, half of a 2.4 kbps air rate
+REPORT_PERIOD = 2           # s between ground station reports
+REPORT_TIMEOUT = 3*REPORT_PERIOD    # no report for this long, assume the ground station lost everything
+
+TYPE_KEYFRAME = "tk"
+TYPE_DELTA = "td"
+TYPE_REPORT = "tr"
+
+FIELDS = {"heartbeat": "h", "bearing": "b", "confident": "c", "arm": "a", "pidparams": "p", "effort(p,y)": "e", "beacon": "l",
+          "power": "w", "confidence": "q"}
+NAMES = {v: k for k, v in FIELDS.items()}
+TOLERANCES = {"bearing": 1, "effort(p,y)": 20, "power": 1, "confidence": 1}      # changes up to this are not worth airtime
+
+def changed(name, old, new):
+    tolerance = TOLERANCES.get(name)
+    if tolerance is None or old is None or new is None:
+        return old != new
+    if isinstance(new, (list, tuple)):
+        return not isinstance(old, (list, tuple)) or len(old) != len(new) or any(abs(a - b) > tolerance for a, b in zip(old, new))
+    return abs(new - old) > tolerance
+
+class TelemetryEncoder:
+    """ Convenient class turning the latest telemetry snapshot into keyframes and deltas at an adaptive rate """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.state = {}             # latest snapshot from autohoming.py
+        self.sent = {}              # seq -> (state the ground station holds if it received that packet, time sent)
+        self.seq = 0
+        self.baseline = None        # latest seq the ground station reported decoding
+        self.next_keyframe = 0
+        self.rate = START_RATE
+        self.size = 60              # bytes, moving average of the packets sent
+        self.loss = None
+        self.expected = 0           # packets sent and received in the current loss window
+        self.arrived = 0
+        self.delays = deque(maxlen=DELAY_WINDOW)    # report delays, send to report
+        self.queueing = None        # s, latest report delay over the smallest
+        self.last_report = None     # (time, seq, received) of the previous report
+        self.keyframes = 0
+        self.deltas = 0
+        self.suppressed = 0
+        self.bytes = 0
+
+    def update(self, packet):
+        """ New snapshot, a decoded telem packet """
+        self.state = {k: v for k, v in packet.items() if k != "type"}
+
+    def period(self):
+        """ Seconds until the next packet, the AIMD rate capped by the byte budget """
+        return 1/max(MIN_RATE, min(self.rate, LINK_BUDGET/self.size))
+
+    def next_packet(self, now=None):
+        """ Encoded packet to write now, None when there is nothing new to say """
+        now = self.clock() if now is None else now
+        if not self.state:
+            return None
+        if self.last_report and now - self.last_report[0] > REPORT_TIMEOUT:
+            self.rate = MIN_RATE
+            self.baseline = None
+            self.last_report = None
+
+        base = self.sent.get(self.baseline, (None,))[0]
+        keyframe = base is None or now >= self.next_keyframe
+        if keyframe:
+            fields = dict(self.state)
+            held = dict(self.state)
+            self.next_keyframe = now + KEYFRAME_PERIOD
+        else:
+            fields = {k: v for k, v in self.state.items() if changed(k, base.get(k), v)}
+            if not fields:
+                self.suppressed += 1
+                return None
+            held = dict(base)
+            held.update(fields)
+
+        self.seq += 1
+        self.sent[self.seq] = (held, now)
+        self.sent.pop(self.seq - HISTORY, None)
+        if self.baseline is not None and self.seq - self.baseline >= HISTORY:
+            self.baseline = None        # the ground station no longer holds it
+
+        packet = {"type": TYPE_KEYFRAME if keyframe else TYPE_DELTA, "s": self.seq}
+        if not keyframe:
+            packet["r"] = self.baseline
+        packet.update((FIELDS.get(k, k), v) for k, v in fields.items())
+        message = codec.encode_json(packet)
+        self.size += (len(message) - self.size)/8
+        self.bytes += len(message)
+        if keyframe:
+            self.keyframes += 1
+        else:
+            self.deltas += 1
+        return message
+
+    def report(self, packet, now=None):
+        """ Ground station report: move the baseline and adapt the rate to the queueing and loss since the previous report """
+        now = self.clock() if now is None else now
+        seq, received = packet.get("s"), packet.get("n")
+        if seq is None or received is None or seq not in self.sent:
+            return
+        if self.baseline is None or seq > self.baseline:
+            self.baseline = seq
+        self.delays.append(now - self.sent[seq][1])
+        self.queueing = self.delays[-1] - min(self.delays)
+        if self.last_report and seq > self.last_report[1] and received >= self.last_report[2]:
+            self.expected += seq - self.last_report[1]
+            self.arrived += received - self.last_report[2]
+            lossy = False
+            if self.expected >= LOSS_WINDOW:
+                self.loss = max(0, 1 - self.arrived/self.expected)
+                self.expected = self.arrived = 0
+                lossy = self.loss > LOSS_LIMIT
+            if self.queueing > DELAY_TARGET or lossy:
+                self.rate = max(MIN_RATE, self.rate*BACKOFF)
+            else:
+                self.rate = min(MAX_RATE, self.rate + RATE_STEP)
+        self.last_report = (now, seq, received)
+
+    def stats(self):
+        return {"rate": round(1/self.period(), 2), "loss": None if self.loss is None else round(self.loss, 2),
+                "queueing": None if self.queueing is None else round(self.queueing, 2),
+                "keyframes": self.keyframes, "deltas": self.deltas, "suppressed": self.suppressed, "bytes": self.bytes}
+
+class TelemetryDecoder:
+    """ Convenient class rebuilding the full telemetry state from keyframes and deltas, and reporting back what arrived """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.states = {}            # seq -> full state
+        self.last = None            # seq of the latest state decoded
+        self.received = 0
+        self.undecodable = 0        # deltas whose baseline was never received
+        self.next_report = 0
+
+    def apply(self, packet):
+        """ Decoded keyframe or delta in, full telem packet out, None if the delta's baseline is unknown """
+        self.received += 1
+        seq = packet.get("s")
+        fields = {NAMES.get(k, k): v for k, v in packet.items() if k not in ("type", "s", "r")}
+        if packet.get("type") == TYPE_KEYFRAME:
+            state = fields
+        else:
+            base = self.states.get(packet.get("r"))
+            if base is None:
+                self.undecodable += 1
+                return None
+            state = dict(base)
+            state.update(fields)
+        if seq is not None:
+            if self.last is not None and seq < self.last - HISTORY:
+                self.states.clear()     # the vehicle restarted its sequence
+            self.states[seq] = state
+            self.states.pop(seq - HISTORY, None)
+            self.last = seq
+        telem = {"type": "telem"}
+        telem.update(state)
+        return telem
+
+    def report(self, now=None):
+        """ Encoded report when one is due, else None """
+        now = self.clock() if now is None else now
+        if self.last is None or now < self.next_report:
+            return None
+        self.next_report = now + REPORT_PERIOD
+        return codec.encode_json({"type": TYPE_REPORT, "s": self.last, "n": self.received})
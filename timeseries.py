@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Fixed size telemetry history for the ground station plots
+Samples go into preallocated numpy arrays used as a ring, so a session of any length holds the same memory and an
+append is a couple of index writes. window() hands back the samples of the last few seconds in time order, decimated
+to what a plot can show.
+"""
+import numpy as np
+
+CAPACITY = 6000         # samples kept, 20 min at the 5 Hz telemetry rate
+CHANNELS = ("bearing", "pitch", "yaw", "power", "confidence")
+
+class RingBuffer:
+    """ Convenient class for the latest capacity samples of a few channels and their times, oldest overwritten first """
+    def __init__(self, channels, capacity=CAPACITY):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.full((capacity, channels), np.nan)
+        self.count = 0          # samples ever appended
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, values):
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.values[i] = values
+        self.count += 1
+
+    def ordered(self):
+        """ (times, values) of everything held, oldest first """
+        if self.count <= self.capacity:
+            return self.times[:self.count], self.values[:self.count]
+        start = self.count % self.capacity
+        return np.roll(self.times, -start), np.roll(self.values, -start, axis=0)
+
+    def window(self, seconds, now=None, points=None):
+        """ (times, values) of the samples from the last seconds before now (default the latest sample), at most points of them """
+        if not self.count:
+            return self.times[:0], self.values[:0]
+        times, values = self.ordered()
+        now = times[-1] if now is None else now
+        start = np.searchsorted(times, now - seconds)
+        times, values = times[start:], values[start:]
+        if points and len(times) > points:
+            keep = np.linspace(0, len(times) - 1, points).astype(int)
+            times, values = times[keep], values[keep]
+        return times, values
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.values[(self.count - 1) % self.capacity]
+
+class TelemetryHistory(RingBuffer):
+    """ Ring buffer of the plotted telemetry fields, missing ones stored as NaN """
+    def __init__(self, capacity=CAPACITY):
+        super().__init__(len(CHANNELS), capacity)
+
+    def add(self, t, packet):
+        pitch, yaw = packet.get("effort(p,y)") or (None, None)
+        values = (packet.get("bearing"), pitch, yaw, packet.get("power"), packet.get("confidence"))
+        self.append(t, [np.nan if v is None else v for v in values])
+
+    def channel(self, name):
+        return CHANNELS.index(name)
+
+def segments(times, values):
+    """ Runs of consecutive non NaN (t, value) points, a line is broken where a value was missing """
+    runs, run = [], []
+    for t, v in zip(times.tolist(), values.tolist()):
+        if v != v:          # NaN
+            if len(run) > 1:
+                runs.append(run)
+            run = []
+        else:
+            run.append((t, v))
+    if len(run) > 1:
+        runs.append(run)
+    return runs
+
+def span(*columns):
+    """ (low, high) of the finite values of the columns, padded so a flat line sits mid plot, None without any """
+    finite = np.concatenate([c[np.isfinite(c)] for c in columns])
+    if not len(finite):
+        return None
+    low, high = float(finite.min()), float(finite.max())
+    pad = max(1, (high - low)*0.1)
+    return low - pad, high + pad
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Batch tuning of the autohoming yaw PID on simulated homing runs
+Every candidate PID(Kp, Ki, Kd, sample_time, output_limits) is run on a set of sim.py scenarios across a process
+pool and scored by time to heading, overshoot, yaw effort, heading error once settled and the distance to the beacon
+left at the end. The controller turns at YAW_SPEED until the bearing is within tolerance, so the time to heading is the
+same for every candidate and the PID shows in the last two terms. Equal scores are ranked by effort, then by the
+smaller gains. A random search around the best candidates can refine the grid. The ranked table is printed, and the
+best gains with the sample time and output limits of autohoming.py can be sent to the vehicle as a tune command.
+"""
+import os
+import math
+import time
+import socket
+import random
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import codec
+import sim
+import logging as log
+log.basicConfig(format='[%(levelname)s][%(asctime)s][%(funcName)s]%(message)s', level=log.DEBUG)
+
+""" Default search space """
+KP = [-1, -0.5, -0.2, 0.2, 0.5, 1]
+KI = [0, 0.05, 0.2]
+KD = [0, 0.2, 0.5]
+SAMPLE_TIME = [0.1, 0.5]
+OUTPUT_LIMIT = [0.2, 0.4]           # symmetric output_limits, as a fraction of full yaw effort
+
+""" Scoring """
+RUN_DURATION = 60                   # s per simulated run, the heading loop has settled or failed by then
+HEADINGS = [90, -60, 150, -135]     # start headings, with the beacon dead ahead of heading 0
+BEACON = (0, 100)
+WEIGHT_TIME = 1                     # per RUN_DURATION taken to settle on the heading (a run that never settles counts as RUN_DURATION)
+WEIGHT_OVERSHOOT = 1                # per SETPOINT_TOLERANCE of overshoot
+WEIGHT_EFFORT = 1                   # per unit of mean absolute yaw effort (1 = full effort all the time)
+WEIGHT_TRACKING = 1                 # per TOLERANCE of mean heading error once settled (a run that never settles counts as TOLERANCE)
+WEIGHT_PROGRESS = 1                 # per start distance to the beacon still left at the end of the run
+TOLERANCE = 10                      # deg, autohoming.SETPOINT_TOLERANCE
+
+PORT_RELAY = 5000
+PORT_GUI = 5005
+IP_BROADCAST = "255.255.255.255"
+
+def scenarios(headings=HEADINGS, seeds=1):
+    return [sim.Scenario(BEACON, heading=heading, seed=seed) for heading in headings for seed in range(seeds)]
+
+def grid(kp=KP, ki=KI, kd=KD, sample_time=SAMPLE_TIME, output_limit=OUTPUT_LIMIT):
+    return [sim.pid_settings((p, i, d), t, (-l, l)) for p, i, d, t, l in itertools.product(kp, ki, kd, sample_time, output_limit)]
+
+def neighbours(pid, count, scale, rng):
+    """ Random candidates around pid, each gain perturbed by up to scale of its magnitude (or of scale itself near 0) """
+    candidates = []
+    for n in range(count):
+        candidate = dict(pid)
+        for key in ("Kp", "Ki", "Kd"):
+            candidate[key] = round(pid[key] + rng.uniform(-scale, scale)*max(abs(pid[key]), scale), 4)
+        candidate["Ki"] = max(0, candidate["Ki"])
+        candidate["Kd"] = max(0, candidate["Kd"])
+        candidates.append(candidate)
+    return candidates
+
+def start_distance(scenario):
+    return math.hypot(scenario.beacon[0] - scenario.start[0], scenario.beacon[1] - scenario.start[1])
+
+def score(result, duration=RUN_DURATION, distance=None):
+    """ Lower is better. distance is the start distance to the beacon, the progress term is left out without it """
+    time_to_heading = duration if result["time_to_heading"] is None else result["time_to_heading"]
+    tracking_error = TOLERANCE if result["tracking_error"] is None else result["tracking_error"]
+    remaining = result["distance"]/distance if distance else 0
+    return (WEIGHT_TIME*time_to_heading/duration
+            + WEIGHT_OVERSHOOT*result["overshoot"]/TOLERANCE
+            + WEIGHT_EFFORT*result["yaw_effort"]
+            + WEIGHT_TRACKING*tracking_error/TOLERANCE
+            + WEIGHT_PROGRESS*remaining)
+
+def rank_key(entry):
+    """ Score, then effort, then the smaller gains, so equal candidates always rank the same way """
+    pid = entry["pid"]
+    return (round(entry["score"], 6), round(entry["yaw_effort"], 6), abs(pid["Kp"]) + pid["Ki"] + pid["Kd"],
+            pid["Kp"], pid["Ki"], pid["Kd"], pid["sample_time"], pid["output_limits"][1])
+
+def pushable(pid):
+    """ Only the gains travel in a tune command, so the rest must match the yaw_pid autohoming.py builds """
+    default = sim.pid_settings()
+    return pid["sample_time"] == default["sample_time"] and tuple(pid["output_limits"]) == default["output_limits"]
+
+def evaluate(task):
+    """ Worker: one candidate on all scenarios, returns the candidate with its mean score and metrics """
+    pid, scenarios, duration = task
+    results = [sim.simulate(scenario, pid, duration) for scenario in scenarios]
+    count = len(results)
+    settled = [r["time_to_heading"] for r in results if r["time_to_heading"] is not None]
+    tracking = [r["tracking_error"] for r in results if r["tracking_error"] is not None]
+    return {"pid": pid,
+            "score": sum(score(r, duration, start_distance(scenario)) for r, scenario in zip(results, scenarios))/count,
+            "settled": len(settled),
+            "time_to_heading": sum(settled)/len(settled) if settled else None,
+            "tracking_error": sum(tracking)/len(tracking) if tracking else None,
+            "overshoot": max(r["overshoot"] for r in results),
+            "yaw_effort": sum(r["yaw_effort"] for r in results)/count,
+            "remaining": sum(r["distance"]/start_distance(scenario) for r, scenario in zip(results, scenarios))/count}
+
+def sweep(candidates, scenarios, workers=None, duration=RUN_DURATION):
+    """ Evaluate every candidate over the process pool, best first """
+    tasks = [(pid, scenarios, duration) for pid in candidates]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        ranked = list(map(evaluate, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            ranked = list(pool.map(evaluate, tasks, chunksize=max(1, len(tasks)//(4*workers))))
+    return sorted(ranked, key=rank_key)
+
+def table(ranked, top=10, runs=None):
+    lines = ["{:>4}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}{:>9}{:>10}{:>10}{:>8}{:>8}{:>8}".format(
+        "rank", "score", "Kp", "Ki", "Kd", "sample", "limit", "settled", "heading s", "track deg", "over", "effort", "left")]
+    for rank, entry in enumerate(ranked[:top], 1):
+        pid = entry["pid"]
+        lines.append("{:>4}{:>8.3f}{:>8.3g}{:>8.3g}{:>8.3g}{:>8.3g}{:>8.3g}{:>9}{:>10}{:>10}{:>8.1f}{:>8.3f}{:>8.2f}".format(
+            rank, entry["score"], pid["Kp"], pid["Ki"], pid["Kd"], pid["sample_time"], pid["output_limits"][1],
+            "{}/{}".format(entry["settled"], runs) if runs else entry["settled"],
+            "-" if entry["time_to_heading"] is None else "{:.1f}".format(entry["time_to_heading"]),
+            "-" if entry["tracking_error"] is None else "{:.1f}".format(entry["tracking_error"]),
+            entry["overshoot"], entry["yaw_effort"], entry["remaining"]))
+    return "\n".join(lines)
+
+def push(pid, vid, host=IP_BROADCAST, timeout=2):
+    """
+    Send the gains as a tune command to vehicle vid through its relay, the way gui.py does, and wait for the ack
+    Only Kp, Ki and Kd travel in a tune command, sample_time and output_limits have to be set in autohoming.py
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)     # share the ack port with a running gui.py
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.bind(("", PORT_GUI))
+    sock.settimeout(timeout)
+    packet = {"type": "cmd", "cmd": "tune", "Kp": pid["Kp"], "Ki": pid["Ki"], "Kd": pid["Kd"], "vid": vid}
+    sock.sendto(codec.encode(packet), (host, PORT_RELAY))
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            try:
+                reply = codec.decode(sock.recv(1024))
+            except codec.DecodeError:
+                continue
+            if reply.get("type") == "ack" and reply.get("cmd") == "tune" and reply.get("vid") in (vid, None):
+                return True
+    except socket.timeout:
+        pass
+    finally:
+        sock.close()
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=None, help="process pool size, all cores by default")
+    parser.add_argument("--seeds", type=int, default=1, help="noise seeds per start heading")
+    parser.add_argument("--refine", type=int, default=0, help="random search rounds around the best candidates after the grid")
+    parser.add_argument("--top", type=int, default=10, help="rows of the ranked table")
+    parser.add_argument("--push", action="store_true", help="send the best gains to the vehicle as a tune command")
+    parser.add_argument("--host", default=IP_BROADCAST, help="relay server address for --push")
+    parser.add_argument("--vid", type=int, help="vehicle id the --push goes to, every relay would apply a tune naming none")
+    parser.add_argument("--scaling", action="store_true", help="time the grid with 1, 2, ... workers up to --workers")
+    args = parser.parse_args()
+    if args.push and args.vid is None:
+        parser.error("--push needs --vid")
+
+    log.getLogger().setLevel(log.INFO)
+    runs = scenarios(seeds=args.seeds)
+    candidates = grid()
+
+    if args.scaling:
+        base = None
+        for workers in range(1, (args.workers or os.cpu_count()) + 1):
+            started = time.perf_counter()
+            sweep(candidates, runs, workers)
+            elapsed = time.perf_counter() - started
+            base = base or elapsed
+            log.info("%d workers: %.1f s, speedup %.2f", workers, elapsed, base/elapsed)
+
+    started = time.perf_counter()
+    ranked = sweep(candidates, runs, args.workers)
+    rng = random.Random(0)
+    for i in range(args.refine):
+        scale = 0.5/(i + 1)
+        refined = [neighbour for entry in ranked[:4] for neighbour in neighbours(entry["pid"], 8, scale, rng)]
+        ranked = sorted(ranked + sweep(refined, runs, args.workers), key=rank_key)
+    elapsed = time.perf_counter() - started
+    evaluated = len(ranked)*len(runs)
+
+    print(table(ranked, args.top, len(runs)))
+    log.info("%d candidates x %d scenarios = %d simulated runs of %d s in %.1f s", len(ranked), len(runs), evaluated, RUN_DURATION, elapsed)
+
+    if args.push:
+        candidates = [(rank, entry["pid"]) for rank, entry in enumerate(ranked, 1) if pushable(entry["pid"])]
+        if not candidates:
+            log.warning("No candidate with the sample time and output limits of autohoming.py, nothing pushed")
+        else:
+            rank, best = candidates[0]
+            log.info("Pushing rank %d, the best with sample time %s and output limits %s", rank, best["sample_time"], best["output_limits"])
+            if push(best, args.vid, args.host):
+                log.info("Tune command acked: Kp %s Ki %s Kd %s", best["Kp"], best["Ki"], best["Kd"])
+            else:
+                log.warning("Tune command not acked")